@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -
+import math
+import time
+import logging
+from xml.sax.saxutils import escape
+
+log = logging.getLogger(__name__)
+
+# (name, path, logged in)
+SCENARIOS = [('static', '/base/css/main.css', False),
+             ('anonymous', '/dataset', False),
+             ('api', '/api/3/action/package_show', False),
+             ('download', '/dataset/x/resource/y/download/data.csv', False),
+             ('logged-in', '/dataset', True)]
+
+BENCHMARK_TICKET = 'ST-identify-benchmark'
+
+SERVICE_RESPONSE = '''<cas:serviceResponse xmlns:cas="http://www.yale.edu/tp/cas">
+  <cas:authenticationSuccess>
+    <cas:user>{user}</cas:user>
+    <cas:attributes>
+{attributes}    </cas:attributes>
+  </cas:authenticationSuccess>
+</cas:serviceResponse>
+'''
+
+SERVICE_FAILURE = '''<cas:serviceResponse xmlns:cas="http://www.yale.edu/tp/cas">
+  <cas:authenticationFailure code="{code}">{message}</cas:authenticationFailure>
+</cas:serviceResponse>
+'''
+
+SAML_FAILURE = '''<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/">
+  <SOAP-ENV:Header/>
+  <SOAP-ENV:Body>
+    <Response xmlns="urn:oasis:names:tc:SAML:1.0:protocol" MajorVersion="1" MinorVersion="1">
+      <Status>
+        <StatusCode Value="samlp:RequestDenied"/>
+        <StatusMessage>{message}</StatusMessage>
+      </Status>
+    </Response>
+  </SOAP-ENV:Body>
+</SOAP-ENV:Envelope>
+'''
+
+SAML_RESPONSE = '''<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/">
+  <SOAP-ENV:Header/>
+  <SOAP-ENV:Body>
+    <Response xmlns="urn:oasis:names:tc:SAML:1.0:protocol" xmlns:saml="urn:oasis:names:tc:SAML:1.0:assertion" MajorVersion="1" MinorVersion="1">
+      <Status><StatusCode Value="samlp:Success"/></Status>
+      <saml:Assertion MajorVersion="1" MinorVersion="1">
+        <saml:AttributeStatement>
+{attributes}        </saml:AttributeStatement>
+      </saml:Assertion>
+    </Response>
+  </SOAP-ENV:Body>
+</SOAP-ENV:Envelope>
+'''
+
+
+def _groups(groups, base_property, role='admin'):
+    # The group matching `base_property` is the last one, the worst case for
+    # a parser looking for it
+    names = ['cn=grupo-{0:04d},ou=grupos,o=gobcan'.format(number)
+             for number in range(max(0, groups - 1))]
+    names.append('cn={0},o={1}'.format(role, base_property))
+    return names
+
+
+def service_response(user, attributes, groups=0, base_property='opendata',
+                     role='admin'):
+    '''
+    Returns a CAS 2/3 ``serviceValidate`` success response for `user` with
+    the `attributes` dict and `groups` ``isMemberOf`` values, the last of
+    them being the `role` group of `base_property`.
+    '''
+    lines = ['      <cas:{0}>{1}</cas:{0}>\n'.format(name, escape(value))
+             for name, value in attributes.items()]
+    lines.extend('      <cas:isMemberOf>{0}</cas:isMemberOf>\n'.format(escape(group))
+                 for group in _groups(groups, base_property, role))
+    return SERVICE_RESPONSE.format(user=escape(user),
+                                   attributes=''.join(lines)).encode('utf-8')
+
+
+def service_failure(code='INVALID_TICKET', message='Ticket not recognized'):
+    return SERVICE_FAILURE.format(code=code, message=escape(message)).encode('utf-8')
+
+
+def saml_response(attributes, groups=0, base_property='opendata',
+                  role='admin'):
+    '''Returns a SAML 1.1 ``samlValidate`` success response'''
+    values = [(name, [value]) for name, value in attributes.items()]
+    if groups:
+        values.append(('isMemberOf', _groups(groups, base_property, role)))
+    lines = []
+    for name, items in values:
+        lines.append('          <saml:Attribute AttributeName="{0}">\n'.format(name))
+        lines.extend('            <saml:AttributeValue>{0}</saml:AttributeValue>\n'.format(
+            escape(item)) for item in items)
+        lines.append('          </saml:Attribute>\n')
+    return SAML_RESPONSE.format(attributes=''.join(lines)).encode('utf-8')
+
+
+def saml_failure(message='Ticket not recognized'):
+    return SAML_FAILURE.format(message=escape(message)).encode('utf-8')
+
+
+def _time_identify(flask_app, plugin, path, iterations, headers=None,
+                   environ=None):
+    with flask_app.test_request_context(path, headers=headers or {},
+                                        environ_base=environ or {}):
+        # Warm up caches (ticket cache, user object) before measuring
+        for _ in range(min(100, iterations)):
+            plugin.identify()
+        start = time.perf_counter()
+        for _ in range(iterations):
+            plugin.identify()
+        return time.perf_counter() - start
+
+
+def benchmark_identify(flask_app, plugin, user_name, iterations=10000):
+    '''
+    Measures the time `plugin.identify` takes per request for each kind of
+    traffic in `SCENARIOS` and returns one result per scenario.
+
+    The logged-in scenario stores a login entry for `user_name`, which must
+    be an existing user that does not log in through CAS (e.g. the site
+    user), and removes it afterwards.
+    '''
+    from ckanext.cas import db
+
+    results = []
+    for name, path, logged_in in SCENARIOS:
+        headers, environ = {}, {}
+        if logged_in:
+            headers['Cookie'] = '{0}=benchmark'.format(
+                plugin.SESSION_COOKIE_NAME)
+            environ['beaker.session'] = {'user': user_name}
+            db.upsert_entry(BENCHMARK_TICKET, user_name)
+        try:
+            elapsed = _time_identify(flask_app, plugin, path, iterations,
+                                     headers, environ)
+        finally:
+            if logged_in:
+                db.delete_user_entry(user_name)
+        results.append({'scenario': name,
+                        'path': path,
+                        'iterations': iterations,
+                        'seconds': elapsed,
+                        'us_per_request': 1e6 * elapsed / iterations})
+    return results
+
+
+def percentile(values, fraction):
+    '''Returns the nearest-rank percentile of a list of numbers'''
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = int(math.ceil(fraction * len(ordered)))
+    return ordered[max(0, min(len(ordered), rank) - 1)]
+
+
+def format_results(results):
+    lines = ['{0:<30} {1:<42} {2:>10} {3:>14}'.format(
+        'scenario', 'path', 'requests', 'us/request')]
+    for result in results:
+        lines.append('{0:<30} {1:<42} {2:>10} {3:>14.2f}'.format(
+            result['scenario'], result['path'], result['iterations'],
+            result['us_per_request']))
+    return '\n'.join(lines)
+
+
+def benchmark_parser(attribute_map, groups=(10, 100, 1000), iterations=1000):
+    '''
+    Times the validation response parsers on responses for a user in each
+    number of `groups` and returns one result per parser and group count.
+    '''
+    from ckanext.cas import parser
+
+    attributes = {'mail': 'usuario@gobiernodecanarias.org',
+                  'displayName': 'Usuario de prueba',
+                  'uid': 'usuario'}
+    results = []
+    for count in groups:
+        payloads = [
+            ('serviceValidate', parser.parse_service_response,
+             service_response('usuario', attributes, count,
+                              attribute_map.member_filter or 'opendata')),
+            ('samlValidate', parser.parse_saml_response,
+             saml_response(attributes, count,
+                           attribute_map.member_filter or 'opendata'))]
+        for name, parse, payload in payloads:
+            start = time.perf_counter()
+            for _ in range(iterations):
+                parse(payload, attribute_map)
+            elapsed = time.perf_counter() - start
+            results.append({'scenario': '{0} ({1} groups)'.format(name, count),
+                            'path': '{0} bytes'.format(len(payload)),
+                            'iterations': iterations,
+                            'seconds': elapsed,
+                            'us_per_request': 1e6 * elapsed / iterations})
+    return results
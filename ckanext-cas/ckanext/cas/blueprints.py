@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -
-from flask import Blueprint
+from flask import Blueprint, make_response
 
 try:
     from ckan.plugins.toolkit import redirect
@@ -9,6 +9,7 @@ except ImportError:
 from ckantoolkit import config
 
 import datetime
+import functools
 import logging
 import time
 import urllib.request
@@ -25,9 +26,13 @@ import ckan.plugins.toolkit as t
 import requests as rq
 from ckan.common import g, session
 
+from ckanext.cas import client, parser
+
 from ckan.views.user import set_repoze_user
-from ckanext.cas.db import delete_entry, delete_user_entry, insert_entry
-from lxml import etree, objectify
+from ckanext.cas.db import (delete_entry, get_attributes_hash, get_user_hash,
+                            set_user_hash, upsert_entry)
+from ckanext.cas.limiter import login_limiter
+from lxml import etree
 
 log = logging.getLogger(__name__)
 
@@ -38,6 +43,17 @@ CAS_NAMESPACE = 'urn:oasis:names:tc:SAML:2.0:protocol'
 XML_NAMESPACES = {'samlp': CAS_NAMESPACE}
 DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
 
+SAML_PREFIXES = {'SOAP-ENV': 'http://schemas.xmlsoap.org/soap/envelope/',
+                 'samlp': 'urn:oasis:names:tc:SAML:1.0:protocol'}
+for _prefix, _uri in SAML_PREFIXES.items():
+    etree.register_namespace(_prefix, _uri)
+
+SOAP_ENVELOPE = etree.QName(SAML_PREFIXES['SOAP-ENV'], 'Envelope')
+SOAP_HEADER = etree.QName(SAML_PREFIXES['SOAP-ENV'], 'Header')
+SOAP_BODY = etree.QName(SAML_PREFIXES['SOAP-ENV'], 'Body')
+SAMLP_REQUEST = etree.QName(SAML_PREFIXES['samlp'], 'Request')
+SAMLP_ARTIFACT = etree.QName(SAML_PREFIXES['samlp'], 'AssertionArtifact')
+
 
 def cas_logout():
     log.debug('Invoked "cas_logout" method.')
@@ -52,29 +68,56 @@ def cas_logout():
     return h.redirect_to(url_return)
 
 
-def _generate_saml_request(ticket_id):
-    prefixes = {'SOAP-ENV': 'http://schemas.xmlsoap.org/soap/envelope/',
-                'samlp': 'urn:oasis:names:tc:SAML:1.0:protocol'}
-
-    def _generate_ns_element(prefix, element):
-        return etree.QName(prefixes[prefix], element)
+def _validation_unavailable(cas_plugin, ticket, error):
+    msg = 'Validation of ticket {0} failed, CAS server unavailable: {1}'.format(
+        ticket, error)
+    log.error(msg)
+    if cas_plugin.REDIRECT_ON_UNSUCCESSFUL_LOGIN:
+        return redirect(cas_plugin.REDIRECT_ON_UNSUCCESSFUL_LOGIN)
+    abort(503, msg)
+
+
+def _login_busy(cas_plugin):
+    retry_after = cas_plugin.LOGIN_RETRY_AFTER
+    response = make_response(
+        render('cas/login_busy.html',
+               {'retry_after': retry_after,
+                'came_from': t.request.params.get('next')}), 503)
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+def _limit_validations(view):
+    '''
+    Runs the ticket validation of a callback view within the login limiter,
+    answering with a retry page when no slot frees up in time
+    '''
+    @functools.wraps(view)
+    def wrapper(**kwargs):
+        cas_plugin = p.get_plugin('cas')
+        if not t.request.params.get(cas_plugin.TICKET_KEY):
+            return view(**kwargs)
+        if not login_limiter.acquire():
+            return _login_busy(cas_plugin)
+        try:
+            return view(**kwargs)
+        finally:
+            login_limiter.release()
+    return wrapper
 
-    for prefix, uri in list(prefixes.items()):
-        etree.register_namespace(prefix, uri)
 
-    envelope = etree.Element(_generate_ns_element('SOAP-ENV', 'Envelope'))
-    etree.SubElement(envelope, _generate_ns_element('SOAP-ENV', 'Header'))
-    body = etree.SubElement(
-        envelope, _generate_ns_element('SOAP-ENV', 'Body'))
+def _generate_saml_request(ticket_id):
+    envelope = etree.Element(SOAP_ENVELOPE)
+    etree.SubElement(envelope, SOAP_HEADER)
+    body = etree.SubElement(envelope, SOAP_BODY)
 
-    request = etree.Element(_generate_ns_element('samlp', 'Request'))
+    request = etree.Element(SAMLP_REQUEST)
     request.set('MajorVersion', '1')
     request.set('MinorVersion', '1')
     request.set('RequestID', uuid4().hex)
     request.set('IssueInstant',
                 datetime.datetime.utcnow().strftime(DATETIME_FORMAT))
-    artifact = etree.SubElement(
-        request, _generate_ns_element('samlp', 'AssertionArtifact'))
+    artifact = etree.SubElement(request, SAMLP_ARTIFACT)
     artifact.text = ticket_id
 
     body.append(request)
@@ -93,34 +136,20 @@ def cas_saml_callback(**kwargs):
             return redirect(cas_plugin.CAS_APP_URL + next_url)
 
         log.debug('Validating ticket: {0}'.format(ticket))
-        q = rq.post(cas_plugin.SAML_VALIDATION_URL + '?TARGET={0}/cas/saml_callback'.format(cas_plugin.CAS_APP_URL),
-                    data=_generate_saml_request(ticket),
-                    verify=cas_plugin.VERIFY_CERTIFICATE)
+        try:
+            q = client.post(cas_plugin.SAML_VALIDATION_URL + '?TARGET={0}/cas/saml_callback'.format(cas_plugin.CAS_APP_URL),
+                            data=_generate_saml_request(ticket),
+                            verify=cas_plugin.VERIFY_CERTIFICATE)
+        except rq.exceptions.RequestException as e:
+            return _validation_unavailable(cas_plugin, ticket, e)
 
-        root = objectify.fromstring(q.content)
-        failure = False
         try:
-            if root['Body']['{urn:oasis:names:tc:SAML:1.0:protocol}Response']['Status']['StatusCode'].get(
-                    'Value') == 'samlp:Success':
-                user_attrs = cas_plugin.USER_ATTR_MAP
-                cas_attributes = [x for x in root['Body']['{urn:oasis:names:tc:SAML:1.0:protocol}Response'][
-                    '{urn:oasis:names:tc:SAML:1.0:assertion}Assertion']['AttributeStatement']['Attribute']]
-                data_dict = {}
-                attributes = {
-                    key.get('AttributeName'): key['AttributeValue'].text for key in cas_attributes}
-
-                for key, val in list(user_attrs.items()):
-                    if type(val) == list:
-                        data_dict[key] = ' '.join(
-                            [attributes.get(x, '') for x in val])
-                    else:
-                        data_dict[key] = attributes.get(val, '')
-
-            else:
-                failure = root['Body']['{urn:oasis:names:tc:SAML:1.0:protocol}Response']['Status'][
-                    'StatusMessage'].text
-        except AttributeError:
-            failure = True
+            result = parser.parse_saml_response(
+                q.content, cas_plugin.ATTRIBUTE_MAP)
+        except etree.XMLSyntaxError as e:
+            result = parser.ValidationResult(None, {}, str(e))
+        failure = result.failure
+        data_dict = result.attributes
 
         if failure:
             # Validation failed - ABORT
@@ -139,7 +168,7 @@ def cas_saml_callback(**kwargs):
         username = _authenticate_user(
             username, email, fullname, sysadmin)
 
-        insert_entry(ticket, username)
+        upsert_entry(ticket, username)
         if 'user/login' not in next_url:
             return redirect(next_url)
         return redirect(t.h.url_for('dashboard.index', id=username))
@@ -156,8 +185,6 @@ def _authenticate_user(username, email, fullname, is_superuser=False):
     g.user = None
     g.userobj = None
 
-    user = m.User.get(username)
-
     cas_plugin = p.get_plugin('cas')
 
     if is_superuser and is_superuser == cas_plugin.CAS_ADMIN_PROPERTY:
@@ -168,6 +195,10 @@ def _authenticate_user(username, email, fullname, is_superuser=False):
         abort(
             403, 'Solo se pueden autenticar los usuarios pertenecientes al equipo de OpenData')
 
+    attributes_hash = get_attributes_hash(
+        username, email, fullname, is_superuser)
+    user = m.User.get(username)
+
     resp = h.redirect_to(u'user.me')
 
     if user is None:
@@ -189,27 +220,31 @@ def _authenticate_user(username, email, fullname, is_superuser=False):
                     {'ignore_auth': True}, user_obj)
             except Exception as e:
                 log.error(e)
+        set_user_hash(user_obj['name'], attributes_hash)
         set_repoze_user(user_obj['name'], resp)
-        delete_user_entry(user_obj['name'])
         return user_obj['name']
     else:
-        if user.name != username \
-                or user.email != email \
-                or user.fullname != fullname \
-                or user.sysadmin != is_superuser:
-            try:
-                user_obj = {'id': user.id,
-                            'email': email,
-                            'fullname': fullname,
-                            'sysadmin': is_superuser}
-                l.get_action('user_update')(
-                    {'ignore_auth': True}, user_obj)
-            except Exception as e:
-                log.error(e)
-                abort(500, str(e))
+        # The sysadmin flag is always checked so that it cannot drift from
+        # the CAS groups, the rest only when the CAS attributes changed
+        if user.sysadmin != is_superuser or \
+                get_user_hash(user.name) != attributes_hash:
+            if user.name != username \
+                    or user.email != email \
+                    or user.fullname != fullname \
+                    or user.sysadmin != is_superuser:
+                try:
+                    user_obj = {'id': user.id,
+                                'email': email,
+                                'fullname': fullname,
+                                'sysadmin': is_superuser}
+                    l.get_action('user_update')(
+                        {'ignore_auth': True}, user_obj)
+                except Exception as e:
+                    log.error(e)
+                    abort(500, str(e))
+            set_user_hash(user.name, attributes_hash)
 
         set_repoze_user(user.name, resp)
-        delete_user_entry(user.name)
         session['user'] = user.name
         return session.get('user')
 
@@ -228,38 +263,18 @@ def cas_callback(**kwargs):
             return redirect(cas_plugin.CAS_APP_URL)
 
         # log.debug('Validating ticket: {0}'.format(ticket))
-        q = rq.get(cas_plugin.SERVICE_VALIDATION_URL,
-                   params={cas_plugin.TICKET_KEY: ticket,
-                           cas_plugin.SERVICE_KEY: cas_plugin.CAS_APP_URL + '/cas/callback'}, verify=cas_plugin.VERIFY_CERTIFICATE)
-        log.debug(b'' + q.content)
-        root = objectify.fromstring(b'' + q.content)
-        isMemberOf = None
-        if hasattr(root.authenticationSuccess.attributes, 'isMemberOf'):
-            log.debug('Cantidad de isMemberOf :')
-            log.debug(
-                len(list(root.authenticationSuccess.attributes.isMemberOf)))
-            log.debug(list(root.authenticationSuccess.attributes.isMemberOf))
-            isMemberOfList = list(
-                root.authenticationSuccess.attributes.isMemberOf)
-            for attr in isMemberOfList:
-                log.debug(attr)
-                if (attr.text.find(cas_plugin.CAS_BASE_PROPERTY) != -1):
-                    isMemberOf = attr
-                    print(('Set up isMemberOf', isMemberOf))
-                    log.debug('Valor de isMemberOf :')
-                    log.debug(isMemberOf)
-        log.debug(type(b'' + q.content))
         try:
-            if hasattr(root.authenticationSuccess, 'user'):
-                username = root.authenticationSuccess.user
-                success = True
-        except AttributeError:
-            success, username = False, None
-
+            q = client.get(cas_plugin.SERVICE_VALIDATION_URL,
+                           params={cas_plugin.TICKET_KEY: ticket,
+                                   cas_plugin.SERVICE_KEY: cas_plugin.CAS_APP_URL + '/cas/callback'}, verify=cas_plugin.VERIFY_CERTIFICATE)
+        except rq.exceptions.RequestException as e:
+            return _validation_unavailable(cas_plugin, ticket, e)
         try:
-            failure = root.authenticationFailure
-        except AttributeError:
-            failure = False
+            result = parser.parse_service_response(
+                q.content, cas_plugin.ATTRIBUTE_MAP)
+        except etree.XMLSyntaxError as e:
+            result = parser.ValidationResult(None, {}, str(e))
+        failure = result.failure or not result.user
 
         if failure:
             # Validation failed - ABORT
@@ -273,26 +288,13 @@ def cas_callback(**kwargs):
             abort(401, msg)
 
         log.debug('Validation of ticket {0} succedded. Authenticated user: {1}'.format(
-            ticket, username.text))
-        attrs = root.authenticationSuccess.attributes.__dict__
-
-        if isMemberOf is not None:
-            attrs.update(isMemberOf=isMemberOf)
-        log.debug('Validated with attrs')
-        log.debug(attrs)
-        data_dict = {}
-        for key, val in list(cas_plugin.USER_ATTR_MAP.items()):
-            if type(val) == list:
-                data_dict[key] = ' '.join([attrs.get(x).text for x in val])
-            else:
-                log.debug(
-                    '-->Obteniendo el parámetro [{0}] con clave [{1}]'.format(key, val))
-                if attrs.get(val) is not None:
-                    data_dict[key] = attrs.get(val).text
+            ticket, result.user))
+        data_dict = result.attributes
+        log.debug('Validated with attrs: {0}'.format(data_dict))
 
         fullname = data_dict['fullname']
         email = data_dict['email']
-        username = str(root.authenticationSuccess.user)
+        username = result.user
         sysadmin = False
 
         sysadmin_check = data_dict.get('sysadmin')
@@ -308,7 +310,7 @@ def cas_callback(**kwargs):
 
         username = _authenticate_user(
             username, email, fullname, sysadmin)
-        insert_entry(ticket, username)
+        upsert_entry(ticket, username)
         if 'user/login' not in next_url:
             log.debug('(NEXT_URL) REDIRECTING TO ' + next_url)
             return redirect(next_url)
@@ -327,8 +329,9 @@ cas = Blueprint('cas', __name__)
 
 
 rules = [
-    ('/cas/callback', 'cas_callback', cas_callback),
-    ('/cas/saml_callback', 'cas_saml_callback', cas_saml_callback),
+    ('/cas/callback', 'cas_callback', _limit_validations(cas_callback)),
+    ('/cas/saml_callback', 'cas_saml_callback',
+     _limit_validations(cas_saml_callback)),
     ('/cas/logout', 'cas_logout', cas_logout),
 ]
 
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -
+import json
+import logging
+
+import click
+
+import ckan.plugins.toolkit as t
+
+from ckanext.cas import db
+
+
+log = logging.getLogger(__name__)
+
+
+def get_commands():
+    return [cas]
+
+
+@click.group()
+def cas():
+    '''CAS login commands'''
+    pass
+
+
+@cas.command('migrate')
+def migrate():
+    '''Creates or upgrades the CAS tables'''
+    previous = db.migrate()
+    if previous == db.SCHEMA_VERSION:
+        click.echo('CAS schema already at version {0}'.format(previous))
+    else:
+        click.echo('CAS schema migrated from version {0} to {1}'.format(
+            previous, db.SCHEMA_VERSION))
+
+
+@cas.command('purge-tickets')
+@click.option('--max-age', type=int, default=None,
+              help='Seconds a login entry is kept '
+                   '(default: ckanext.cas.ticket_lifetime)')
+@click.option('--batch-size', type=int, default=1000,
+              help='Rows deleted per transaction')
+@click.option('--enqueue', is_flag=True,
+              help='Run the purge on a background job worker')
+def purge_tickets(max_age, batch_size, enqueue):
+    '''Deletes the expired entries of the ckanext_cas_login table'''
+    if enqueue:
+        job = t.enqueue_job(db.purge_expired_entries,
+                            kwargs={'max_age': max_age,
+                                    'batch_size': batch_size},
+                            title='Purge expired CAS tickets')
+        click.echo('Enqueued job {0}'.format(job.id))
+        return
+    deleted = db.purge_expired_entries(max_age=max_age, batch_size=batch_size)
+    click.echo('Deleted {0} expired CAS login entries'.format(deleted))
+
+
+@cas.command('benchmark-identify')
+@click.option('--iterations', type=int, default=10000,
+              help='Requests timed per scenario')
+@click.option('--json', 'as_json', is_flag=True, help='Print the results as JSON')
+@click.pass_context
+def benchmark_identify(ctx, iterations, as_json):
+    '''Measures the overhead of identify per kind of request'''
+    import ckan.plugins as p
+    from ckanext.cas import benchmark
+
+    flask_app = ctx.obj.app.apps['flask_app']._wsgi_app
+    site_user = t.get_action('get_site_user')({'ignore_auth': True}, {})
+    results = benchmark.benchmark_identify(
+        flask_app, p.get_plugin('cas'), site_user['name'], iterations)
+    if as_json:
+        click.echo(json.dumps(results, indent=2))
+    else:
+        click.echo(benchmark.format_results(results))
+
+
+@cas.command('benchmark-parser')
+@click.option('--groups', type=int, multiple=True,
+              help='isMemberOf values per response, can be repeated '
+                   '(default: 10, 100 and 1000)')
+@click.option('--iterations', type=int, default=1000,
+              help='Responses parsed per scenario')
+@click.option('--json', 'as_json', is_flag=True, help='Print the results as JSON')
+def benchmark_parser(groups, iterations, as_json):
+    '''Measures the validation response parsers on large attribute payloads'''
+    import ckan.plugins as p
+    from ckanext.cas import benchmark
+
+    results = benchmark.benchmark_parser(
+        p.get_plugin('cas').ATTRIBUTE_MAP, groups or (10, 100, 1000), iterations)
+    if as_json:
+        click.echo(json.dumps(results, indent=2))
+    else:
+        click.echo(benchmark.format_results(results))
+
+
+@cas.command('load-test')
+@click.option('--users', type=int, default=10, help='Concurrent virtual users')
+@click.option('--rounds', type=int, default=5,
+              help='Login, page views and logout cycles per user')
+@click.option('--pages', type=int, default=5, help='Page views per login')
+@click.option('--path', 'paths', multiple=True,
+              help='Page viewed while logged in, can be repeated '
+                   '(default: /dataset)')
+@click.option('--latency', type=float, default=0.05,
+              help='Seconds the mock CAS server takes per validation')
+@click.option('--groups', type=int, default=100,
+              help='isMemberOf values sent by the mock CAS server')
+@click.option('--json', 'as_json', is_flag=True, help='Print the report as JSON')
+@click.pass_context
+def load_test(ctx, users, rounds, pages, paths, latency, groups, as_json):
+    '''
+    Drives concurrent logins, page views and logouts against a mock CAS
+    server. Creates users, run it only against a disposable database.
+    '''
+    import ckan.model as model
+    import ckan.plugins as p
+    from ckanext.cas import loadtest
+
+    test = loadtest.LoadTest(ctx.obj.app, p.get_plugin('cas'),
+                             model.meta.engine, users=users, rounds=rounds,
+                             pages=pages, paths=paths or ('/dataset',),
+                             latency=latency, groups=groups)
+    report = test.run()
+    if as_json:
+        click.echo(json.dumps(report, indent=2))
+    else:
+        click.echo(loadtest.format_report(report))
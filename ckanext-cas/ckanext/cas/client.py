@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -
+import logging
+import threading
+
+import requests as rq
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import ckan.plugins.toolkit as t
+
+log = logging.getLogger(__name__)
+
+_session = None
+_timeout = (5.0, 10.0)
+_lock = threading.Lock()
+
+
+def configure(config_):
+    '''
+    Builds the pooled HTTP session used to talk to the CAS server from the
+    ``ckanext.cas.http_*`` settings.
+
+    Only connection errors are retried: a validation request that reached the
+    server may already have consumed the single-use ticket.
+    '''
+    global _session, _timeout
+
+    pool_size = t.asint(config_.get('ckanext.cas.http_pool_size', 15))
+    retries = t.asint(config_.get('ckanext.cas.http_retries', 2))
+    backoff_factor = float(config_.get('ckanext.cas.http_backoff_factor', 0.3))
+    _timeout = (float(config_.get('ckanext.cas.http_connect_timeout', 5)),
+                float(config_.get('ckanext.cas.http_read_timeout', 10)))
+
+    retry = Retry(total=retries, connect=retries, read=0, status=0,
+                  redirect=0, backoff_factor=backoff_factor)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                          max_retries=retry, pool_block=False)
+    session = rq.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    with _lock:
+        if _session is not None:
+            _session.close()
+        _session = session
+    log.debug('CAS HTTP pool configured: size %d, timeouts %r, retries %d',
+              pool_size, _timeout, retries)
+
+
+def get_session():
+    if _session is None:
+        configure({})
+    return _session
+
+
+def get(url, **kwargs):
+    kwargs.setdefault('timeout', _timeout)
+    return get_session().get(url, **kwargs)
+
+
+def post(url, **kwargs):
+    kwargs.setdefault('timeout', _timeout)
+    return get_session().post(url, **kwargs)
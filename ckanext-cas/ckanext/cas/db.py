@@ -1,43 +1,176 @@
+import abc
+import json
+import time
+import hashlib
 import logging
 import datetime
+import threading
+import sqlalchemy
 import sqlalchemy.exc
 import ckan.plugins.toolkit as t
 
 from ckan.model import domain_object
 from ckan.model.meta import Session, metadata, mapper
-from sqlalchemy.engine.reflection import Inspector
-from sqlalchemy.exc import NoSuchTableError
-from sqlalchemy import types, Column, Table, ForeignKey, func, CheckConstraint, UniqueConstraint, Index
+from sqlalchemy import types, Column, Table, ForeignKey, func, CheckConstraint, UniqueConstraint, Index, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
 log = logging.getLogger(__name__)
 
 cas_table = None
+cas_user_table = None
+
+# Seconds a login entry is kept before it is purged (one day)
+DEFAULT_TICKET_LIFETIME = 86400
+
+
+class TicketCache(object):
+    '''
+    Per-process cache of the users known to hold a valid CAS ticket.
+
+    Only positive results are cached, for `ttl` seconds, so a fresh login
+    served by another process is never rejected from a stale entry. Entries
+    are tagged with the revocation generation of the ticket store they were
+    read with: every logout or single sign out, in any process, moves the
+    shared generation on, and the next check of each process drops its
+    cached entries.
+    '''
+
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self._entries = {}
+        self._generation = None
+        self._lock = threading.Lock()
+
+    def get(self, user, generation=None):
+        if generation != self._generation:
+            with self._lock:
+                self._entries.clear()
+                self._generation = generation
+            return False
+        entry = self._entries.get(user)
+        if entry is None:
+            return False
+        ticket_id, expires = entry
+        if expires < time.time():
+            self._entries.pop(user, None)
+            return False
+        return True
+
+    def set(self, user, ticket_id, generation=None):
+        # An entry read before the latest revocation is not cached
+        if self.ttl > 0 and generation == self._generation:
+            self._entries[user] = (ticket_id, time.time() + self.ttl)
+
+    def invalidate_user(self, user):
+        self._entries.pop(user, None)
+
+    def invalidate_ticket(self, ticket_id):
+        with self._lock:
+            for user, (cached_ticket_id, _) in list(self._entries.items()):
+                if cached_ticket_id == ticket_id:
+                    self._entries.pop(user, None)
+
+    def clear(self):
+        self._entries.clear()
+
+
+ticket_cache = TicketCache()
 
 
 def setup():
+    '''
+    Defines the CAS tables in memory. The database schema is checked the
+    first time a process uses it, see `ensure_schema`.
+    '''
     if cas_table is None:
         define_cas_tables()
         log.debug('CAS table(s) defined in memory')
 
-        if not cas_table.exists():
-            cas_table.create()
 
-    else:
-        log.debug('CAS table(s) already exist')
-        from ckan.model.meta import engine
-        inspector = Inspector.from_engine(engine)
+def _migration_1(connection):
+    cas_table.create(bind=connection, checkfirst=True)
+    connection.execute('CREATE INDEX IF NOT EXISTS ckanext_cas_login_ticket_id_idx '
+                       'ON ckanext_cas_login (ticket_id)')
 
-        try:
-            inspector.get_indexes("ckanext_cas_login")
-        except NoSuchTableError:
-            cas_table.create()
 
-        index_names = [index['name']
-                       for index in inspector.get_indexes("ckanext_cas_login")]
-        if "ckanext_cas_login_ticket_id_idx" not in index_names:
-            log.debug('Creating index for ckanext_cas_login')
-            Index("ckanext_cas_login_ticket_id_idx",
-                  cas_table.c.ticket_id).create()
+def _migration_2(connection):
+    connection.execute('CREATE INDEX IF NOT EXISTS ckanext_cas_login_timestamp_idx '
+                       'ON ckanext_cas_login (timestamp)')
+    cas_user_table.create(bind=connection, checkfirst=True)
+
+
+def _migration_3(connection):
+    connection.execute('CREATE SEQUENCE IF NOT EXISTS ckanext_cas_revocation_seq')
+
+
+# Schema version N is reached by running the first N migrations, they must
+# be idempotent as they may run on tables created before versioning
+MIGRATIONS = [_migration_1, _migration_2, _migration_3]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+
+def schema_version():
+    '''Returns the version of the CAS schema in the database, 0 if missing'''
+    from ckan.model.meta import engine
+    try:
+        return engine.execute(
+            'SELECT max(version) FROM ckanext_cas_schema').scalar() or 0
+    except sqlalchemy.exc.ProgrammingError:
+        return 0
+
+
+def migrate():
+    '''
+    Brings the CAS schema up to `SCHEMA_VERSION` and returns the version the
+    database was at. Concurrent runs are serialised with an advisory lock.
+    '''
+    from ckan.model.meta import engine
+    setup()
+    with engine.begin() as connection:
+        connection.execute(
+            sqlalchemy.text('SELECT pg_advisory_xact_lock(hashtext(:key))'),
+            key='ckanext_cas_schema')
+        connection.execute('CREATE TABLE IF NOT EXISTS ckanext_cas_schema '
+                           '(version integer NOT NULL)')
+        version = connection.execute(
+            'SELECT max(version) FROM ckanext_cas_schema').scalar() or 0
+        for number, migration in enumerate(MIGRATIONS, 1):
+            if number > version:
+                log.info('Migrating CAS schema to version %d', number)
+                migration(connection)
+        if version < SCHEMA_VERSION:
+            connection.execute('DELETE FROM ckanext_cas_schema')
+            connection.execute(
+                sqlalchemy.text('INSERT INTO ckanext_cas_schema (version) '
+                                'VALUES (:version)'),
+                version=SCHEMA_VERSION)
+    return version
+
+
+def ensure_schema():
+    '''
+    Checks once per process, with a single query, that the CAS schema is up
+    to date. Outdated schemas are migrated unless
+    ``ckanext.cas.auto_migrate`` is false, in which case ``ckan cas
+    migrate`` has to be run.
+    '''
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if _schema_ready:
+            return
+        setup()
+        if schema_version() < SCHEMA_VERSION:
+            if t.asbool(t.config.get('ckanext.cas.auto_migrate', True)):
+                migrate()
+            else:
+                raise RuntimeError(
+                    'The CAS schema is outdated, run "ckan cas migrate"')
+        _schema_ready = True
 
 
 class CasUser(domain_object.DomainObject):
@@ -66,8 +199,20 @@ def define_cas_tables():
                       Column('user', types.UnicodeText, default='',
                              nullable=False, unique=True),
                       Column('timestamp', types.DateTime,
-                             default=datetime.datetime.utcnow(), nullable=False),
-                      Index('ckanext_cas_login_ticket_id_idx', 'ticket_id'))
+                             default=datetime.datetime.utcnow, nullable=False),
+                      Index('ckanext_cas_login_ticket_id_idx', 'ticket_id'),
+                      Index('ckanext_cas_login_timestamp_idx', 'timestamp'))
+
+    global cas_user_table
+    cas_user_table = Table('ckanext_cas_user', metadata,
+                           Column('user', types.UnicodeText,
+                                  primary_key=True, nullable=False),
+                           Column('attributes_hash', types.UnicodeText,
+                                  nullable=False),
+                           Column('synced', types.DateTime,
+                                  default=datetime.datetime.utcnow,
+                                  onupdate=datetime.datetime.utcnow,
+                                  nullable=False))
 
     mapper(
         CasUser,
@@ -75,37 +220,394 @@ def define_cas_tables():
     )
 
 
+class TicketStore(abc.ABC):
+    '''
+    Interface of the stores keeping the current CAS ticket of each logged in
+    user. Entries older than `ttl` seconds are expired by the store, a `ttl`
+    of 0 keeps them until they are deleted.
+    '''
+
+    def __init__(self, ttl=DEFAULT_TICKET_LIFETIME):
+        self.ttl = ttl
+
+    def get_ticket(self, user):
+        return self.get_many([user]).get(user)
+
+    @abc.abstractmethod
+    def get_many(self, users):
+        '''Returns a dict with the current ticket of the given users'''
+
+    def set_ticket(self, user, ticket_id):
+        self.set_many({user: ticket_id})
+
+    @abc.abstractmethod
+    def set_many(self, tickets):
+        '''Stores the tickets of a dict of users, replacing their previous ones'''
+
+    @abc.abstractmethod
+    def delete_users(self, users):
+        '''Deletes the tickets of the given users'''
+
+    @abc.abstractmethod
+    def delete_tickets(self, ticket_ids):
+        '''Deletes the given tickets, whichever user holds them'''
+
+    @abc.abstractmethod
+    def generation(self):
+        '''
+        Returns the revocation generation, shared by every process using the
+        store, which deleting users or tickets moves on
+        '''
+
+    def purge_expired(self, max_age=None, batch_size=1000, max_batches=None):
+        '''Deletes the expired entries and returns how many were removed'''
+        return 0
+
+
+class SQLTicketStore(TicketStore):
+    '''
+    Stores the tickets in the ``ckanext_cas_login`` table, shared by every
+    process using the database. Expired entries are ignored on reads and
+    deleted by `purge_expired`.
+    '''
+
+    def _cutoff(self, max_age=None):
+        max_age = self.ttl if max_age is None else max_age
+        if max_age:
+            return datetime.datetime.utcnow() - \
+                datetime.timedelta(seconds=max_age)
+
+    def _execute(self, statement):
+        try:
+            result = Session.execute(statement)
+            Session.commit()
+        except Exception:
+            Session.rollback()
+            raise
+        return result
+
+    def get_many(self, users):
+        users = list(users)
+        if not users:
+            return {}
+        query = select([cas_table.c.user, cas_table.c.ticket_id]) \
+            .where(cas_table.c.user.in_(users))
+        cutoff = self._cutoff()
+        if cutoff is not None:
+            query = query.where(cas_table.c.timestamp >= cutoff)
+        return dict(Session.execute(query).fetchall())
+
+    def set_many(self, tickets):
+        if not tickets:
+            return
+        now = datetime.datetime.utcnow()
+        statement = pg_insert(cas_table).values(
+            [{'ticket_id': ticket_id, 'user': user, 'timestamp': now}
+             for user, ticket_id in tickets.items()])
+        statement = statement.on_conflict_do_update(
+            index_elements=[cas_table.c.user],
+            set_={'ticket_id': statement.excluded.ticket_id,
+                  'timestamp': statement.excluded.timestamp})
+        self._execute(statement)
+
+    def delete_users(self, users):
+        users = list(users)
+        if users:
+            self._execute(cas_table.delete().where(cas_table.c.user.in_(users)))
+            self._revoke()
+
+    def delete_tickets(self, ticket_ids):
+        ticket_ids = list(ticket_ids)
+        if ticket_ids:
+            self._execute(cas_table.delete().where(
+                cas_table.c.ticket_id.in_(ticket_ids)))
+            self._revoke()
+
+    def _revoke(self):
+        # After the deletion is committed, so a process seeing the new
+        # generation can no longer read the deleted entries
+        self._execute(sqlalchemy.text(
+            "SELECT nextval('ckanext_cas_revocation_seq')"))
+
+    def generation(self):
+        return Session.execute(
+            'SELECT last_value FROM ckanext_cas_revocation_seq').scalar()
+
+    def purge_expired(self, max_age=None, batch_size=1000, max_batches=None):
+        '''
+        Rows are deleted `batch_size` at a time, each batch in its own short
+        transaction. Rows locked by a concurrent login are skipped and picked
+        up by the next run, so the purge never waits on the web processes.
+        '''
+        cutoff = self._cutoff(max_age)
+        if cutoff is None:
+            return 0
+
+        expired = select([cas_table.c.ticket_id]) \
+            .where(cas_table.c.timestamp < cutoff) \
+            .limit(batch_size) \
+            .with_for_update(skip_locked=True)
+        statement = cas_table.delete().where(cas_table.c.ticket_id.in_(expired))
+
+        deleted = batches = 0
+        while max_batches is None or batches < max_batches:
+            count = self._execute(statement).rowcount
+            batches += 1
+            deleted += count
+            if count < batch_size:
+                break
+        log.info('Purged %d CAS login entries older than %s', deleted, cutoff)
+        return deleted
+
+
+class MemoryTicketStore(TicketStore):
+    '''
+    Keeps the tickets in the memory of the process. Only suitable for
+    deployments running a single CKAN process, e.g. development servers.
+    '''
+
+    def __init__(self, ttl=DEFAULT_TICKET_LIFETIME):
+        super(MemoryTicketStore, self).__init__(ttl)
+        self._tickets = {}
+        self._users = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _expired(self, expires):
+        return expires is not None and expires < time.time()
+
+    def get_many(self, users):
+        tickets = {}
+        for user in users:
+            entry = self._tickets.get(user)
+            if entry is not None and not self._expired(entry[1]):
+                tickets[user] = entry[0]
+        return tickets
+
+    def set_many(self, tickets):
+        expires = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            for user, ticket_id in tickets.items():
+                previous = self._tickets.get(user)
+                if previous is not None:
+                    self._users.pop(previous[0], None)
+                self._tickets[user] = (ticket_id, expires)
+                self._users[ticket_id] = user
+
+    def delete_users(self, users):
+        with self._lock:
+            for user in users:
+                entry = self._tickets.pop(user, None)
+                if entry is not None:
+                    self._users.pop(entry[0], None)
+            self._generation += 1
+
+    def delete_tickets(self, ticket_ids):
+        with self._lock:
+            for ticket_id in ticket_ids:
+                user = self._users.pop(ticket_id, None)
+                if user is not None:
+                    self._tickets.pop(user, None)
+            self._generation += 1
+
+    def generation(self):
+        return self._generation
+
+    def purge_expired(self, max_age=None, batch_size=1000, max_batches=None):
+        with self._lock:
+            expired = [user for user, (_, expires) in self._tickets.items()
+                       if self._expired(expires)]
+        self.delete_users(expired)
+        return len(expired)
+
+
+class RedisTicketStore(TicketStore):
+    '''
+    Keeps the tickets in the Redis server CKAN already uses for its job
+    queues (``ckan.redis.url``), so every process and web node shares them
+    without querying Postgres. Entries expire through Redis key TTLs.
+    '''
+    prefix = 'ckanext-cas:'
+
+    def __init__(self, ttl=DEFAULT_TICKET_LIFETIME, connection=None):
+        super(RedisTicketStore, self).__init__(ttl)
+        if connection is None:
+            from ckan.lib.redis import connect_to_redis
+            connection = connect_to_redis()
+        self.redis = connection
+
+    def _user_key(self, user):
+        return '{0}user:{1}'.format(self.prefix, user)
+
+    def _generation_key(self):
+        return '{0}generation'.format(self.prefix)
+
+    def _delete(self, keys):
+        # In one transaction with the deletion, so a process seeing the new
+        # generation can no longer read the deleted entries
+        pipeline = self.redis.pipeline()
+        pipeline.delete(*keys)
+        pipeline.incr(self._generation_key())
+        pipeline.execute()
+
+    def generation(self):
+        return self._decode(self.redis.get(self._generation_key()))
+
+    def _ticket_key(self, ticket_id):
+        return '{0}ticket:{1}'.format(self.prefix, ticket_id)
+
+    @staticmethod
+    def _decode(value):
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+
+    def get_many(self, users):
+        users = list(users)
+        if not users:
+            return {}
+        values = self.redis.mget([self._user_key(user) for user in users])
+        return {user: self._decode(value)
+                for user, value in zip(users, values) if value is not None}
+
+    def set_many(self, tickets):
+        if not tickets:
+            return
+        previous = self.get_many(tickets.keys())
+        pipeline = self.redis.pipeline()
+        for user, ticket_id in tickets.items():
+            if user in previous and previous[user] != ticket_id:
+                pipeline.delete(self._ticket_key(previous[user]))
+            pipeline.set(self._user_key(user), ticket_id, ex=self.ttl or None)
+            pipeline.set(self._ticket_key(ticket_id), user, ex=self.ttl or None)
+        pipeline.execute()
+
+    def delete_users(self, users):
+        users = list(users)
+        if not users:
+            return
+        tickets = self.get_many(users)
+        keys = [self._user_key(user) for user in users] + \
+            [self._ticket_key(ticket_id) for ticket_id in tickets.values()]
+        self._delete(keys)
+
+    def delete_tickets(self, ticket_ids):
+        ticket_ids = list(ticket_ids)
+        if not ticket_ids:
+            return
+        users = self.redis.mget([self._ticket_key(ticket_id)
+                                 for ticket_id in ticket_ids])
+        users = [self._decode(user) for user in users if user is not None]
+        # Only drop the user entries still pointing to the deleted tickets
+        current = self.get_many(users)
+        keys = [self._ticket_key(ticket_id) for ticket_id in ticket_ids] + \
+            [self._user_key(user) for user, ticket_id in current.items()
+             if ticket_id in ticket_ids]
+        self._delete(keys)
+
+
+TICKET_STORES = {
+    'sql': SQLTicketStore,
+    'memory': MemoryTicketStore,
+    'redis': RedisTicketStore,
+}
+
+ticket_store = None
+
+
+def configure_ticket_store(name='sql', ttl=DEFAULT_TICKET_LIFETIME):
+    global ticket_store
+    if name not in TICKET_STORES:
+        raise RuntimeError(
+            'Unknown CAS ticket store "{0}", use one of: {1}'.format(
+                name, ', '.join(sorted(TICKET_STORES))))
+    ticket_store = TICKET_STORES[name](ttl)
+    ticket_cache.clear()
+    return ticket_store
+
+
+def get_ticket_store():
+    ensure_schema()
+    if ticket_store is None:
+        configure_ticket_store(ttl=t.asint(t.config.get(
+            'ckanext.cas.ticket_lifetime', DEFAULT_TICKET_LIFETIME)))
+    return ticket_store
+
+
 def insert_entry(ticket_id, user=None):
+    if user is None:
+        user = t.c.user
+    return upsert_entry(ticket_id, user)
+
+
+def upsert_entry(ticket_id, user):
+    '''
+    Stores `ticket_id` as the current ticket of `user`, replacing the
+    previous one
+    '''
+    # Cached by the next check, with the generation it reads
+    ticket_cache.invalidate_user(user)
     try:
-        if user is None:
-            user = t.c.user
-        cas_user = CasUser(ticket_id, user)
-        cas_user.save()
-        return True
-    except sqlalchemy.exc.IntegrityError as exc:
-        reason = exc.message
-        log.error(reason)
-        if reason.endswith('is not unique'):
-            log.error('{0} already exists', exc.params[0])
-        Session.rollback()
-        return False
-    except Exception:
-        Session.rollback()
+        get_ticket_store().set_ticket(user, ticket_id)
+    except Exception as e:
+        log.error(e)
         return False
+    return True
+
+
+def get_attributes_hash(*values):
+    return hashlib.sha1(json.dumps(values).encode('utf-8')).hexdigest()
+
+
+def get_user_hash(user):
+    '''Returns the hash of the CAS attributes last synced for `user`'''
+    ensure_schema()
+    return Session.execute(
+        select([cas_user_table.c.attributes_hash])
+        .where(cas_user_table.c.user == user)).scalar()
+
+
+def set_user_hash(user, attributes_hash):
+    ensure_schema()
+    statement = pg_insert(cas_user_table).values(
+        user=user, attributes_hash=attributes_hash,
+        synced=datetime.datetime.utcnow())
+    statement = statement.on_conflict_do_update(
+        index_elements=[cas_user_table.c.user],
+        set_={'attributes_hash': statement.excluded.attributes_hash,
+              'synced': statement.excluded.synced})
+    Session.execute(statement)
+    Session.commit()
 
 
 def delete_entry(ticket_id):
-    cas_table.delete(CasUser.ticket_id == ticket_id).execute()
+    ticket_cache.invalidate_ticket(ticket_id)
+    get_ticket_store().delete_tickets([ticket_id])
 
 
 def delete_user_entry(user):
-    cas_table.delete(CasUser.user == user).execute()
+    ticket_cache.invalidate_user(user)
+    get_ticket_store().delete_users([user])
 
 
 def is_ticket_valid(user):
-    search = {'user': user}
-    results = CasUser.get(**search)
-    log.info(results)
-    if len(results) == 1:
+    if not user:
+        return False
+    store = get_ticket_store()
+    # Read before the ticket, so that a revocation in between is seen by the
+    # next check
+    generation = store.generation() if ticket_cache.ttl > 0 else None
+    if ticket_cache.get(user, generation):
+        return True
+    ticket_id = store.get_ticket(user)
+    if ticket_id:
+        ticket_cache.set(user, ticket_id, generation)
         return True
     return False
+
+
+def purge_expired_entries(max_age=None, batch_size=1000, max_batches=None):
+    '''
+    Deletes the login entries older than `max_age` seconds (by default
+    ``ckanext.cas.ticket_lifetime``) and returns how many were removed.
+    Stores expiring their entries natively have nothing to purge.
+    '''
+    return get_ticket_store().purge_expired(max_age, batch_size, max_batches)
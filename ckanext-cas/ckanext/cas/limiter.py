@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class LoginLimiter(object):
+    '''
+    Caps the number of ticket validations a process runs at once.
+
+    When all the `limit` slots are taken, up to `max_waiting` logins wait
+    for one to free up, for at most `timeout` seconds each, and any other
+    login is turned away at once. A burst of logins can therefore only take
+    `limit + max_waiting` of the WSGI threads of the process and the rest
+    keep serving the catalogue. A `limit` of 0 disables the cap.
+    '''
+
+    def __init__(self, limit=10, timeout=5, max_waiting=10):
+        self.configure(limit, timeout, max_waiting)
+
+    def configure(self, limit, timeout, max_waiting=10):
+        self.limit = limit
+        self.timeout = timeout
+        self.max_waiting = max_waiting
+        self.waiting = 0
+        self._slots = threading.BoundedSemaphore(limit) if limit > 0 else None
+        self._lock = threading.Lock()
+
+    def _wait(self):
+        with self._lock:
+            if self.waiting >= self.max_waiting:
+                return False
+            self.waiting += 1
+        try:
+            return self._slots.acquire(timeout=self.timeout)
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+    def acquire(self):
+        if self._slots is None:
+            return True
+        if self._slots.acquire(blocking=False) or self._wait():
+            return True
+        log.warning('Rejecting login, %d ticket validations already running',
+                    self.limit)
+        return False
+
+    def release(self):
+        if self._slots is not None:
+            self._slots.release()
+
+
+login_limiter = LoginLimiter()
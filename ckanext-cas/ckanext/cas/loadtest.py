@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -
+import time
+import logging
+import threading
+from collections import defaultdict
+
+from ckanext.cas.benchmark import percentile
+
+log = logging.getLogger(__name__)
+
+STEPS = ['login', 'page', 'logout']
+
+# CKAN user fields filled from the mapped CAS attributes
+USER_FIELDS = {'user': 'username', 'email': 'email', 'fullname': 'fullname'}
+
+
+class ThreadQueryCounter(object):
+    '''Counts the SQL statements each thread executes on an engine'''
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._local = threading.local()
+
+    def _before_cursor_execute(self, *args, **kwargs):
+        self._local.count = getattr(self._local, 'count', 0) + 1
+
+    @property
+    def count(self):
+        return getattr(self._local, 'count', 0)
+
+    def attach(self):
+        from sqlalchemy import event
+        event.listen(self.engine, 'before_cursor_execute',
+                     self._before_cursor_execute)
+
+    def detach(self):
+        from sqlalchemy import event
+        event.remove(self.engine, 'before_cursor_execute',
+                     self._before_cursor_execute)
+
+
+def _attribute_names(user_attr_map):
+    names = {}
+    for key, val in user_attr_map.items():
+        if key not in USER_FIELDS:
+            continue
+        for index, name in enumerate(val if isinstance(val, list) else [val]):
+            names[name] = USER_FIELDS[key] if index == 0 else None
+    return names
+
+
+class LoadTest(object):
+    '''
+    Drives concurrent CAS logins, authenticated page views and logouts
+    through the full CKAN WSGI stack against the mock CAS server.
+
+    Each of the `users` virtual users runs on its own thread with its own
+    cookie jar and repeats `rounds` times: log in with a fresh ticket, view
+    `pages` times each of `paths`, log out. Users are created in CKAN on
+    their first login, so it must only be run against a disposable database.
+    '''
+
+    def __init__(self, wsgi_app, plugin, engine, users=10, rounds=5, pages=5,
+                 paths=('/dataset',), latency=0.05, groups=100,
+                 user_prefix='loadtest'):
+        self.wsgi_app = wsgi_app
+        self.plugin = plugin
+        self.engine = engine
+        self.users = users
+        self.rounds = rounds
+        self.pages = pages
+        self.paths = list(paths)
+        self.latency = latency
+        self.groups = groups
+        self.user_prefix = user_prefix
+        self._lock = threading.Lock()
+        self._samples = defaultdict(list)
+        self._errors = defaultdict(int)
+
+    def _record(self, step, seconds, queries, status):
+        with self._lock:
+            self._samples[step].append((seconds, queries))
+            if status >= 400:
+                self._errors[step] += 1
+
+    def _request(self, client, counter, step, path):
+        start, queries = time.perf_counter(), counter.count
+        response = client.get(path)
+        status = response.status_code
+        response.close()
+        self._record(step, time.perf_counter() - start,
+                     counter.count - queries, status)
+        return status
+
+    def _virtual_user(self, username, counter, mock):
+        from werkzeug.test import Client
+        from werkzeug.wrappers import Response
+
+        client = Client(self.wsgi_app, Response)
+        if self.plugin.CAS_VERSION == 3:
+            callback = '/cas/saml_callback'
+        else:
+            callback = '/cas/callback'
+        service = self.plugin.CAS_APP_URL + callback
+
+        for _ in range(self.rounds):
+            ticket = mock.issue_ticket(username, service)
+            self._request(client, counter, 'login',
+                          '{0}?{1}={2}'.format(callback,
+                                               self.plugin.TICKET_KEY, ticket))
+            for _ in range(self.pages):
+                for path in self.paths:
+                    self._request(client, counter, 'page', path)
+            self._request(client, counter, 'logout', '/user/_logout')
+
+    def run(self):
+        from ckanext.cas import mockserver
+
+        mock = mockserver.MockCASServer
+        mock.configure(latency=self.latency, groups=self.groups,
+                       base_property=self.plugin.CAS_BASE_PROPERTY,
+                       admin_role=self.plugin.CAS_ADMIN_PROPERTY,
+                       member_role=self.plugin.CAS_MEMBER_PROPERTY,
+                       attributes=_attribute_names(self.plugin.USER_ATTR_MAP))
+        usernames = ['{0}-{1:04d}'.format(self.user_prefix, number)
+                     for number in range(self.users)]
+        for username in usernames:
+            mock.add_user(username, fullname='Load test {0}'.format(username))
+
+        httpd = mockserver.serve(port=0)
+        mock_url = 'http://127.0.0.1:{0}'.format(httpd.server_address[1])
+        saved = (self.plugin.SERVICE_VALIDATION_URL,
+                 self.plugin.SAML_VALIDATION_URL)
+        self.plugin.SERVICE_VALIDATION_URL = mock_url + '/serviceValidate'
+        self.plugin.SAML_VALIDATION_URL = mock_url + '/samlValidate'
+        counter = ThreadQueryCounter(self.engine)
+        counter.attach()
+        try:
+            threads = [threading.Thread(target=self._virtual_user,
+                                        args=(username, counter, mock))
+                       for username in usernames]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+        finally:
+            counter.detach()
+            (self.plugin.SERVICE_VALIDATION_URL,
+             self.plugin.SAML_VALIDATION_URL) = saved
+            httpd.shutdown()
+            httpd.server_close()
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        requests = sum(len(samples) for samples in self._samples.values())
+        report = {'users': self.users,
+                  'rounds': self.rounds,
+                  'cas_latency_ms': self.latency * 1000,
+                  'groups': self.groups,
+                  'seconds': elapsed,
+                  'requests': requests,
+                  'requests_per_second': requests / elapsed if elapsed else None,
+                  'steps': {}}
+        for step in STEPS:
+            samples = self._samples.get(step, [])
+            latencies = [seconds for seconds, _ in samples]
+            queries = [count for _, count in samples]
+            report['steps'][step] = {
+                'requests': len(samples),
+                'errors': self._errors.get(step, 0),
+                'p50_ms': (percentile(latencies, 0.5) or 0) * 1000,
+                'p95_ms': (percentile(latencies, 0.95) or 0) * 1000,
+                'p99_ms': (percentile(latencies, 0.99) or 0) * 1000,
+                'queries_per_request': float(sum(queries)) / len(queries)
+                if queries else None}
+        return report
+
+
+def format_report(report):
+    lines = ['{0} users x {1} rounds, CAS latency {2:.0f} ms, {3} groups: '
+             '{4} requests in {5:.2f} s ({6:.1f} req/s)'.format(
+                 report['users'], report['rounds'], report['cas_latency_ms'],
+                 report['groups'], report['requests'], report['seconds'],
+                 report['requests_per_second'] or 0),
+             '{0:<8} {1:>9} {2:>7} {3:>9} {4:>9} {5:>9} {6:>9}'.format(
+                 'step', 'requests', 'errors', 'p50 ms', 'p95 ms', 'p99 ms',
+                 'queries')]
+    for step in STEPS:
+        totals = report['steps'][step]
+        lines.append('{0:<8} {1:>9} {2:>7} {3:>9.1f} {4:>9.1f} {5:>9.1f} {6:>9.1f}'.format(
+            step, totals['requests'], totals['errors'], totals['p50_ms'],
+            totals['p95_ms'], totals['p99_ms'],
+            totals['queries_per_request'] or 0))
+    return '\n'.join(lines)
@@ -0,0 +1,253 @@
+import re
+import time
+import logging
+import threading
+import http.server
+import socketserver
+
+from uuid import uuid4
+from threading import Thread
+from urllib.parse import urlencode, urlparse, parse_qs
+
+from ckanext.cas import benchmark
+
+PORT = 8899
+
+log = logging.getLogger(__name__)
+
+ARTIFACT_PATTERN = re.compile(
+    rb'<(?:\w+:)?AssertionArtifact[^>]*>\s*([^<\s]+)\s*</')
+
+
+class MockCASServer(http.server.BaseHTTPRequestHandler):
+    '''
+    Local stand-in for a CAS 2.0/SAML 1.1 server.
+
+    ``/login`` issues a service ticket for the user given in the ``username``
+    parameter (or the ``sessionid`` header of a previous login) and
+    redirects to the service, ``/serviceValidate`` and ``/samlValidate``
+    validate single-use tickets and answer with the attributes of the user
+    plus `GROUPS` ``isMemberOf`` values. Every validation waits `LATENCY`
+    seconds to mimic the round trip to a real server.
+    '''
+    SESSION = {}
+    TICKETS = {}
+    LATENCY = 0
+    GROUPS = 10
+    BASE_PROPERTY = 'opendata'
+    ADMIN_ROLE = 'admin'
+    MEMBER_ROLE = 'member'
+    # CAS attribute name -> user field it is filled from
+    ATTRIBUTES = {'username': 'username', 'email': 'email',
+                  'fullname': 'fullname'}
+    _lock = threading.Lock()
+
+    protocol_version = 'HTTP/1.1'
+
+    @classmethod
+    def configure(cls, latency=None, groups=None, base_property=None,
+                  admin_role=None, member_role=None, attributes=None):
+        if latency is not None:
+            cls.LATENCY = latency
+        if groups is not None:
+            cls.GROUPS = groups
+        if base_property is not None:
+            cls.BASE_PROPERTY = base_property
+        if admin_role is not None:
+            cls.ADMIN_ROLE = admin_role
+        if member_role is not None:
+            cls.MEMBER_ROLE = member_role
+        if attributes is not None:
+            cls.ATTRIBUTES = attributes
+
+    @classmethod
+    def add_user(cls, username, fullname=None, email=None, password='1234',
+                 is_superuser=False):
+        USERS[username] = {'username': username,
+                           'fullname': fullname or username,
+                           'email': email or '{0}@local.host'.format(username),
+                           'password': password,
+                           'is_superuser': is_superuser}
+        return USERS[username]
+
+    @classmethod
+    def issue_ticket(cls, username, service):
+        '''Returns a new service ticket of `username` for `service`'''
+        ticket = 'ST-{0}'.format(uuid4().hex)
+        with cls._lock:
+            cls.TICKETS[ticket] = {'user': username, 'service': service,
+                                   'used': False}
+        return ticket
+
+    @classmethod
+    def consume_ticket(cls, ticket, service=None):
+        '''Returns the user of a valid ticket and marks it as used'''
+        with cls._lock:
+            entry = cls.TICKETS.get(ticket)
+            if entry is None or entry['used']:
+                return None
+            if service is not None and entry['service'] != service:
+                return None
+            entry['used'] = True
+        return USERS.get(entry['user'])
+
+    def _attributes(self, user):
+        return {name: user.get(field, '') if field else ''
+                for name, field in self.ATTRIBUTES.items()}
+
+    def _role(self, user):
+        return self.ADMIN_ROLE if user['is_superuser'] else self.MEMBER_ROLE
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        if url.path.endswith('/login'):
+            self._login(params)
+        elif url.path.endswith('/logout'):
+            self._logout(params)
+        elif url.path.endswith('/serviceValidate'):
+            self._service_validate(params)
+        elif url.path.endswith('/validate'):
+            # Validation CAS 1.0
+            time.sleep(self.LATENCY)
+            user = self.consume_ticket(params.get('ticket'), params.get('service'))
+            content = 'yes\n{0}\n'.format(user['username']) if user else 'no\n\n'
+            self.respond(content, content_type='text/plain')
+        else:
+            self.respond('Not found', status=404, content_type='text/plain')
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if url.path.endswith('/samlValidate'):
+            self._saml_validate(body)
+        else:
+            self.respond('Not found', status=404, content_type='text/plain')
+
+    def _login(self, params):
+        sessionid = self.headers.get('sessionid')
+        username = params.get('username') or self.SESSION.get(sessionid)
+        user = USERS.get(username)
+        if user is None or ('password' in params and
+                            params['password'] != user['password']):
+            self.respond('Login required', status=401, content_type='text/plain')
+            return
+
+        sessionid = sessionid if sessionid in self.SESSION else uuid4().hex
+        self.SESSION[sessionid] = user['username']
+        service = params.get('service')
+        if not service:
+            self.respond('Logged in', content_type='text/plain',
+                         headers={'sessionid': sessionid})
+            return
+        ticket = self.issue_ticket(user['username'], service)
+        separator = '&' if '?' in service else '?'
+        self.respond('', status=302, headers={
+            'Location': '{0}{1}{2}'.format(service, separator,
+                                           urlencode({'ticket': ticket})),
+            'sessionid': sessionid})
+
+    def _logout(self, params):
+        self.SESSION.pop(self.headers.get('sessionid'), None)
+        if params.get('service'):
+            self.respond('', status=302, headers={'Location': params['service']})
+        else:
+            self.respond('Logged out', content_type='text/plain')
+
+    def _service_validate(self, params):
+        # Service validation CAS 2.0
+        time.sleep(self.LATENCY)
+        ticket = params.get('ticket')
+        user = self.consume_ticket(ticket, params.get('service'))
+        if user is None:
+            content = benchmark.service_failure(
+                message='Ticket {0} not recognized'.format(ticket))
+        else:
+            content = benchmark.service_response(
+                user['username'], self._attributes(user), max(1, self.GROUPS),
+                self.BASE_PROPERTY, self._role(user))
+        self.respond(content, content_type='application/xml')
+
+    def _saml_validate(self, body):
+        # SAML Validation CAS 3.0
+        time.sleep(self.LATENCY)
+        match = ARTIFACT_PATTERN.search(body)
+        ticket = match.group(1).decode('utf-8') if match else None
+        user = self.consume_ticket(ticket)
+        if user is None:
+            content = benchmark.saml_failure(
+                'Ticket {0} not recognized'.format(ticket))
+        else:
+            # The SAML callback compares the first isMemberOf value with the
+            # admin and member properties as is
+            attributes = self._attributes(user)
+            attributes['isMemberOf'] = self._role(user)
+            content = benchmark.saml_response(
+                attributes, self.GROUPS, self.BASE_PROPERTY, self._role(user))
+        self.respond(content, content_type='text/xml')
+
+    def respond(self, content, status=200, content_type='application/json', headers={}):
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+
+        # Set response status code
+        self.send_response(status)
+
+        # Set response headers
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        if any(headers):
+            for key, val in list(headers.items()):
+                self.send_header(key, val)
+        self.end_headers()
+
+        # Set response content
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+
+class TestServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def serve(port=PORT):
+    '''
+    Starts the mock CAS server on a background thread and returns it, call
+    `shutdown` and `server_close` on it to stop it. Pass port 0 to listen on
+    a free port, available in ``server_address``.
+    '''
+    httpd = TestServer(('127.0.0.1', port), MockCASServer)
+    log.info('Serving test CAS server at port {0}'.format(httpd.server_address[1]))
+    httpd_thread = Thread(target=httpd.serve_forever)
+    httpd_thread.daemon = True
+    httpd_thread.start()
+    return httpd
+
+
+USERS = {
+    'admin': {
+        'username': 'admin',
+        'fullname': 'Admin User',
+        'email': 'admin@local.host',
+        'password': '1234',
+        'is_superuser': True
+    },
+    'test': {
+        'username': 'test',
+        'fullname': 'Test User',
+        'email': 'test@local.host',
+        'password': '1234',
+        'is_superuser': False
+    }
+}
+
+SERVICES = [
+    {
+        'URL': 'http://localhost:5000',
+        'CALLBACK': 'http://localhost:5000/cas/callback'
+    }
+]
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -
+import io
+import logging
+from collections import namedtuple
+
+from lxml import etree
+
+log = logging.getLogger(__name__)
+
+ValidationResult = namedtuple('ValidationResult',
+                              ['user', 'attributes', 'failure'])
+
+
+def _local_name(tag):
+    return tag.rpartition('}')[2] if isinstance(tag, str) else None
+
+
+def _iterparse(content):
+    return etree.iterparse(io.BytesIO(content), events=('end',),
+                           resolve_entities=False, no_network=True)
+
+
+class AttributeMap(object):
+    '''
+    Compiled form of the ``ckanext.cas.user_mapping`` setting.
+
+    `mapping` maps CKAN user fields to a CAS attribute name, or to a list of
+    names whose values are joined with spaces. The CAS attributes to collect
+    are known up front, so parsers can ignore every other attribute of the
+    response. For `member_attribute` (``isMemberOf``) the last value
+    containing `member_filter` is kept, or the first value if none does.
+    '''
+
+    def __init__(self, mapping, member_attribute='isMemberOf',
+                 member_filter=None):
+        self.fields = [(key, tuple(val) if isinstance(val, list) else val)
+                       for key, val in mapping.items()]
+        names = set()
+        for _, val in self.fields:
+            names.update(val if isinstance(val, tuple) else (val,))
+        self.names = frozenset(names)
+        self.member_attribute = member_attribute
+        self.member_filter = member_filter
+
+    def resolve(self, values, default=None):
+        '''
+        Builds the user fields from the collected attribute values. Fields
+        mapped to a single missing attribute get `default`, or are left out
+        if it is None.
+        '''
+        data_dict = {}
+        for key, val in self.fields:
+            if isinstance(val, tuple):
+                data_dict[key] = ' '.join(values.get(name) or '' for name in val)
+            elif val in values:
+                data_dict[key] = values[val]
+            elif default is not None:
+                data_dict[key] = default
+        return data_dict
+
+
+def parse_service_response(content, attribute_map):
+    '''
+    Parses a CAS 2/3 ``serviceValidate`` response in a single pass, keeping
+    only the user, the mapped attributes and the failure message.
+    '''
+    user = failure = None
+    values = {}
+    member_matched = False
+    member_attribute = attribute_map.member_attribute
+    member_filter = attribute_map.member_filter
+
+    for _, element in _iterparse(content):
+        name = _local_name(element.tag)
+        parent = element.getparent()
+        parent_name = _local_name(parent.tag) if parent is not None else None
+
+        if parent_name == 'attributes' and name in attribute_map.names:
+            text = element.text or ''
+            if name == member_attribute and member_filter:
+                if member_filter in text:
+                    values[name] = text
+                    member_matched = True
+                elif not member_matched and name not in values:
+                    values[name] = text
+            elif name not in values:
+                values[name] = text
+        elif name == 'user' and parent_name == 'authenticationSuccess':
+            user = (element.text or '').strip()
+        elif name == 'authenticationFailure':
+            failure = (element.text or '').strip() or \
+                element.get('code') or True
+
+        if parent_name != 'authenticationSuccess' or name == 'attributes':
+            element.clear()
+
+    return ValidationResult(user, attribute_map.resolve(values), failure)
+
+
+def parse_saml_response(content, attribute_map):
+    '''
+    Parses a SAML 1.1 ``samlValidate`` response in a single pass. The first
+    value of each mapped attribute is used. A successful status without an
+    assertion is reported as a failure.
+    '''
+    values = {}
+    success = has_assertion = False
+    status_message = None
+
+    for _, element in _iterparse(content):
+        name = _local_name(element.tag)
+        if name == 'Attribute':
+            attribute_name = element.get('AttributeName')
+            if attribute_name in attribute_map.names and \
+                    attribute_name not in values:
+                for child in element:
+                    if _local_name(child.tag) == 'AttributeValue':
+                        values[attribute_name] = child.text
+                        break
+            element.clear()
+        elif name == 'Assertion':
+            has_assertion = True
+            element.clear()
+        elif name == 'StatusCode':
+            success = element.get('Value', '').rpartition(':')[2] == 'Success'
+        elif name == 'StatusMessage':
+            status_message = element.text
+
+    if not success or not has_assertion:
+        return ValidationResult(None, {}, status_message or True)
+    return ValidationResult(None, attribute_map.resolve(values, default=''),
+                            None)
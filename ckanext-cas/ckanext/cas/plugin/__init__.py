@@ -4,7 +4,6 @@ from ckantoolkit import config
 from flask import redirect
 
 import logging
-import re
 import urllib.request
 import urllib.parse
 import urllib.error
@@ -13,8 +12,14 @@ import ckan.lib.helpers as h
 import ckan.plugins as p
 import ckan.plugins.toolkit as t
 import ckanext.cas.blueprints as blueprints
+import ckanext.cas.cli as cli
+import ckanext.cas.client as client
+import ckanext.cas.parser as parser
+import ckanext.cas.routes as routes
 from ckanext.cas.db import setup as db_setup
-from ckanext.cas.db import delete_user_entry, is_ticket_valid
+from ckanext.cas.db import (DEFAULT_TICKET_LIFETIME, configure_ticket_store,
+                            delete_user_entry, is_ticket_valid, ticket_cache)
+from ckanext.cas.limiter import login_limiter
 from ckan.common import g, session
 import ckan.model as model
 
@@ -26,11 +31,16 @@ abort = base.abort
 log = logging.getLogger(__name__)
 
 
+def _is_local_path(url):
+    return bool(url) and url.startswith('/') and not url.startswith('//')
+
+
 class CASClientPlugin(p.SingletonPlugin):
     p.implements(p.IConfigurer)
     p.implements(p.IAuthenticator, inherit=True)
     p.implements(p.IBlueprint)
     p.implements(p.IConfigurable)
+    p.implements(p.IClick)
 
     USER_ATTR_MAP = {}
     TICKET_KEY = None
@@ -48,8 +58,12 @@ class CASClientPlugin(p.SingletonPlugin):
     CAS_ADMIN_PROPERTY = None
     CAS_MEMBER_PROPERTY = None
     CAS_BASE_PROPERTY = None
+    SESSION_COOKIE_NAME = 'ckan'
+    LOGIN_RETRY_AFTER = 10
+    ROUTES = routes.RouteClassifier()
+    ATTRIBUTE_MAP = parser.AttributeMap({})
 
-    def _generate_login_url(self, gateway=False, next=False):
+    def _generate_login_url(self, gateway=False, next=False, next_url=None):
         params = '?service='
         if gateway:
             params = '?gateway=true&service='
@@ -66,7 +80,9 @@ class CASClientPlugin(p.SingletonPlugin):
                 next = False
         elif self.CAS_VERSION == 3:
             url = self.CAS_LOGIN_URL + params + self.CAS_APP_URL + '/cas/saml_callback'
-        if next:
+        if next_url:
+            url = url + '?next=' + urllib.parse.quote(next_url)
+        elif next:
             url = url + '?next=' + \
                 urllib.parse.quote(t.request.environ['CKAN_CURRENT_URL'])
         log.debug('RETURNING URL:' + url)
@@ -75,9 +91,30 @@ class CASClientPlugin(p.SingletonPlugin):
     # IConfigurable
 
     def configure(self, config_):
-        # Setup database tables
+        # Define the database tables, their schema is checked on first use
         db_setup()
 
+        # Store of the current ticket of each logged in user
+        configure_ticket_store(
+            config_.get('ckanext.cas.ticket_store', 'sql'),
+            t.asint(config_.get('ckanext.cas.ticket_lifetime',
+                                DEFAULT_TICKET_LIFETIME)))
+
+        # Pooled HTTP session for ticket validation
+        client.configure(config_)
+
+        # Concurrent ticket validations per process
+        login_limiter.configure(
+            t.asint(config_.get('ckanext.cas.max_concurrent_logins', 10)),
+            float(config_.get('ckanext.cas.login_queue_timeout', 5)),
+            t.asint(config_.get('ckanext.cas.max_waiting_logins', 10)))
+        self.LOGIN_RETRY_AFTER = t.asint(
+            config_.get('ckanext.cas.login_retry_after', 10))
+
+        # Seconds a valid ticket check is reused by this process
+        ticket_cache.ttl = t.asint(
+            config_.get('ckanext.cas.ticket_cache_ttl', 30))
+
         # Load and parse user attributes mapping
         user_mapping = t.aslist(config_.get('ckanext.cas.user_mapping'))
         for attr in user_mapping:
@@ -159,6 +196,15 @@ class CASClientPlugin(p.SingletonPlugin):
             'ckanext.cas.member_property', None)
         self.CAS_BASE_PROPERTY = config.get(
             'ckanext.cas.base_property', None)
+        self.SESSION_COOKIE_NAME = config.get('beaker.session.key', 'ckan')
+        self.ATTRIBUTE_MAP = parser.AttributeMap(
+            self.USER_ATTR_MAP, member_filter=self.CAS_BASE_PROPERTY)
+
+        static_paths = config.get('ckanext.cas.static_paths', None)
+        static_extensions = config.get('ckanext.cas.static_extensions', None)
+        self.ROUTES = routes.RouteClassifier(
+            t.aslist(static_paths) if static_paths is not None else None,
+            t.aslist(static_extensions) if static_extensions is not None else None)
 
     # IConfigurer
 
@@ -173,14 +219,19 @@ class CASClientPlugin(p.SingletonPlugin):
         log.debug('Invoked "identify" method.')
 
         environ = t.request.environ
+        route = self.ROUTES.classify(environ.get('PATH_INFO', ''))
 
-        remote_user = session.get('user')
+        # Static assets never need a user, and a request without a session
+        # cookie has no session user, skip loading the session for both
+        if route == routes.STATIC or \
+                self.SESSION_COOKIE_NAME not in t.request.cookies:
+            remote_user = None
+        else:
+            remote_user = session.get('user')
 
         g.user = remote_user
-        g.userobj = model.User.get(remote_user)
+        g.userobj = model.User.get(remote_user) if remote_user else None
 
-        log.debug('IS TICKET VALID ?')
-        log.debug(is_ticket_valid(remote_user))
         if remote_user and not is_ticket_valid(remote_user):
             log.debug('User logged out of CAS Server')
 
@@ -204,9 +255,7 @@ class CASClientPlugin(p.SingletonPlugin):
                     'logout_handler_path'
                 ) + '?came_from=' + url)
 
-        elif not remote_user \
-                and not re.match(r'.*/api(/\d+)?/action/.*', environ['PATH_INFO']) \
-                and not re.match(r'.*/dataset/.+/resource/.+/download/.+', environ['PATH_INFO']):
+        elif not remote_user and route == routes.PAGE:
             login_checkup_cookie = t.request.cookies.get(
                 self.LOGIN_CHECKUP_COOKIE, None)
             if login_checkup_cookie:
@@ -218,7 +267,11 @@ class CASClientPlugin(p.SingletonPlugin):
     def login(self):
         log.debug('Invoked "login" method.')
 
-        cas_login_url = self._generate_login_url(next=True)
+        # Set by the retry page of a login turned away by the limiter
+        came_from = t.request.params.get('came_from')
+        if not _is_local_path(came_from):
+            came_from = None
+        cas_login_url = self._generate_login_url(next=True, next_url=came_from)
         return redirect(cas_login_url)
 
     def logout(self):
@@ -252,3 +305,8 @@ class CASClientPlugin(p.SingletonPlugin):
 
     def get_blueprint(self):
         return [blueprints.cas]
+
+    # IClick
+
+    def get_commands(self):
+        return cli.get_commands()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -
+import re
+import logging
+
+log = logging.getLogger(__name__)
+
+STATIC = 'static'
+API = 'api'
+DOWNLOAD = 'download'
+PAGE = 'page'
+
+DEFAULT_STATIC_PATHS = ['/base/', '/webassets/', '/fanstatic/', '/images/',
+                        '/img/', '/css/', '/js/', '/fonts/', '/uploads/',
+                        '/favicon.ico', '/robots.txt']
+DEFAULT_STATIC_EXTENSIONS = ['.css', '.js', '.map', '.png', '.jpg', '.jpeg',
+                             '.gif', '.svg', '.ico', '.woff', '.woff2', '.ttf',
+                             '.eot']
+
+API_PATTERN = re.compile(r'.*/api(/\d+)?/action/')
+DOWNLOAD_PATTERN = re.compile(r'.*/dataset/.+/resource/.+/download/.')
+
+
+class RouteClassifier(object):
+    '''
+    Sorts request paths into the kinds of traffic `identify` handles
+    differently: static assets, which never need a user, API actions,
+    resource downloads and regular pages.
+
+    Static assets are matched by path prefix or file extension with plain
+    string checks, and the API and download regular expressions are compiled
+    once and only tried on paths containing their literal part.
+    '''
+
+    def __init__(self, static_paths=None, static_extensions=None):
+        self.static_paths = tuple(
+            DEFAULT_STATIC_PATHS if static_paths is None else static_paths)
+        self.static_extensions = tuple(
+            ext.lower() for ext in (DEFAULT_STATIC_EXTENSIONS
+                                    if static_extensions is None
+                                    else static_extensions))
+
+    def classify(self, path):
+        if path.startswith(self.static_paths):
+            return STATIC
+        if '/api/' in path and API_PATTERN.match(path):
+            return API
+        if '/download/' in path and DOWNLOAD_PATTERN.match(path):
+            return DOWNLOAD
+        if path.lower().endswith(self.static_extensions):
+            return STATIC
+        return PAGE
@@ -0,0 +1,75 @@
+"""Tests for db.py."""
+import time
+
+from ckanext.cas.db import MemoryTicketStore, TicketCache, get_attributes_hash
+
+
+def test_ticket_cache_expires():
+    cache = TicketCache(ttl=1)
+    cache.set('admin', 'ST-1')
+    assert cache.get('admin')
+    cache._entries['admin'] = ('ST-1', time.time() - 1)
+    assert not cache.get('admin')
+
+
+def test_ticket_cache_invalidation():
+    cache = TicketCache(ttl=30)
+    cache.set('admin', 'ST-1')
+    cache.set('test', 'ST-2')
+    cache.invalidate_ticket('ST-1')
+    assert not cache.get('admin')
+    assert cache.get('test')
+    cache.invalidate_user('test')
+    assert not cache.get('test')
+
+
+def test_ticket_cache_disabled():
+    cache = TicketCache(ttl=0)
+    cache.set('admin', 'ST-1')
+    assert not cache.get('admin')
+
+
+def test_attributes_hash_changes_with_attributes():
+    attributes_hash = get_attributes_hash('test', 'test@example.com', 'Test', False)
+    assert attributes_hash == get_attributes_hash(
+        'test', 'test@example.com', 'Test', False)
+    assert attributes_hash != get_attributes_hash(
+        'test', 'test@example.com', 'Test', True)
+
+
+def test_memory_ticket_store_replaces_tickets():
+    store = MemoryTicketStore(ttl=60)
+    store.set_many({'admin': 'ST-1', 'test': 'ST-2'})
+    store.set_ticket('admin', 'ST-3')
+    assert store.get_many(['admin', 'test', 'other']) == {'admin': 'ST-3',
+                                                          'test': 'ST-2'}
+    store.delete_tickets(['ST-1', 'ST-2'])
+    assert store.get_ticket('admin') == 'ST-3'
+    assert store.get_ticket('test') is None
+
+
+def test_memory_ticket_store_expiry():
+    store = MemoryTicketStore(ttl=60)
+    store.set_many({'admin': 'ST-1', 'test': 'ST-2'})
+    store._tickets['admin'] = ('ST-1', time.time() - 1)
+    assert store.get_ticket('admin') is None
+    assert store.purge_expired() == 1
+    assert store.get_many(['admin', 'test']) == {'test': 'ST-2'}
+
+
+def test_ticket_cache_drops_entries_revoked_by_other_processes():
+    store = MemoryTicketStore(ttl=60)
+    store.set_ticket('admin', 'ST-1')
+    cache = TicketCache(ttl=30)
+    generation = store.generation()
+    assert not cache.get('admin', generation)
+    cache.set('admin', 'ST-1', generation)
+    assert cache.get('admin', store.generation())
+
+    # Logout served by another process sharing the store
+    store.delete_users(['admin'])
+    assert not cache.get('admin', store.generation())
+
+    # Entries read before the latest revocation are not cached
+    cache.set('admin', 'ST-1', generation)
+    assert not cache.get('admin', store.generation())
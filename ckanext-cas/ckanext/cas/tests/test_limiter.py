@@ -0,0 +1,39 @@
+"""Tests for limiter.py."""
+import threading
+import time
+
+from ckanext.cas.limiter import LoginLimiter
+
+
+def test_login_limiter_rejects_when_full():
+    limiter = LoginLimiter(limit=2, timeout=0.01)
+    assert limiter.acquire()
+    assert limiter.acquire()
+    assert not limiter.acquire()
+    limiter.release()
+    assert limiter.acquire()
+
+
+def test_login_limiter_disabled():
+    limiter = LoginLimiter(limit=0)
+    assert all(limiter.acquire() for _ in range(100))
+    limiter.release()
+
+
+def test_login_limiter_bounds_waiting_logins():
+    limiter = LoginLimiter(limit=1, timeout=5, max_waiting=1)
+    assert limiter.acquire()
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(limiter.acquire()))
+    waiter.start()
+    while not limiter.waiting:
+        time.sleep(0.001)
+
+    # The queue is full, so this login is turned away without waiting
+    start = time.time()
+    assert not limiter.acquire()
+    assert time.time() - start < 1
+
+    limiter.release()
+    waiter.join()
+    assert results == [True]
@@ -0,0 +1,49 @@
+"""Tests for the mock CAS server in helpers/cas.py."""
+import requests as rq
+
+from ckanext.cas import parser
+from ckanext.cas.tests.helpers import cas as mock_cas
+
+SERVICE = 'http://localhost:5000/cas/callback'
+ATTRIBUTE_MAP = parser.AttributeMap(
+    {'user': 'username', 'email': 'email', 'fullname': 'fullname',
+     'sysadmin': 'isMemberOf'}, member_filter='opendata')
+
+
+def test_mock_cas_service_validate():
+    httpd = mock_cas.serve(port=0)
+    url = 'http://127.0.0.1:{0}'.format(httpd.server_address[1])
+    try:
+        mock_cas.MockCASServer.configure(groups=50)
+        ticket = mock_cas.MockCASServer.issue_ticket('admin', SERVICE)
+        params = {'ticket': ticket, 'service': SERVICE}
+
+        result = parser.parse_service_response(
+            rq.get(url + '/serviceValidate', params=params).content,
+            ATTRIBUTE_MAP)
+        assert result.user == 'admin'
+        assert result.attributes['email'] == 'admin@local.host'
+        assert result.attributes['sysadmin'] == 'cn=admin,o=opendata'
+
+        # Tickets are single use
+        result = parser.parse_service_response(
+            rq.get(url + '/serviceValidate', params=params).content,
+            ATTRIBUTE_MAP)
+        assert result.failure
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def test_mock_cas_login_redirects_with_ticket():
+    httpd = mock_cas.serve(port=0)
+    url = 'http://127.0.0.1:{0}'.format(httpd.server_address[1])
+    try:
+        response = rq.get(url + '/login',
+                          params={'username': 'test', 'service': SERVICE},
+                          allow_redirects=False)
+        assert response.status_code == 302
+        assert response.headers['Location'].startswith(SERVICE + '?ticket=ST-')
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
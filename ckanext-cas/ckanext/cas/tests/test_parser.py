@@ -0,0 +1,47 @@
+"""Tests for parser.py."""
+from ckanext.cas import benchmark, parser
+
+ATTRIBUTES = {'mail': 'user@example.com', 'givenName': 'Test',
+              'sn': 'User', 'uid': 'test'}
+USER_ATTR_MAP = {'email': 'mail', 'fullname': ['givenName', 'sn'],
+                 'user': 'uid', 'sysadmin': 'isMemberOf'}
+
+
+def _attribute_map():
+    return parser.AttributeMap(USER_ATTR_MAP, member_filter='opendata')
+
+
+def test_parse_service_response():
+    content = benchmark.service_response('test', ATTRIBUTES, groups=200)
+    result = parser.parse_service_response(content, _attribute_map())
+    assert result.failure is None
+    assert result.user == 'test'
+    assert result.attributes == {'email': 'user@example.com',
+                                 'fullname': 'Test User',
+                                 'user': 'test',
+                                 'sysadmin': 'cn=admin,o=opendata'}
+
+
+def test_parse_service_response_without_matching_group():
+    content = benchmark.service_response('test', ATTRIBUTES, groups=3,
+                                         base_property='other')
+    result = parser.parse_service_response(content, _attribute_map())
+    assert result.attributes['sysadmin'] == 'cn=grupo-0000,ou=grupos,o=gobcan'
+
+
+def test_parse_service_failure():
+    result = parser.parse_service_response(
+        benchmark.service_failure(message='Ticket ST-1 not recognized'),
+        _attribute_map())
+    assert result.user is None
+    assert result.failure == 'Ticket ST-1 not recognized'
+
+
+def test_parse_saml_response():
+    content = benchmark.saml_response(ATTRIBUTES, groups=5)
+    result = parser.parse_saml_response(content, _attribute_map())
+    assert result.failure is None
+    assert result.attributes == {'email': 'user@example.com',
+                                 'fullname': 'Test User',
+                                 'user': 'test',
+                                 'sysadmin': 'cn=grupo-0000,ou=grupos,o=gobcan'}
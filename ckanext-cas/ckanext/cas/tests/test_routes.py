@@ -0,0 +1,22 @@
+"""Tests for routes.py."""
+from ckanext.cas import routes
+
+
+def test_classify_default_routes():
+    classifier = routes.RouteClassifier()
+    assert classifier.classify('/base/css/main.css') == routes.STATIC
+    assert classifier.classify('/webassets/vendor/jquery.js') == routes.STATIC
+    assert classifier.classify('/logo/gobcan.PNG') == routes.STATIC
+    assert classifier.classify('/api/3/action/package_show') == routes.API
+    assert classifier.classify('/data/api/action/status_show') == routes.API
+    assert classifier.classify(
+        '/dataset/a/resource/b/download/c.csv') == routes.DOWNLOAD
+    assert classifier.classify('/dataset') == routes.PAGE
+    assert classifier.classify('/api/i18n/es') == routes.PAGE
+
+
+def test_classify_configured_static_paths():
+    classifier = routes.RouteClassifier(static_paths=['/assets/'],
+                                        static_extensions=[])
+    assert classifier.classify('/assets/logo.svg') == routes.STATIC
+    assert classifier.classify('/base/css/main.css') == routes.PAGE
@@ -0,0 +1,349 @@
+import os
+import sys
+import json
+import math
+import time
+import uuid
+import random
+import logging
+import resource
+import threading
+import contextlib
+import tempfile
+import http.server
+import socketserver
+
+from xml.sax.saxutils import escape, quoteattr
+
+from ckanext.gobcangroups.harvester.instrumentation import QueryCounter
+
+
+log = logging.getLogger(__name__)
+
+SECTOR_URI = 'http://datos.gob.es/kos/sector-publico/sector/'
+PUBLISHER_URI = 'http://datos.gob.es/recurso/sector-publico/org/Organismo/'
+
+SECTORS = ['ciencia-tecnologia', 'comercio', 'cultura-ocio', 'demografia',
+           'deporte', 'economia', 'educacion', 'empleo', 'energia',
+           'hacienda', 'industria', 'legislacion-justicia', 'medio-ambiente',
+           'medio-rural-pesca', 'salud', 'sector-publico', 'seguridad',
+           'sociedad-bienestar', 'transporte', 'turismo', 'urbanismo-infraestructuras',
+           'vivienda']
+
+# (time property, amount, label) as serialised by GobCanProfile
+FREQUENCIES = [('years', 1, 'Anual'), ('months', 6, 'Semestral'),
+               ('months', 3, 'Trimestral'), ('months', 1, 'Mensual'),
+               ('days', 15, 'Quincenal'), ('weeks', 1, 'Semanal'),
+               ('days', 1, 'Diaria')]
+
+FORMATS = [('CSV', 'text/csv'), ('JSON', 'application/json'),
+           ('XLSX', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+           ('PDF', 'application/pdf'), ('XML', 'application/xml')]
+
+HEADER = '''<?xml version="1.0" encoding="utf-8"?>
+<rdf:RDF
+  xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+  xmlns:rdfs="http://www.w3.org/2000/01/rdf-schema#"
+  xmlns:dcat="http://www.w3.org/ns/dcat#"
+  xmlns:dct="http://purl.org/dc/terms/"
+  xmlns:foaf="http://xmlns.com/foaf/0.1/"
+  xmlns:time="http://www.w3.org/2006/time#"
+  xmlns:xsd="http://www.w3.org/2001/XMLSchema#">
+  <dcat:Catalog rdf:about={catalog}>
+    <dct:title>Synthetic GOBCAN catalogue</dct:title>
+'''
+
+DATASET = '''    <dcat:dataset>
+      <dcat:Dataset rdf:about={uri}>
+        <dct:identifier>{identifier}</dct:identifier>
+        <dct:title>{title}</dct:title>
+        <dct:description>{description}</dct:description>
+        <dct:issued rdf:datatype="http://www.w3.org/2001/XMLSchema#dateTime">2020-01-01T00:00:00</dct:issued>
+        <dct:modified rdf:datatype="http://www.w3.org/2001/XMLSchema#dateTime">{modified}</dct:modified>
+        <dcat:theme rdf:resource={theme}/>
+        <dct:publisher rdf:resource={publisher}/>
+        <dct:license rdf:resource="https://creativecommons.org/licenses/by/4.0/"/>
+        <dcat:keyword>{keyword}</dcat:keyword>
+        <dct:accrualPeriodicity>
+          <dct:Frequency>
+            <rdf:value>
+              <time:DurationDescription>
+                <rdfs:label>{frequency_label}</rdfs:label>
+                <time:{frequency_unit} rdf:datatype="http://www.w3.org/2001/XMLSchema#decimal">{frequency_amount}</time:{frequency_unit}>
+              </time:DurationDescription>
+            </rdf:value>
+          </dct:Frequency>
+        </dct:accrualPeriodicity>
+{distributions}      </dcat:Dataset>
+    </dcat:dataset>
+'''
+
+DISTRIBUTION = '''        <dcat:distribution>
+          <dcat:Distribution rdf:about={uri}>
+            <dct:title>{title}</dct:title>
+            <dcat:accessURL rdf:resource={url}/>
+            <dct:format>{format}</dct:format>
+            <dcat:mediaType>{media_type}</dcat:mediaType>
+          </dcat:Distribution>
+        </dcat:distribution>
+'''
+
+FOOTER = '''  </dcat:Catalog>
+</rdf:RDF>
+'''
+
+
+def generate_catalogue(out, datasets=1000, themes=10, publishers=5,
+                       distributions=2, frequencies=None, seed=0,
+                       base_uri='http://example.com/catalogo/'):
+    '''
+    Writes a synthetic DCAT-AP catalogue in RDF/XML to the text stream `out`.
+
+    Datasets are written one at a time, so memory use does not depend on the
+    size of the catalogue. `themes` and `publishers` set how many NTI sectors
+    and DIR3 publishers are spread across the datasets, `frequencies` how
+    many of the known update frequencies are used. The output only depends on
+    the arguments, so two runs with the same seed are byte-for-byte equal.
+    '''
+    rng = random.Random(seed)
+    sectors = SECTORS[:max(1, min(themes, len(SECTORS)))]
+    frequencies = FREQUENCIES[:max(1, min(frequencies or len(FREQUENCIES),
+                                          len(FREQUENCIES)))]
+
+    out.write(HEADER.format(catalog=quoteattr(base_uri)))
+    for number in range(datasets):
+        identifier = 'dataset-{0:07d}'.format(number)
+        dataset_uri = base_uri + identifier
+        sector = rng.choice(sectors)
+        unit, amount, label = rng.choice(frequencies)
+
+        resources = []
+        for index in range(distributions):
+            fmt, media_type = rng.choice(FORMATS)
+            resources.append(DISTRIBUTION.format(
+                uri=quoteattr('{0}/distribucion/{1}'.format(dataset_uri, index)),
+                title=escape('{0} ({1})'.format(identifier, fmt)),
+                url=quoteattr('{0}/descarga/{1}.{2}'.format(
+                    dataset_uri, index, fmt.lower())),
+                format=fmt,
+                media_type=escape(media_type)))
+
+        out.write(DATASET.format(
+            uri=quoteattr(dataset_uri),
+            identifier=escape(dataset_uri),
+            title=escape('Conjunto de datos {0}'.format(number)),
+            description=escape('Conjunto de datos sintetico {0} del sector {1}'.format(
+                number, sector)),
+            modified='2021-{0:02d}-{1:02d}T00:00:00'.format(
+                rng.randint(1, 12), rng.randint(1, 28)),
+            theme=quoteattr(SECTOR_URI + sector),
+            publisher=quoteattr('{0}A{1:08d}'.format(
+                PUBLISHER_URI, rng.randrange(publishers))),
+            keyword=escape(sector),
+            frequency_label=label,
+            frequency_unit=unit,
+            frequency_amount=amount,
+            distributions=''.join(resources)))
+    out.write(FOOTER)
+
+
+def percentile(values, fraction):
+    '''Returns the nearest-rank percentile of a list of numbers'''
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = int(math.ceil(fraction * len(ordered)))
+    return ordered[max(0, min(len(ordered), rank) - 1)]
+
+
+def _ms(seconds):
+    return seconds * 1000 if seconds is not None else None
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+@contextlib.contextmanager
+def serve_catalogue(path):
+    '''Serves the file at `path` as application/rdf+xml on a local port'''
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/rdf+xml')
+            self.send_header('Content-Length', str(os.path.getsize(path)))
+            self.end_headers()
+            with open(path, 'rb') as f:
+                while True:
+                    chunk = f.read(64 * 1024)
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = socketserver.TCPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:{0}/catalog.rdf'.format(httpd.server_address[1])
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def run_harvest_benchmark(datasets=1000, batch_size=None, **catalogue_options):
+    '''
+    Harvests a synthetic catalogue with GOBCANHarvester into the configured
+    CKAN database and returns a report of the gather and import stages.
+
+    It creates a harvest source, datasets and group memberships, so it must
+    only be run against a disposable test database.
+    '''
+    fd, path = tempfile.mkstemp(suffix='.rdf')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as out:
+            generate_catalogue(out, datasets=datasets, **catalogue_options)
+        return _run_harvest_benchmark(path, datasets, batch_size)
+    finally:
+        os.remove(path)
+
+
+def _run_harvest_benchmark(path, datasets, batch_size):
+    import ckan.model as model
+    import ckan.plugins as p
+    from ckanext.harvest.model import HarvestJob, HarvestObject
+    from ckanext.harvest.queue import fetch_and_import_stages
+
+    harvester = p.get_plugin('gobcan_harvester')
+    context = {'model': model, 'session': model.Session,
+               'user': harvester._get_user_name(), 'ignore_auth': True}
+    counter = QueryCounter(model.meta.engine)
+    report = {'datasets': datasets,
+              'catalogue_bytes': os.path.getsize(path),
+              'batch_size': batch_size}
+
+    with serve_catalogue(path) as url, counter.attached():
+        source = p.toolkit.get_action('harvest_source_create')(context, {
+            'name': 'benchmark-{0}'.format(uuid.uuid4().hex[:8]),
+            'url': url,
+            'source_type': 'gobcan_harvester',
+            'config': json.dumps({'rdf_format': 'xml'}),
+        })
+        job = p.toolkit.get_action('harvest_job_create')(
+            context, {'source_id': source['id'], 'run': False})
+        harvest_job = HarvestJob.get(job['id'])
+
+        start, queries = time.time(), counter.count
+        object_ids = harvester.gather_stage(harvest_job) or []
+        report['gather_seconds'] = time.time() - start
+        report['gather_queries'] = counter.count - queries
+
+        # Per object latencies in per-object mode, per batch latencies in
+        # batch mode: a batch average is not a per object percentile
+        latencies = []
+        batch_latencies = []
+        start, queries = time.time(), counter.count
+        if batch_size:
+            for index in range(0, len(object_ids), batch_size):
+                harvest_objects = model.Session.query(HarvestObject) \
+                    .filter(HarvestObject.id.in_(object_ids[index:index + batch_size])) \
+                    .all()
+                batch_start = time.time()
+                harvester.import_objects(harvest_objects)
+                batch_latencies.append(time.time() - batch_start)
+        else:
+            for object_id in object_ids:
+                object_start = time.time()
+                fetch_and_import_stages(harvester, HarvestObject.get(object_id))
+                latencies.append(time.time() - object_start)
+        elapsed = time.time() - start
+
+    report.update({
+        'objects': len(object_ids),
+        'import_seconds': elapsed,
+        'objects_per_second': len(object_ids) / elapsed if elapsed else None,
+        'p50_ms': _ms(percentile(latencies, 0.5)),
+        'p99_ms': _ms(percentile(latencies, 0.99)),
+        'batch_p50_ms': _ms(percentile(batch_latencies, 0.5)),
+        'batch_p99_ms': _ms(percentile(batch_latencies, 0.99)),
+        'import_queries': counter.count - queries,
+        'queries_per_object': (counter.count - queries) / float(len(object_ids))
+        if object_ids else None,
+        'peak_rss_mb': peak_rss_mb(),
+    })
+    return report
+
+
+def load_profile_module(name='gobcan'):
+    '''Returns the module of the DCAT RDF profile registered as `name`'''
+    from pkg_resources import iter_entry_points
+    for entry_point in iter_entry_points('ckan.rdf.profiles', name=name):
+        return sys.modules[entry_point.load().__module__]
+    raise ValueError('Unknown RDF profile: {0}'.format(name))
+
+
+def _license_references(licenses, datasets, seed):
+    # URIs as found in harvested catalogues: other scheme, trailing slash or
+    # case than the register, and some unknown licenses only matched by title
+    rng = random.Random(seed)
+    references = []
+    for number in range(datasets):
+        license = rng.choice(licenses)
+        uri = license.url
+        variant = rng.random()
+        if variant < 0.1:
+            uri = 'http://example.com/licencia/{0}'.format(number)
+        elif variant < 0.3:
+            uri = uri.replace('https://', 'http://', 1)
+        elif variant < 0.5:
+            uri = uri.rstrip('/') + '/'
+        elif variant < 0.6:
+            uri = uri.upper()
+        references.append((uri, license.title))
+    return references
+
+
+def run_license_benchmark(profile='gobcan', datasets=10000, seed=0):
+    '''
+    Compares the license lookups of GobCanProfile for `datasets` harvested
+    datasets: the per-instance tables it used to rebuild from the license
+    register for every parsed graph, against the process-wide license index.
+    '''
+    from ckan.model.license import LicenseRegister
+
+    module = load_profile_module(profile)
+    licenses = [license for license in LicenseRegister().values()
+                if license.url]
+    references = _license_references(licenses, datasets, seed)
+
+    def per_instance(uri, title):
+        license_uri2id = {}
+        license_title2id = {}
+        for license_id, license in list(LicenseRegister().items()):
+            license_uri2id[license.url] = license_id
+            license_title2id[license.title] = license_id
+        return license_uri2id.get(uri) or license_title2id.get(title)
+
+    def process_index(uri, title):
+        index = module.get_license_index()
+        return index.by_uri(uri) or index.by_title(title)
+
+    report = {'datasets': datasets, 'licenses': len(licenses)}
+    module.reload_license_index()
+    for name, lookup in (('per_instance', per_instance),
+                         ('process_index', process_index)):
+        start = time.time()
+        matched = sum(1 for uri, title in references if lookup(uri, title))
+        elapsed = time.time() - start
+        report[name] = {'seconds': elapsed,
+                        'us_per_dataset': 1e6 * elapsed / datasets if datasets else None,
+                        'matched': matched}
+    if report['process_index']['seconds']:
+        report['speedup'] = report['per_instance']['seconds'] / \
+            report['process_index']['seconds']
+    return report
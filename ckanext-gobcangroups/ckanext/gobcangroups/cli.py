@@ -0,0 +1,246 @@
+import json
+import logging
+import multiprocessing
+import zlib
+
+import click
+
+import ckan.model as model
+import ckan.plugins as p
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.harvest.model import HarvestJob, HarvestObject
+
+from ckanext.gobcangroups import benchmark
+from ckanext.gobcangroups.harvester import instrumentation
+
+
+log = logging.getLogger(__name__)
+
+
+def get_commands():
+    return [gobcangroups]
+
+
+@click.group()
+def gobcangroups():
+    '''GOBCAN harvester commands'''
+    pass
+
+
+def guid_partition(guid, partitions):
+    '''
+    Returns the partition a guid belongs to. All the objects of a guid land
+    in the same partition, so workers never compete for its current flag.
+    '''
+    return zlib.crc32(guid.encode('utf-8')) % partitions
+
+
+def _waiting_object_ids(job_id, partition=0, partitions=1):
+    rows = model.Session.query(HarvestObject.id, HarvestObject.guid) \
+        .filter(HarvestObject.harvest_job_id == job_id) \
+        .filter(HarvestObject.state == 'WAITING') \
+        .order_by(HarvestObject.guid)
+    return [object_id for object_id, guid in rows
+            if guid_partition(guid or '', partitions) == partition]
+
+
+def _claim_batch(ids):
+    '''
+    Moves the waiting objects among `ids` to IMPORT and returns them. Rows
+    locked by another worker claiming them are skipped, and a claimed object
+    is no longer WAITING for the next claim.
+    '''
+    harvest_objects = model.Session.query(HarvestObject) \
+        .filter(HarvestObject.id.in_(ids)) \
+        .filter(HarvestObject.state == 'WAITING') \
+        .order_by(HarvestObject.guid) \
+        .with_for_update(skip_locked=True) \
+        .all()
+    for harvest_object in harvest_objects:
+        harvest_object.state = 'IMPORT'
+    model.Session.commit()
+    return harvest_objects
+
+
+def _release_batch(ids):
+    '''Puts the objects of a failed batch back to WAITING'''
+    model.Session.rollback()
+    model.Session.query(HarvestObject) \
+        .filter(HarvestObject.id.in_(ids)) \
+        .filter(HarvestObject.state == 'IMPORT') \
+        .update({'state': 'WAITING'}, synchronize_session=False)
+    model.Session.commit()
+
+
+def _import_partition(job_id, batch_size, partition=0, partitions=1):
+    harvester = p.get_plugin('gobcan_harvester')
+    object_ids = _waiting_object_ids(job_id, partition, partitions)
+    click.echo('Importing {0} objects of job {1} (partition {2}/{3})'.format(
+        len(object_ids), job_id, partition, partitions))
+
+    totals = {}
+    for start in range(0, len(object_ids), batch_size):
+        ids = object_ids[start:start + batch_size]
+        harvest_objects = _claim_batch(ids)
+        claimed = [harvest_object.id for harvest_object in harvest_objects]
+        try:
+            report = harvester.import_objects(harvest_objects)
+        except Exception:
+            log.exception('Batch %d-%d of job %s failed, putting its objects '
+                          'back to WAITING', start, start + len(ids), job_id)
+            _release_batch(claimed)
+            raise
+        for status, count in report.items():
+            totals[status] = totals.get(status, 0) + count
+        log.info('Imported batch %d-%d of job %s (partition %d/%d): %r',
+                 start, start + len(ids), job_id, partition, partitions, report)
+
+    click.echo('Partition {0}/{1}: {2}'.format(
+        partition, partitions,
+        ', '.join('{0}: {1}'.format(status, count)
+                  for status, count in sorted(totals.items()))))
+
+
+def _import_worker(job_id, batch_size, partition, partitions):
+    try:
+        _import_partition(job_id, batch_size, partition, partitions)
+    finally:
+        model.Session.remove()
+
+
+def _check_batch_job(job_id):
+    job = HarvestJob.get(job_id)
+    if job is None:
+        raise click.ClickException('Harvest job {0} not found'.format(job_id))
+    harvester = p.get_plugin('gobcan_harvester')
+    if not harvester._batch_import(harvester._source_config(job.source)):
+        # The fetch consumer would import the same objects again
+        raise click.ClickException(
+            'The source of job {0} does not have "batch_import": true, so '
+            'its objects are queued for the fetch consumer'.format(job_id))
+
+
+def _parse_partition(value):
+    try:
+        partition, partitions = [int(x) for x in value.split('/')]
+    except ValueError:
+        raise click.BadParameter('Use the form INDEX/COUNT, e.g. 0/4')
+    if partitions < 1 or not 0 <= partition < partitions:
+        raise click.BadParameter('INDEX must be between 0 and COUNT - 1')
+    return partition, partitions
+
+
+@gobcangroups.command('import-batch')
+@click.argument('job_id')
+@click.option('--batch-size', type=int, default=None,
+              help='Harvest objects imported per transaction')
+@click.option('--workers', type=int, default=None,
+              help='Worker processes, each importing a partition of guids')
+@click.option('--partition', default=None,
+              help='Only import the INDEX/COUNT partition of guids')
+def import_batch(job_id, batch_size, workers, partition):
+    '''Import the waiting objects of a harvest job in batches.
+
+    The job must come from a source with "batch_import": true, whose
+    objects are not queued for the fetch consumer. Each batch is imported
+    in a single transaction. Objects are partitioned by guid, either across
+    local worker processes (--workers) or across separately launched
+    commands (--partition).
+    '''
+    _check_batch_job(job_id)
+    if batch_size is None:
+        batch_size = toolkit.asint(toolkit.config.get(
+            'ckanext.gobcangroups.import_batch_size', 100))
+    if workers is None:
+        workers = toolkit.asint(toolkit.config.get(
+            'ckanext.gobcangroups.import_workers', 1))
+
+    if partition:
+        _import_partition(job_id, batch_size, *_parse_partition(partition))
+        return
+
+    if workers <= 1:
+        _import_partition(job_id, batch_size)
+        return
+
+    # Forked workers must not share the parent's connections
+    model.Session.remove()
+    model.meta.engine.dispose()
+
+    context = multiprocessing.get_context('fork')
+    processes = [
+        context.Process(target=_import_worker,
+                        args=(job_id, batch_size, index, workers))
+        for index in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    failed = [index for index, process in enumerate(processes)
+              if process.exitcode != 0]
+    if failed:
+        raise click.ClickException(
+            'Import workers for partitions {0} failed'.format(failed))
+
+
+@gobcangroups.command('generate-catalogue')
+@click.argument('output', type=click.File('w', encoding='utf-8'))
+@click.option('--datasets', type=int, default=1000)
+@click.option('--themes', type=int, default=10)
+@click.option('--publishers', type=int, default=5)
+@click.option('--distributions', type=int, default=2)
+@click.option('--frequencies', type=int, default=None)
+@click.option('--seed', type=int, default=0)
+def generate_catalogue(output, **options):
+    '''Write a synthetic DCAT-AP RDF/XML catalogue to OUTPUT.'''
+    benchmark.generate_catalogue(output, **options)
+
+
+@gobcangroups.command('benchmark')
+@click.option('--datasets', type=int, multiple=True,
+              help='Catalogue sizes to harvest (default: 1000, 10000, 100000)')
+@click.option('--themes', type=int, default=10)
+@click.option('--publishers', type=int, default=5)
+@click.option('--distributions', type=int, default=2)
+@click.option('--batch-size', type=int, default=None,
+              help='Use import_objects with this batch size')
+def harvest_benchmark(datasets, batch_size, **options):
+    '''Harvest synthetic catalogues and report the import performance.
+
+    It writes harvest sources and datasets to the configured database: only
+    run it against a disposable test instance.
+    '''
+    for size in datasets or (1000, 10000, 100000):
+        report = benchmark.run_harvest_benchmark(
+            datasets=size, batch_size=batch_size, **options)
+        click.echo(json.dumps(report, sort_keys=True))
+
+
+@gobcangroups.command('benchmark-licenses')
+@click.option('--datasets', type=int, default=10000)
+@click.option('--profile', default='gobcan',
+              help='Name of the GOBCAN DCAT RDF profile')
+@click.option('--seed', type=int, default=0)
+def license_benchmark(datasets, profile, seed):
+    '''Compare the per-instance and process-wide license lookups.'''
+    report = benchmark.run_license_benchmark(
+        profile=profile, datasets=datasets, seed=seed)
+    click.echo(json.dumps(report, sort_keys=True))
+
+
+@gobcangroups.command('import-stats')
+@click.argument('job_id')
+@click.option('--json', 'as_json', is_flag=True, help='Print the raw report')
+def import_stats(job_id, as_json):
+    '''Show where the import time of a harvest job went, per stage.'''
+    directory = toolkit.config.get('ckanext.gobcangroups.import_stats_dir')
+    if not directory:
+        raise click.ClickException(
+            'Set ckanext.gobcangroups.import_stats_dir to collect import stats')
+    report = instrumentation.load_report(directory, job_id)
+    if as_json:
+        click.echo(json.dumps(report, sort_keys=True))
+    else:
+        click.echo(instrumentation.format_report(report))
@@ -0,0 +1,15 @@
+import json
+import hashlib
+
+
+def dataset_fingerprint(dataset):
+    '''
+    Returns a stable hash of a harvested dataset dict.
+
+    Keys are sorted so that two parses of the same DCAT content give the same
+    fingerprint regardless of dict ordering. List order is kept, as the order
+    of resources and extras is meaningful.
+    '''
+    content = json.dumps(dataset, sort_keys=True, separators=(',', ':'),
+                         ensure_ascii=False, default=str)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
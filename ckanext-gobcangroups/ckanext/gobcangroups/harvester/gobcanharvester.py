@@ -1,23 +1,52 @@
 import json
 import uuid
+import datetime
 import logging
+import tempfile
 import traceback
 
+import requests
+
 import ckan.plugins as p
 import ckan.model as model
 import ckan.lib.plugins as lib_plugins
 
-from ckanext.harvest.model import HarvestObject
+from sqlalchemy import and_
+
+from ckanext.harvest.model import (HarvestObject, HarvestObjectExtra,
+                                   HarvestObjectError)
 
 from ckanext.dcat.harvesters.rdf import DCATRDFHarvester
 
 from ckanext.dcat.interfaces import IDCATRDFHarvester
+from ckanext.dcat.processors import RDFParser, RDFParserException
+
+from ckanext.gobcangroups.harvester.fingerprint import dataset_fingerprint
+from ckanext.gobcangroups.harvester.index import HarvestJobIndexes
+from ckanext.gobcangroups.harvester.indexing import DeferredIndex
+from ckanext.gobcangroups.harvester.instrumentation import ImportStats
+from ckanext.gobcangroups.harvester.streaming import DatasetStream
+from ckanext.gobcangroups.harvester.watermark import (IncrementalFilter,
+                                                      dataset_modified,
+                                                      imported_modified)
+from ckanext.gobcangroups.harvester.memberships import add_memberships
 
 
 log = logging.getLogger(__name__)
 
 
 class GOBCANHarvester(DCATRDFHarvester):
+    p.implements(p.IGroupController, inherit=True)
+    p.implements(p.IOrganizationController, inherit=True)
+
+    _indexes = HarvestJobIndexes()
+    _deferred_index = DeferredIndex()
+    _stats = None
+
+    # Set while import_objects runs: errors and group memberships are held
+    # back until the batch savepoints are resolved
+    _batch_errors = None
+    _batch_members = None
 
     def info(self):
         return {
@@ -26,49 +55,87 @@ class GOBCANHarvester(DCATRDFHarvester):
             'description': 'DCAT RDF Harvester modified for GOBCAN'
         }
 
+    # IGroupController / IOrganizationController
+
+    def create(self, entity):
+        self._indexes.invalidate()
+
+    def edit(self, entity):
+        self._indexes.invalidate()
+
+    def delete(self, entity):
+        self._indexes.invalidate()
+
+    def _save_object_error(self, message, obj, stage=u'Fetch', line=None):
+        if self._batch_errors is None:
+            return super(GOBCANHarvester, self)._save_object_error(
+                message, obj, stage, line)
+        log.error('Error for object {0} in {1} stage: {2}'.format(
+            obj.id, stage, message))
+        self._batch_errors.append((message, obj, stage, line))
+
+    def _get_stats(self):
+        '''
+        Returns the per-stage import stats, enabled when
+        ckanext.gobcangroups.import_stats_dir is set
+        '''
+        if GOBCANHarvester._stats is None:
+            stats = ImportStats()
+            stats.configure(
+                p.toolkit.config.get('ckanext.gobcangroups.import_stats_dir'),
+                model.meta.engine)
+            GOBCANHarvester._stats = stats
+        return GOBCANHarvester._stats
+
     def _search_dict(self, list_of_dictionaries, key, value):
         return [element for element in list_of_dictionaries if element[key] == value]
 
-    def _check_value_in_group(self, group, theme):
-        for data in group:
-            if data['value'] in theme[0]['value']:
-                return True
+    def _get_indexes(self, harvest_object):
+        '''
+        Returns the skos_nti and dir3 indexes for the job of the harvest object,
+        building them with a single group_list/organization_list call per job
+        '''
+        def build_groups():
+            return p.toolkit.get_action('group_list')(
+                data_dict={'all_fields': True, 'include_extras': True})
+
+        def build_organizations():
+            return p.toolkit.get_action('organization_list')(
+                data_dict={'all_fields': True, 'include_extras': True})
+
+        return self._indexes.get(
+            harvest_object.harvest_job_id, build_groups, build_organizations)
 
     def _add_dataset_to_group(self, dataset, context, harvest_object):
-        try:
-            if self._search_dict(dataset['extras'], 'key', 'theme'):
-                groups = p.toolkit.get_action('group_list')(
-                    data_dict={'all_fields': True, 'include_extras': True})
-                theme = self._search_dict(dataset['extras'], 'key', 'theme')
-                for group in groups:
-                    group_extras = self._search_dict(
-                        group['extras'], 'key', 'skos_nti')
-                    if self._check_value_in_group(group_extras, theme):
-                        data_dict = {"id": group['id'],
-                                     "object": dataset['id'],
-                                     "object_type": 'package',
-                                     "capacity": 'public'}
-                        p.toolkit.get_action('member_create')(
-                            context, data_dict)
-                        log.info(
-                            'Created dataset group member for the group %s' % group['id'])
-        except p.toolkit.ValidationError as e:
-            self._save_object_error('Create validation Error: %s' % str(
-                e.error_summary), harvest_object, 'Import')
-            return False
+        theme = self._search_dict(dataset['extras'], 'key', 'theme')
+        if theme:
+            groups, _ = self._get_indexes(harvest_object)
+            pairs = [(group_id, dataset['id'])
+                     for group_id in groups.lookup(theme[0]['value'])]
+            if self._batch_members is not None:
+                self._batch_members.extend(pairs)
+            else:
+                self._apply_memberships(pairs)
+
+    def _apply_memberships(self, pairs):
+        '''
+        Writes the missing (group, dataset) memberships in one go and queues
+        the datasets whose groups changed for reindexing
+        '''
+        changed = add_memberships(pairs)
+        model.Session.commit()
+        for group_id, package_id in pairs:
+            if package_id in changed:
+                log.info('Created dataset group member for the group %s' %
+                         group_id)
+        self._deferred_index.update(changed)
 
     def _add_dataset_to_organization(self, dataset, context, harvest_object):
-        if self._search_dict(dataset['extras'], 'key', 'publisher_uri'):
-            organizations = p.toolkit.get_action(
-                'organization_list')(
-                    data_dict={'all_fields': True, 'include_extras': True})
-            publisher = self._search_dict(
-                dataset['extras'], 'key', 'publisher_uri')
-            for organization in organizations:
-                organizations_extras = self._search_dict(
-                    organization['extras'], 'key', 'dir3')
-                if self._check_value_in_group(organizations_extras, publisher):
-                    return organization['id']
+        publisher = self._search_dict(
+            dataset['extras'], 'key', 'publisher_uri')
+        if publisher:
+            _, organizations = self._get_indexes(harvest_object)
+            return organizations.lookup_first(publisher[0]['value'])
 
     def _set_organization(self, harvest_object, context, dataset):
         organization = self._add_dataset_to_organization(
@@ -76,10 +143,483 @@ class GOBCANHarvester(DCATRDFHarvester):
         if organization is not None:
             dataset['owner_org'] = organization
 
+    def _source_config(self, source):
+        try:
+            return json.loads(source.config or '{}')
+        except (AttributeError, ValueError):
+            return {}
+
+    def _force_import(self, harvest_object):
+        source_config = self._source_config(harvest_object.source)
+        return p.toolkit.asbool(source_config.get('force_all', False))
+
+    def gather_stage(self, harvest_job):
+        source_config = self._source_config(harvest_job.source)
+        incremental = self._incremental_filter(harvest_job, source_config)
+        if p.toolkit.asbool(source_config.get('streaming', False)):
+            object_ids = self._gather_streaming(harvest_job, incremental)
+        else:
+            object_ids = super(GOBCANHarvester, self).gather_stage(
+                harvest_job)
+            object_ids = self._filter_gathered(object_ids or [], incremental)
+        if incremental is not None:
+            log.info('Incremental harvest skipped %d datasets whose '
+                     'dct:modified has not changed' % incremental.skipped)
+        if self._batch_import(source_config) and object_ids:
+            # Nothing is queued for the fetch consumer: the objects stay
+            # waiting for `ckan gobcangroups import-batch`
+            log.info('Gathered %d objects of job %s for a batch import',
+                     len(object_ids), harvest_job.id)
+            return []
+        return object_ids
+
+    def _batch_import(self, source_config):
+        return p.toolkit.asbool(source_config.get('batch_import', False))
+
+    def _incremental_filter(self, harvest_job, source_config):
+        '''
+        Returns the filter for an incremental harvest of the source, or None
+        for a full harvest. Incremental harvests need "incremental": true in
+        the source config; "force_all": true forces a full harvest. A
+        dataset is skipped when its dct:modified is the one stored on the
+        harvest object of its latest successful import.
+        '''
+        if not p.toolkit.asbool(source_config.get('incremental', False)) or \
+                p.toolkit.asbool(source_config.get('force_all', False)):
+            return None
+
+        # A failed batch import leaves the previous object current, so the
+        # latest object of each guid tells whether its last import worked
+        latest_objects = model.Session.query(
+            HarvestObject.guid, HarvestObject.state, HarvestObject.current,
+            HarvestObject.report_status, HarvestObjectExtra.value) \
+            .outerjoin(HarvestObjectExtra, and_(
+                HarvestObjectExtra.harvest_object_id == HarvestObject.id,
+                HarvestObjectExtra.key == 'modified')) \
+            .filter(HarvestObject.harvest_source_id == harvest_job.source_id) \
+            .filter(HarvestObject.harvest_job_id != harvest_job.id) \
+            .distinct(HarvestObject.guid) \
+            .order_by(HarvestObject.guid, HarvestObject.gathered.desc())
+        imported = imported_modified(latest_objects)
+        if not imported:
+            return None
+        return IncrementalFilter(imported)
+
+    def _filter_gathered(self, object_ids, incremental):
+        '''
+        Records the dct:modified date of the objects gathered by
+        DCATRDFHarvester and, in an incremental harvest, drops the ones that
+        have not changed since their last import before they are queued
+        '''
+        kept = []
+        for start in range(0, len(object_ids), 500):
+            chunk = object_ids[start:start + 500]
+            for harvest_object in model.Session.query(HarvestObject) \
+                    .filter(HarvestObject.id.in_(chunk)):
+                if harvest_object.content is None or \
+                        self._get_object_extra(harvest_object, 'status') == 'delete':
+                    kept.append(harvest_object.id)
+                    continue
+                modified = dataset_modified(json.loads(harvest_object.content))
+                if incremental is not None and \
+                        incremental.skip(harvest_object.guid, modified):
+                    model.Session.delete(harvest_object)
+                    continue
+                if modified:
+                    harvest_object.extras.append(
+                        HarvestObjectExtra(key='modified', value=modified))
+                kept.append(harvest_object.id)
+            model.Session.commit()
+        return kept
+
+    def _download(self, url, harvest_job):
+        '''
+        Downloads a catalogue page to a temporary file without holding it in
+        memory. Returns None if the request fails.
+        '''
+        timeout = p.toolkit.asint(p.toolkit.config.get(
+            'ckanext.gobcangroups.gather_timeout', 60))
+        try:
+            response = requests.get(url, stream=True, timeout=timeout)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            self._save_gather_error(
+                'Could not get content from {0}: {1}'.format(url, e), harvest_job)
+            return None
+        page = tempfile.TemporaryFile()
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            page.write(chunk)
+        page.seek(0)
+        return page
+
+    def _gather_streaming(self, harvest_job, incremental=None):
+        '''
+        Gather stage for very large RDF/XML catalogues.
+
+        Each page is downloaded to disk and split into one document per
+        dataset while it is read, and each document is parsed into its own
+        graph. Only one dataset graph is held in memory at a time. The
+        content based hooks of IDCATRDFHarvester (after_download and
+        after_parsing) are not called in this mode.
+        '''
+        log.debug('In GOBCANHarvester streaming gather_stage')
+
+        next_page_url = harvest_job.source.url
+        visited = set()
+        guids_in_source = []
+        object_ids = []
+        names_taken = set()
+        pending = []
+
+        source_dataset = model.Package.get(harvest_job.source.id)
+
+        while next_page_url and next_page_url not in visited:
+            visited.add(next_page_url)
+            for harvester in p.PluginImplementations(IDCATRDFHarvester):
+                next_page_url, before_download_errors = \
+                    harvester.before_download(next_page_url, harvest_job)
+                for error_msg in before_download_errors:
+                    self._save_gather_error(error_msg, harvest_job)
+                if not next_page_url:
+                    return []
+
+            page = self._download(next_page_url, harvest_job)
+            if page is None:
+                return []
+
+            stream = DatasetStream(page)
+            try:
+                for document in stream:
+                    parser = RDFParser()
+                    parser.parse(document, _format='xml')
+                    for dataset in parser.datasets():
+                        guid = self._gather_dataset(
+                            dataset, harvest_job, source_dataset, names_taken)
+                        if not guid:
+                            continue
+                        guids_in_source.append(guid)
+                        modified = dataset_modified(dataset)
+                        if incremental is not None and \
+                                incremental.skip(guid, modified):
+                            continue
+                        pending.append(self._streamed_object(
+                            guid, harvest_job, dataset, modified))
+                    if len(pending) >= 100:
+                        object_ids.extend(
+                            self._save_gathered(pending, harvest_job))
+            except (RDFParserException, SyntaxError) as e:
+                self._save_gather_error(
+                    'Error parsing the RDF file: {0}'.format(e), harvest_job)
+                return []
+            except Exception as e:
+                self._save_gather_error('Error when processsing dataset: %r / %s' % (
+                    e, traceback.format_exc()), harvest_job)
+                return []
+            finally:
+                page.close()
+
+            object_ids.extend(self._save_gathered(pending, harvest_job))
+            next_page_url = stream.next_page
+
+        # Check if some datasets need to be deleted
+        object_ids.extend(self._mark_datasets_for_deletion(
+            guids_in_source, harvest_job))
+        return object_ids
+
+    def _gather_dataset(self, dataset, harvest_job, source_dataset, names_taken):
+        '''
+        Fills the name, owner organization and guid of a gathered dataset the
+        same way DCATRDFHarvester does. Returns the guid, or None if the
+        dataset has no identifier.
+        '''
+        if not dataset.get('name'):
+            dataset['name'] = self._gen_new_name(dataset['title'])
+        name, suffix = dataset['name'], 1
+        while dataset['name'] in names_taken:
+            dataset['name'] = '{0}-{1}'.format(name, suffix)
+            suffix += 1
+        names_taken.add(dataset['name'])
+
+        if not dataset.get('owner_org') and source_dataset.owner_org:
+            dataset['owner_org'] = source_dataset.owner_org
+
+        guid = self._get_guid(dataset, source_url=source_dataset.url)
+        if not guid:
+            self._save_gather_error(
+                'Could not get a unique identifier for dataset: {0}'.format(dataset),
+                harvest_job)
+            return None
+        dataset['extras'].append({'key': 'guid', 'value': guid})
+        return guid
+
+    def _streamed_object(self, guid, harvest_job, dataset, modified):
+        '''
+        Returns a new harvest object for a dataset gathered in streaming mode.
+        The job must be set through the relationship: the before_insert
+        listener of ckanext-harvest takes the source from it.
+        '''
+        harvest_object = HarvestObject(guid=guid, job=harvest_job,
+                                       content=json.dumps(dataset))
+        if modified:
+            harvest_object.extras.append(HarvestObjectExtra(
+                key='modified', value=modified))
+        return harvest_object
+
+    def _save_gathered(self, harvest_objects, harvest_job=None):
+        '''
+        Saves the gathered objects with one commit and returns their ids
+        '''
+        model.Session.add_all(harvest_objects)
+        model.Session.flush()
+        object_ids = [obj.id for obj in harvest_objects]
+        model.Session.commit()
+        # Do not keep the saved objects around, the job and source
+        # relationships add every object to their objects collections too
+        for obj in harvest_objects:
+            model.Session.expunge(obj)
+        if harvest_job is not None:
+            model.Session.expire(harvest_job, ['objects'])
+            model.Session.expire(harvest_job.source, ['objects'])
+        del harvest_objects[:]
+        return object_ids
+
+    def _previous_fingerprint(self, previous_object):
+        fingerprint = self._get_object_extra(previous_object, 'fingerprint')
+        if fingerprint is None and previous_object.content:
+            try:
+                fingerprint = dataset_fingerprint(
+                    json.loads(previous_object.content))
+            except ValueError:
+                return None
+        return fingerprint
+
+    def _is_unchanged(self, harvest_object, previous_object, fingerprint):
+        '''
+        Returns True if the previous current object was imported successfully
+        with the same content and its dataset is still active, so the import
+        can be skipped
+        '''
+        if previous_object is None or previous_object.state != 'COMPLETE' \
+                or not previous_object.package_id:
+            return False
+        if self._force_import(harvest_object):
+            return False
+        if self._previous_fingerprint(previous_object) != fingerprint:
+            return False
+        package = model.Package.get(previous_object.package_id)
+        return package is not None and package.state == 'active'
+
     def import_stage(self, harvest_object):
 
         log.debug('In GOBCANHarvester import_stage')
 
+        if self._get_object_extra(harvest_object, 'status') == 'delete':
+            return self._import_object(harvest_object)
+
+        stats = self._get_stats()
+        stats.start_object(harvest_object.harvest_job_id)
+
+        # Index the dataset once, after its groups have been set. Datasets
+        # are only coalesced across objects by import_objects: here each
+        # object is indexed right after its own commit
+        try:
+            with self._deferred_index.suppressed():
+                try:
+                    result = self._import_object(harvest_object)
+                finally:
+                    with stats.stage('index'):
+                        indexed = self._flush_index([harvest_object])
+            return result if indexed else False
+        finally:
+            # A fetch consumer cannot tell which object is the last one of
+            # its job, so the totals are written after every object
+            stats.finish_object(write=True)
+
+    def _flush_index(self, harvest_objects):
+        '''
+        Indexes the datasets touched by the import of `harvest_objects`.
+        Returns False, with the error recorded on each object, if the
+        indexing fails.
+        '''
+        try:
+            self._deferred_index.flush()
+        except Exception as e:
+            for harvest_object in harvest_objects:
+                self._save_object_error(
+                    'Error indexing the dataset of object {0}: {1!r}'.format(
+                        harvest_object.id, e), harvest_object, 'Import')
+            return False
+        return True
+
+    def import_objects(self, harvest_objects):
+        '''
+        Imports a batch of harvest objects in a single transaction.
+
+        The guids of the batch are locked first, then the previous current
+        objects and the existing datasets of the whole batch are fetched with
+        one query each. Every object is imported inside its own savepoint, so
+        a failing object is rolled back (keeping the previous object as the
+        current one) without affecting the rest of the batch. The group
+        memberships of the whole batch are written with the batch commit, and
+        the touched datasets are indexed together after it. Deletions, whose
+        action always commits, are applied afterwards.
+
+        Returns a dict with the number of objects per report status.
+        '''
+        report = {'added': 0, 'updated': 0, 'not modified': 0,
+                  'deleted': 0, 'errored': 0}
+        if not harvest_objects:
+            return report
+
+        to_delete = [obj for obj in harvest_objects
+                     if self._get_object_extra(obj, 'status') == 'delete']
+        to_import = [obj for obj in harvest_objects if obj not in to_delete]
+        stats = self._get_stats()
+        guids = [obj.guid for obj in to_import]
+
+        previous_objects = {}
+        existing_datasets = {}
+        if guids:
+            # Lock the guids before reading their current objects and
+            # datasets, so that no other import changes them in between
+            self._lock_guids(guids)
+            previous_objects = dict(
+                (obj.guid, obj) for obj in
+                model.Session.query(HarvestObject)
+                .filter(HarvestObject.guid.in_(guids))
+                .filter(HarvestObject.current == True))
+            existing_datasets = dict(
+                model.Session.query(model.PackageExtra.value, model.Package.id)
+                .select_from(model.Package)
+                .join(model.PackageExtra)
+                .filter(model.PackageExtra.key == 'guid')
+                .filter(model.PackageExtra.value.in_(guids))
+                .filter(model.Package.state == 'active'))
+
+        # Index the datasets of the batch once, after the batch commit
+        with self._deferred_index.suppressed():
+            self._batch_errors = []
+            self._batch_members = []
+            try:
+                for harvest_object in to_import:
+                    stats.start_object(harvest_object.harvest_job_id)
+                    status = self._import_batch_object(
+                        harvest_object, previous_objects, existing_datasets)
+                    report[status] += 1
+                    stats.finish_object()
+                members = self._batch_members
+            finally:
+                self._batch_errors = None
+                self._batch_members = None
+
+            # Commits the batch
+            with stats.stage('commit'):
+                self._apply_memberships(members)
+        indexed = [obj for obj in to_import if obj.state == 'COMPLETE'
+                   and obj.report_status != 'not modified']
+        with stats.stage('index'):
+            if not self._flush_index(indexed):
+                for harvest_object in indexed:
+                    report[harvest_object.report_status] -= 1
+                    report['errored'] += 1
+                    harvest_object.state = 'ERROR'
+                    harvest_object.report_status = 'errored'
+                model.Session.commit()
+        stats.write()
+
+        for harvest_object in to_delete:
+            harvest_object.import_started = datetime.datetime.utcnow()
+            result = self._import_object(harvest_object)
+            harvest_object.import_finished = datetime.datetime.utcnow()
+            harvest_object.state = 'COMPLETE' if result else 'ERROR'
+            harvest_object.report_status = 'deleted' if result else 'errored'
+            report[harvest_object.report_status] += 1
+            harvest_object.save()
+
+        return report
+
+    def _import_batch_object(self, harvest_object, previous_objects,
+                             existing_datasets):
+        '''
+        Imports one object of a batch inside a savepoint and returns its
+        report status
+        '''
+        harvest_object.import_started = datetime.datetime.utcnow()
+        updated = harvest_object.guid in existing_datasets
+
+        members_count = len(self._batch_members)
+        index_checkpoint = self._deferred_index.checkpoint()
+        savepoint = model.Session.begin_nested()
+        try:
+            result = self._import_object(
+                harvest_object, previous_objects, existing_datasets,
+                commit=False)
+        except Exception as e:
+            self._save_object_error('Error importing object {0}: {1!r}'.format(
+                harvest_object.id, e), harvest_object, 'Import')
+            result = False
+
+        if result:
+            savepoint.commit()
+            previous_objects[harvest_object.guid] = harvest_object
+            if harvest_object.package_id:
+                existing_datasets[harvest_object.guid] = \
+                    harvest_object.package_id
+        else:
+            savepoint.rollback()
+            del self._batch_members[members_count:]
+            # A dataset created inside the savepoint no longer exists
+            self._deferred_index.rollback(index_checkpoint)
+
+        for message, obj, stage, line in self._batch_errors:
+            model.Session.add(HarvestObjectError(
+                message=message, object=obj, stage=stage, line=line))
+        del self._batch_errors[:]
+
+        harvest_object.import_finished = datetime.datetime.utcnow()
+        if not result:
+            harvest_object.state = 'ERROR'
+            harvest_object.report_status = 'errored'
+        else:
+            harvest_object.state = 'COMPLETE'
+            if result == 'unchanged':
+                harvest_object.report_status = 'not modified'
+            elif updated:
+                harvest_object.report_status = 'updated'
+            else:
+                harvest_object.report_status = 'added'
+        harvest_object.add()
+        return harvest_object.report_status
+
+    def _lock_guid(self, guid):
+        '''
+        Takes a transaction-level advisory lock on the guid, released on
+        commit or rollback
+        '''
+        model.Session.execute('SELECT pg_advisory_xact_lock(hashtext(:guid))',
+                              {'guid': guid})
+
+    def _lock_guids(self, guids):
+        '''
+        Takes the advisory locks of several guids at once, in the order of
+        their lock keys so that concurrent batches never deadlock
+        '''
+        model.Session.execute(
+            'SELECT pg_advisory_xact_lock(key) FROM '
+            '(SELECT DISTINCT hashtext(guid) AS key '
+            'FROM unnest(CAST(:guids AS text[])) AS guid ORDER BY key) keys',
+            {'guids': list(set(guids))})
+
+    def _import_object(self, harvest_object, previous_objects=None,
+                       existing_datasets=None, commit=True):
+        '''
+        Imports a single harvest object.
+
+        `previous_objects` and `existing_datasets` map guids to the current
+        harvest object and to the id of the existing dataset. When they are
+        not provided they are queried for this object. With `commit=False`
+        the changes are left on the session for the caller to commit.
+        '''
         status = self._get_object_extra(harvest_object, 'status')
         if status == 'delete':
             # Delete package
@@ -97,18 +637,33 @@ class GOBCANHarvester(DCATRDFHarvester):
                                     harvest_object, 'Import')
             return False
 
+        stats = self._get_stats()
+
         try:
-            dataset = json.loads(harvest_object.content)
+            with stats.stage('parse'):
+                dataset = json.loads(harvest_object.content)
         except ValueError:
             self._save_object_error('Could not parse content for object {0}'.format(harvest_object.id),
                                     harvest_object, 'Import')
             return False
 
+        # Serialize the current flag handling of objects with the same guid
+        # across concurrent fetch consumers and import workers
+        self._lock_guid(harvest_object.guid)
+
         # Get the last harvested object (if any)
-        previous_object = model.Session.query(HarvestObject) \
-                                       .filter(HarvestObject.guid == harvest_object.guid) \
-                                       .filter(HarvestObject.current == True) \
-                                       .first()
+        with stats.stage('previous_object'):
+            if previous_objects is None:
+                previous_object = model.Session.query(HarvestObject) \
+                                               .filter(HarvestObject.guid == harvest_object.guid) \
+                                               .filter(HarvestObject.current == True) \
+                                               .first()
+            else:
+                previous_object = previous_objects.get(harvest_object.guid)
+
+            fingerprint = dataset_fingerprint(dataset)
+            unchanged = self._is_unchanged(
+                harvest_object, previous_object, fingerprint)
 
         # Flag previous object as not current anymore
         if previous_object:
@@ -117,18 +672,42 @@ class GOBCANHarvester(DCATRDFHarvester):
 
         # Flag this object as the current one
         harvest_object.current = True
+        harvest_object.extras.append(
+            HarvestObjectExtra(key='fingerprint', value=fingerprint))
         harvest_object.add()
 
+        if unchanged:
+            # Same content as the last successful import, leave the package
+            # and the search index untouched
+            harvest_object.package_id = previous_object.package_id
+            harvest_object.add()
+            if commit:
+                with stats.stage('commit'):
+                    model.Session.commit()
+            log.info('Skipping unchanged dataset with guid %s' %
+                     harvest_object.guid)
+            return 'unchanged'
+
         context = {
             'user': self._get_user_name(),
             'return_id_only': True,
             'ignore_auth': True,
+            'defer_commit': not commit,
         }
 
-        dataset = self.modify_package_dict(dataset, {}, harvest_object)
+        with stats.stage('modify_package_dict'):
+            dataset = self.modify_package_dict(dataset, {}, harvest_object)
 
         # Check if a dataset with the same guid exists
-        existing_dataset = self._get_existing_dataset(harvest_object.guid)
+        with stats.stage('get_existing_dataset'):
+            if existing_datasets is None:
+                existing_dataset = self._get_existing_dataset(
+                    harvest_object.guid)
+            elif harvest_object.guid in existing_datasets:
+                existing_dataset = p.toolkit.get_action('package_show')(
+                    {}, {'id': existing_datasets[harvest_object.guid]})
+            else:
+                existing_dataset = None
 
         try:
             if existing_dataset:
@@ -147,22 +726,26 @@ class GOBCANHarvester(DCATRDFHarvester):
                     if res_uri and res_uri in resource_mapping:
                         resource['id'] = resource_mapping[res_uri]
 
-                for harvester in p.PluginImplementations(IDCATRDFHarvester):
-                    harvester.before_update(
-                        harvest_object, dataset, harvester_tmp_dict)
+                with stats.stage('before_hooks'):
+                    for harvester in p.PluginImplementations(IDCATRDFHarvester):
+                        harvester.before_update(
+                            harvest_object, dataset, harvester_tmp_dict)
 
                 try:
                     if dataset:
 
-                        self._set_organization(
-                            harvest_object, context, dataset)
+                        with stats.stage('set_organization'):
+                            self._set_organization(
+                                harvest_object, context, dataset)
 
                         # Save reference to the package on the object
                         harvest_object.package_id = dataset['id']
                         harvest_object.add()
 
-                        p.toolkit.get_action(
-                            'package_update')(context, dataset)
+                        with stats.stage('package_update'):
+                            p.toolkit.get_action(
+                                'package_update')(context, dataset)
+                        self._deferred_index.add(dataset['id'])
                     else:
                         log.info('Ignoring dataset %s' %
                                  existing_dataset['name'])
@@ -172,17 +755,22 @@ class GOBCANHarvester(DCATRDFHarvester):
                         e.error_summary), harvest_object, 'Import')
                     return False
 
-                for harvester in p.PluginImplementations(IDCATRDFHarvester):
-                    err = harvester.after_update(
-                        harvest_object, dataset, harvester_tmp_dict)
-
-                    if err:
-                        self._save_object_error(
-                            'RDFHarvester plugin error: %s' % err, harvest_object, 'Import')
-                        return False
+                err = None
+                with stats.stage('after_hooks'):
+                    for harvester in p.PluginImplementations(IDCATRDFHarvester):
+                        err = harvester.after_update(
+                            harvest_object, dataset, harvester_tmp_dict)
+                        if err:
+                            break
+                if err:
+                    self._save_object_error(
+                        'RDFHarvester plugin error: %s' % err, harvest_object, 'Import')
+                    return False
                 log.info('Updated dataset %s' % dataset['name'])
 
-                self._add_dataset_to_group(dataset, context, harvest_object)
+                with stats.stage('add_dataset_to_group'):
+                    self._add_dataset_to_group(
+                        dataset, context, harvest_object)
 
             else:
                 package_plugin = lib_plugins.lookup_package_plugin(
@@ -198,15 +786,17 @@ class GOBCANHarvester(DCATRDFHarvester):
                 harvester_tmp_dict = {}
 
                 name = dataset['name']
-                for harvester in p.PluginImplementations(IDCATRDFHarvester):
-                    harvester.before_create(
-                        harvest_object, dataset, harvester_tmp_dict)
+                with stats.stage('before_hooks'):
+                    for harvester in p.PluginImplementations(IDCATRDFHarvester):
+                        harvester.before_create(
+                            harvest_object, dataset, harvester_tmp_dict)
 
                 try:
                     if dataset:
 
-                        self._set_organization(
-                            harvest_object, context, dataset)
+                        with stats.stage('set_organization'):
+                            self._set_organization(
+                                harvest_object, context, dataset)
 
                         # Save reference to the package on the object
                         harvest_object.package_id = dataset['id']
@@ -219,8 +809,10 @@ class GOBCANHarvester(DCATRDFHarvester):
                             'SET CONSTRAINTS harvest_object_package_id_fkey DEFERRED')
                         model.Session.flush()
 
-                        p.toolkit.get_action(
-                            'package_create')(context, dataset)
+                        with stats.stage('package_create'):
+                            p.toolkit.get_action(
+                                'package_create')(context, dataset)
+                        self._deferred_index.add(dataset['id'])
                     else:
                         log.info('Ignoring dataset %s' % name)
                         return 'unchanged'
@@ -229,19 +821,23 @@ class GOBCANHarvester(DCATRDFHarvester):
                         e.error_summary), harvest_object, 'Import')
                     return False
 
-                for harvester in p.PluginImplementations(IDCATRDFHarvester):
-                    err = harvester.after_create(
-                        harvest_object, dataset, harvester_tmp_dict)
-
-                    if err:
-                        self._save_object_error(
-                            'RDFHarvester plugin error: %s' % err, harvest_object, 'Import')
-                        return False
+                err = None
+                with stats.stage('after_hooks'):
+                    for harvester in p.PluginImplementations(IDCATRDFHarvester):
+                        err = harvester.after_create(
+                            harvest_object, dataset, harvester_tmp_dict)
+                        if err:
+                            break
+                if err:
+                    self._save_object_error(
+                        'RDFHarvester plugin error: %s' % err, harvest_object, 'Import')
+                    return False
 
                 log.info('Created dataset %s' % dataset['name'])
 
-                self._add_dataset_to_group(
-                    dataset, context, harvest_object)
+                with stats.stage('add_dataset_to_group'):
+                    self._add_dataset_to_group(
+                        dataset, context, harvest_object)
 
         except Exception as e:
             self._save_object_error('Error importing dataset %s: %r / %s' % (
@@ -249,6 +845,8 @@ class GOBCANHarvester(DCATRDFHarvester):
             return False
 
         finally:
-            model.Session.commit()
+            if commit:
+                with stats.stage('commit'):
+                    model.Session.commit()
 
         return True
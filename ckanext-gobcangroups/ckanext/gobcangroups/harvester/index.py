@@ -0,0 +1,83 @@
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+def _search_extras(extras, key):
+    return [extra['value'] for extra in extras or []
+            if extra.get('key') == key and extra.get('value')]
+
+
+class GroupIndex(object):
+    '''
+    Index of the value of a group extra (``skos_nti`` for groups, ``dir3``
+    for organizations) and the ids of the groups holding it.
+
+    It is built once from the ``group_list``/``organization_list`` output so
+    each dataset lookup is a scan of the collected values instead of an
+    action call. A group matches when one of its values is contained in the
+    harvested value, as the harvester has always matched them.
+    '''
+
+    def __init__(self, groups, extra_key):
+        self.extra_key = extra_key
+        self._entries = []
+        for group in groups:
+            for value in _search_extras(group.get('extras'), extra_key):
+                if (value, group['id']) not in self._entries:
+                    self._entries.append((value, group['id']))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, value):
+        '''
+        Returns the ids of the groups with a value contained in a harvested
+        extra value, in the order of the group list
+        '''
+        group_ids = []
+        if not value:
+            return group_ids
+        for group_value, group_id in self._entries:
+            if group_value in value and group_id not in group_ids:
+                group_ids.append(group_id)
+        return group_ids
+
+    def lookup_first(self, value):
+        group_ids = self.lookup(value)
+        if group_ids:
+            return group_ids[0]
+
+
+class HarvestJobIndexes(object):
+    '''
+    Holds the group and organization indexes for the harvest job being
+    imported. They are built lazily for the first object of a job, reused for
+    the rest of its objects and dropped when a new job starts or the groups
+    change.
+    '''
+
+    def __init__(self):
+        self.harvest_job_id = None
+        self.groups = None
+        self.organizations = None
+
+    def get(self, harvest_job_id, build_groups, build_organizations):
+        if harvest_job_id != self.harvest_job_id:
+            self.invalidate()
+            self.harvest_job_id = harvest_job_id
+
+        if self.groups is None:
+            self.groups = GroupIndex(build_groups(), 'skos_nti')
+            log.debug('Built skos_nti index with %d entries for job %s',
+                      len(self.groups), harvest_job_id)
+        if self.organizations is None:
+            self.organizations = GroupIndex(build_organizations(), 'dir3')
+            log.debug('Built dir3 index with %d entries for job %s',
+                      len(self.organizations), harvest_job_id)
+        return self.groups, self.organizations
+
+    def invalidate(self):
+        self.groups = None
+        self.organizations = None
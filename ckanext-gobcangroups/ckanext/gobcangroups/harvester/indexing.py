@@ -0,0 +1,103 @@
+import logging
+import threading
+import contextlib
+
+import ckan.lib.search as search
+import ckan.plugins.toolkit as toolkit
+
+
+log = logging.getLogger(__name__)
+
+AUTOMATIC_INDEXING = 'ckan.search.automatic_indexing'
+
+
+class AutomaticIndexing(object):
+    '''
+    Value of ``ckan.search.automatic_indexing`` that is false only in the
+    threads suppressing the indexing, so that the other threads of the
+    process keep the configured behaviour. CKAN reads the setting with
+    `asbool`, which falls back to the truth value of non-string values.
+    '''
+
+    def __init__(self, value):
+        self.value = toolkit.asbool(value)
+        self._local = threading.local()
+
+    @property
+    def depth(self):
+        return getattr(self._local, 'depth', 0)
+
+    @depth.setter
+    def depth(self, value):
+        self._local.depth = value
+
+    def __bool__(self):
+        return self.value and not self.depth
+
+    def __str__(self):
+        return str(bool(self))
+
+
+_install_lock = threading.Lock()
+
+
+def automatic_indexing():
+    '''Returns the thread-aware automatic indexing setting, installing it'''
+    with _install_lock:
+        value = toolkit.config.get(AUTOMATIC_INDEXING, True)
+        if not isinstance(value, AutomaticIndexing):
+            value = AutomaticIndexing(value)
+            toolkit.config[AUTOMATIC_INDEXING] = value
+        return value
+
+
+class DeferredIndex(object):
+    '''
+    Suppresses the synchronous search indexing of CKAN in the importing
+    thread and collects the ids of the packages that were touched, so that
+    each of them is indexed once, with a single Solr commit, when the index
+    is flushed.
+
+    Ids are also kept in the order they were first added, so the ones added
+    inside a savepoint can be dropped with `rollback` if it is rolled back.
+    '''
+
+    def __init__(self):
+        self.package_ids = set()
+        self._added = []
+
+    @contextlib.contextmanager
+    def suppressed(self):
+        setting = automatic_indexing()
+        setting.depth += 1
+        try:
+            yield self
+        finally:
+            setting.depth -= 1
+
+    def add(self, package_id):
+        if package_id not in self.package_ids:
+            self.package_ids.add(package_id)
+            self._added.append(package_id)
+
+    def update(self, package_ids):
+        for package_id in package_ids:
+            self.add(package_id)
+
+    def checkpoint(self):
+        '''Returns the marker `rollback` drops the ids added after'''
+        return len(self._added)
+
+    def rollback(self, checkpoint):
+        for package_id in self._added[checkpoint:]:
+            self.package_ids.discard(package_id)
+        del self._added[checkpoint:]
+
+    def flush(self):
+        if not self.package_ids:
+            return
+        package_ids = sorted(self.package_ids)
+        self.package_ids.clear()
+        del self._added[:]
+        log.debug('Indexing %d harvested datasets', len(package_ids))
+        search.rebuild(package_ids=package_ids)
@@ -0,0 +1,153 @@
+import os
+import glob
+import json
+import time
+import logging
+import contextlib
+
+
+log = logging.getLogger(__name__)
+
+# Import stages in the order they run, used to sort the summary table
+STAGES = ['parse', 'previous_object', 'modify_package_dict',
+          'get_existing_dataset', 'before_hooks', 'set_organization',
+          'package_create', 'package_update', 'after_hooks',
+          'add_dataset_to_group', 'commit', 'index']
+
+
+class QueryCounter(object):
+    '''Counts the SQL statements executed on an engine while attached'''
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _before_cursor_execute(self, *args, **kwargs):
+        self.count += 1
+
+    def attach(self):
+        from sqlalchemy import event
+        event.listen(self.engine, 'before_cursor_execute',
+                     self._before_cursor_execute)
+
+    def detach(self):
+        from sqlalchemy import event
+        event.remove(self.engine, 'before_cursor_execute',
+                     self._before_cursor_execute)
+
+    @contextlib.contextmanager
+    def attached(self):
+        self.attach()
+        try:
+            yield self
+        finally:
+            self.detach()
+
+
+class ImportStats(object):
+    '''
+    Aggregates the time and the SQL queries spent in each import stage per
+    harvest job.
+
+    Every process writes its totals to ``<directory>/<job id>.<pid>.json``
+    each `write_every` objects, after objects finished with ``write=True``
+    and when it moves on to another job, and `load_report` merges the files
+    of a job. Nothing is measured while `directory` is not set.
+    '''
+
+    def __init__(self, directory=None, write_every=100):
+        self.directory = directory
+        self.write_every = write_every
+        self.job_id = None
+        self.objects = 0
+        self.stages = {}
+        self._queries = None
+
+    def configure(self, directory, engine):
+        self.directory = directory
+        if directory and self._queries is None:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self._queries = QueryCounter(engine)
+            self._queries.attach()
+
+    @property
+    def enabled(self):
+        return bool(self.directory) and self._queries is not None
+
+    def start_object(self, job_id):
+        if not self.enabled:
+            return
+        if job_id != self.job_id:
+            self.write()
+            self.job_id = job_id
+            self.objects = 0
+            self.stages = {}
+
+    def finish_object(self, write=False):
+        if not self.enabled:
+            return
+        self.objects += 1
+        if write or self.objects % self.write_every == 0:
+            self.write()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        start, queries = time.time(), self._queries.count
+        try:
+            yield
+        finally:
+            totals = self.stages.setdefault(
+                name, {'calls': 0, 'seconds': 0.0, 'queries': 0})
+            totals['calls'] += 1
+            totals['seconds'] += time.time() - start
+            totals['queries'] += self._queries.count - queries
+
+    def write(self):
+        if not self.enabled or self.job_id is None:
+            return
+        path = os.path.join(self.directory, '{0}.{1}.json'.format(
+            self.job_id, os.getpid()))
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'job_id': self.job_id, 'objects': self.objects,
+                       'stages': self.stages}, f)
+        os.replace(path + '.tmp', path)
+
+
+def load_report(directory, job_id):
+    '''Merges the stats written by every process for a harvest job'''
+    report = {'job_id': job_id, 'objects': 0, 'stages': {}}
+    for path in glob.glob(os.path.join(directory, '{0}.*.json'.format(job_id))):
+        with open(path) as f:
+            stats = json.load(f)
+        report['objects'] += stats['objects']
+        for name, totals in stats['stages'].items():
+            merged = report['stages'].setdefault(
+                name, {'calls': 0, 'seconds': 0.0, 'queries': 0})
+            for key in merged:
+                merged[key] += totals[key]
+    return report
+
+
+def format_report(report):
+    '''Returns the report as a plain text table, one row per stage'''
+    def order(name):
+        return (STAGES.index(name) if name in STAGES else len(STAGES), name)
+
+    total_seconds = sum(totals['seconds']
+                        for totals in report['stages'].values()) or 1.0
+    lines = ['Harvest job {0}: {1} objects'.format(
+                 report['job_id'], report['objects']),
+             '{0:<22} {1:>8} {2:>10} {3:>6} {4:>9} {5:>9}'.format(
+                 'stage', 'calls', 'seconds', '%', 'ms/call', 'queries')]
+    for name in sorted(report['stages'], key=order):
+        totals = report['stages'][name]
+        lines.append('{0:<22} {1:>8} {2:>10.2f} {3:>6.1f} {4:>9.2f} {5:>9}'.format(
+            name, totals['calls'], totals['seconds'],
+            100.0 * totals['seconds'] / total_seconds,
+            1000.0 * totals['seconds'] / totals['calls'] if totals['calls'] else 0,
+            totals['queries']))
+    return '\n'.join(lines)
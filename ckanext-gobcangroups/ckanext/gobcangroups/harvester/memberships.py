@@ -0,0 +1,56 @@
+import logging
+
+import ckan.model as model
+
+
+log = logging.getLogger(__name__)
+
+
+def add_memberships(pairs, capacity='public'):
+    '''
+    Makes each dataset a member of its groups with a single query for the
+    existing memberships and one insert for the missing ones.
+
+    `pairs` is an iterable of (group id, package id) tuples. Active
+    memberships are left untouched and deleted ones are reactivated. The
+    changes are added to the session but not committed.
+
+    Returns the set of package ids whose memberships changed.
+    '''
+    pairs = set(pairs)
+    if not pairs:
+        return set()
+
+    group_ids = set(group_id for group_id, _ in pairs)
+    package_ids = set(package_id for _, package_id in pairs)
+
+    existing = {}
+    for member in model.Session.query(model.Member) \
+            .filter(model.Member.table_name == 'package') \
+            .filter(model.Member.group_id.in_(group_ids)) \
+            .filter(model.Member.table_id.in_(package_ids)):
+        existing[(member.group_id, member.table_id)] = member
+
+    changed = set()
+    new_members = []
+    reactivated = 0
+    for group_id, package_id in sorted(pairs):
+        member = existing.get((group_id, package_id))
+        if member is None:
+            new_members.append(model.Member(table_name='package',
+                                            table_id=package_id,
+                                            group_id=group_id,
+                                            capacity=capacity,
+                                            state='active'))
+        elif member.state != 'active' or member.capacity != capacity:
+            member.state = 'active'
+            member.capacity = capacity
+            reactivated += 1
+        else:
+            continue
+        changed.add(package_id)
+
+    model.Session.add_all(new_members)
+    log.debug('Added %d and reactivated %d group memberships',
+              len(new_members), reactivated)
+    return changed
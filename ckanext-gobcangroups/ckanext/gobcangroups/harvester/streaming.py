@@ -0,0 +1,87 @@
+import logging
+from xml.etree import ElementTree
+
+
+log = logging.getLogger(__name__)
+
+RDF = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'
+DCAT = 'http://www.w3.org/ns/dcat#'
+HYDRA = 'http://www.w3.org/ns/hydra/core#'
+
+RDF_ROOT = '{%s}RDF' % RDF
+RDF_DESCRIPTION = '{%s}Description' % RDF
+RDF_TYPE = '{%s}type' % RDF
+RDF_RESOURCE = '{%s}resource' % RDF
+DCAT_DATASET = '{%s}Dataset' % DCAT
+HYDRA_NEXT = ('{%s}next' % HYDRA, '{%s}nextPage' % HYDRA)
+
+
+def _is_dataset(element):
+    if element.tag == DCAT_DATASET:
+        return True
+    if element.tag == RDF_DESCRIPTION:
+        for child in element.findall(RDF_TYPE):
+            if child.get(RDF_RESOURCE) == DCAT + 'Dataset':
+                return True
+    return False
+
+
+class DatasetStream(object):
+    '''
+    Splits an RDF/XML catalogue into one standalone RDF/XML document per
+    dcat:Dataset while it is being read.
+
+    Only the element of the dataset being parsed is kept in memory: each
+    dataset is detached from the tree once it has been emitted, so peak
+    memory does not depend on the size of the catalogue. Datasets must be
+    described inline (distributions nested in the dataset element), as done
+    by the ckanext-dcat RDF/XML serializer. The hydra next page of the
+    catalogue, if any, is available in `next_page` once the stream has been
+    consumed.
+    '''
+
+    def __init__(self, source):
+        self.source = source
+        self.next_page = None
+
+    def __iter__(self):
+        stack = []
+        # Dataset elements currently open, nested datasets are emitted as
+        # part of their parent
+        open_datasets = 0
+        for event, element in ElementTree.iterparse(
+                self.source, events=('start', 'end')):
+            if event == 'start':
+                stack.append(element)
+                if element.tag == DCAT_DATASET:
+                    open_datasets += 1
+                continue
+
+            stack.pop()
+            parent = stack[-1] if stack else None
+
+            if element.tag in HYDRA_NEXT:
+                self.next_page = element.get(RDF_RESOURCE) or \
+                    (element.text or '').strip() or None
+
+            if element.tag == DCAT_DATASET:
+                open_datasets -= 1
+
+            if open_datasets == 0 and _is_dataset(element):
+                yield self._document(element)
+                element.clear()
+                if parent is not None:
+                    parent.remove(element)
+            elif parent is not None and open_datasets == 0 and (
+                    len(stack) == 1 or
+                    (len(stack) == 2 and parent.tag != RDF_DESCRIPTION)):
+                # Drop processed top level nodes and catalogue properties
+                # (e.g. the dcat:dataset wrappers) so they do not pile up.
+                # Properties of a top level rdf:Description are kept until
+                # it is known whether it describes a dataset.
+                parent.remove(element)
+
+    def _document(self, element):
+        root = ElementTree.Element(RDF_ROOT)
+        root.append(element)
+        return ElementTree.tostring(root, encoding='utf-8')
@@ -1,13 +1,21 @@
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
 
+from ckanext.gobcangroups import cli
+
 
 class GobcangroupsPlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.IConfigurer)
+    plugins.implements(plugins.IClick)
 
     # IConfigurer
 
     def update_config(self, config_):
         toolkit.add_template_directory(config_, 'templates')
         toolkit.add_public_directory(config_, 'public')
-        toolkit.add_resource('fanstatic', 'gobcangroups')
\ No newline at end of file
+        toolkit.add_resource('fanstatic', 'gobcangroups')
+
+    # IClick
+
+    def get_commands(self):
+        return cli.get_commands()
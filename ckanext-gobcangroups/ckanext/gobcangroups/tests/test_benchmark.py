@@ -0,0 +1,33 @@
+"""Tests for benchmark.py."""
+import io
+from xml.etree import ElementTree
+
+from ckanext.gobcangroups.benchmark import generate_catalogue, percentile
+
+DCAT = '{http://www.w3.org/ns/dcat#}'
+
+
+def test_generate_catalogue():
+    out = io.StringIO()
+    generate_catalogue(out, datasets=20, themes=3, publishers=2, distributions=3)
+    root = ElementTree.fromstring(out.getvalue())
+    datasets = root.findall('.//{0}Dataset'.format(DCAT))
+    assert len(datasets) == 20
+    assert len(root.findall('.//{0}Distribution'.format(DCAT))) == 60
+    themes = set(theme.get('{http://www.w3.org/1999/02/22-rdf-syntax-ns#}resource')
+                 for theme in root.iter('{0}theme'.format(DCAT)))
+    assert len(themes) <= 3
+
+
+def test_generate_catalogue_is_deterministic():
+    a, b = io.StringIO(), io.StringIO()
+    generate_catalogue(a, datasets=5, seed=1)
+    generate_catalogue(b, datasets=5, seed=1)
+    assert a.getvalue() == b.getvalue()
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 0.5) == 50
+    assert percentile(values, 0.99) == 99
+    assert percentile([], 0.5) is None
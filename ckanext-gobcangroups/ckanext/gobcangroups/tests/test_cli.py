@@ -0,0 +1,36 @@
+"""Tests for cli.py, run against the CKAN database."""
+import pytest
+
+from ckanext.harvest import model as harvest_model
+from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.tests import factories as harvest_factories
+
+from ckanext.gobcangroups import cli
+
+
+@pytest.fixture
+def harvest_job(clean_db):
+    harvest_model.setup()
+    source = harvest_factories.HarvestSourceObj(
+        url='http://example.com/catalog.rdf', source_type='gobcan_harvester',
+        config='{"batch_import": true}')
+    return harvest_factories.HarvestJobObj(source=source)
+
+
+def test_claim_and_release_batch(harvest_job):
+    waiting = harvest_factories.HarvestObjectObj(
+        job=harvest_job, guid='waiting', state='WAITING')
+    taken = harvest_factories.HarvestObjectObj(
+        job=harvest_job, guid='taken', state='IMPORT')
+    ids = [waiting.id, taken.id]
+
+    claimed = cli._claim_batch(ids)
+
+    assert [obj.id for obj in claimed] == [waiting.id]
+    assert HarvestObject.get(waiting.id).state == 'IMPORT'
+    assert cli._claim_batch(ids) == []
+
+    cli._release_batch([waiting.id])
+
+    assert HarvestObject.get(waiting.id).state == 'WAITING'
+    assert HarvestObject.get(taken.id).state == 'IMPORT'
@@ -0,0 +1,14 @@
+"""Tests for harvester/fingerprint.py."""
+from ckanext.gobcangroups.harvester.fingerprint import dataset_fingerprint
+
+
+def test_fingerprint_ignores_key_order():
+    a = {'title': 'Paro', 'extras': [{'key': 'theme', 'value': 'empleo'}]}
+    b = {'extras': [{'value': 'empleo', 'key': 'theme'}], 'title': 'Paro'}
+    assert dataset_fingerprint(a) == dataset_fingerprint(b)
+
+
+def test_fingerprint_detects_changes():
+    a = {'title': 'Paro', 'resources': [{'url': 'a'}, {'url': 'b'}]}
+    b = {'title': 'Paro', 'resources': [{'url': 'b'}, {'url': 'a'}]}
+    assert dataset_fingerprint(a) != dataset_fingerprint(b)
@@ -0,0 +1,171 @@
+"""Tests for harvester/gobcanharvester.py, run against the CKAN database."""
+import datetime
+
+import pytest
+
+import ckan.model as model
+import ckan.plugins as p
+
+from ckanext.harvest import model as harvest_model
+from ckanext.harvest.model import (HarvestObject, HarvestObjectError,
+                                   HarvestObjectExtra)
+from ckanext.harvest.tests import factories as harvest_factories
+
+
+@pytest.fixture
+def harvest_tables(clean_db):
+    harvest_model.setup()
+
+
+@pytest.fixture
+def harvest_job(harvest_tables):
+    source = harvest_factories.HarvestSourceObj(
+        url='http://example.com/catalog.rdf', source_type='gobcan_harvester')
+    return harvest_factories.HarvestJobObj(source=source)
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'harvest gobcan_harvester')
+@pytest.mark.usefixtures('with_plugins')
+def test_save_streamed_objects(harvest_job):
+    harvester = p.get_plugin('gobcan_harvester')
+    pending = [harvester._streamed_object(
+        'guid-{0}'.format(number), harvest_job,
+        {'name': 'dataset-{0}'.format(number), 'extras': []},
+        '2021-03-01T00:00:00') for number in range(3)]
+
+    object_ids = harvester._save_gathered(pending, harvest_job)
+
+    assert len(object_ids) == 3
+    assert pending == []
+    for object_id in object_ids:
+        harvest_object = HarvestObject.get(object_id)
+        assert harvest_object.harvest_job_id == harvest_job.id
+        assert harvest_object.harvest_source_id == harvest_job.source_id
+        assert harvester._get_object_extra(
+            harvest_object, 'modified') == '2021-03-01T00:00:00'
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'harvest gobcan_harvester')
+@pytest.mark.usefixtures('with_plugins')
+def test_rolled_back_batch_object_is_not_indexed(harvest_job, monkeypatch):
+    harvester = p.get_plugin('gobcan_harvester')
+    harvest_object = harvest_factories.HarvestObjectObj(
+        job=harvest_job, guid='guid-1', content='{}')
+
+    def import_object(harvest_object, *args, **kwargs):
+        # A dataset created before a later step of the import fails
+        harvester._deferred_index.add('rolled-back-dataset')
+        return False
+
+    monkeypatch.setattr(harvester, '_import_object', import_object)
+    harvester._batch_errors, harvester._batch_members = [], []
+    try:
+        status = harvester._import_batch_object(harvest_object, {}, {})
+    finally:
+        harvester._batch_errors = harvester._batch_members = None
+
+    assert status == 'errored'
+    assert 'rolled-back-dataset' not in harvester._deferred_index.package_ids
+
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'harvest gobcan_harvester')
+@pytest.mark.usefixtures('with_plugins')
+def test_batch_locks_guids_before_reading_them(harvest_job, monkeypatch):
+    harvester = p.get_plugin('gobcan_harvester')
+    harvest_objects = [harvest_factories.HarvestObjectObj(
+        job=harvest_job, guid=guid, content='{}') for guid in ('b', 'a', 'b')]
+    calls = []
+    lock_guids = harvester._lock_guids
+
+    def record_lock(guids):
+        calls.append(('lock', sorted(set(guids))))
+        lock_guids(guids)
+
+    def import_batch_object(harvest_object, previous_objects,
+                            existing_datasets):
+        calls.append(('import', harvest_object.guid))
+        return 'errored'
+
+    monkeypatch.setattr(harvester, '_lock_guids', record_lock)
+    monkeypatch.setattr(harvester, '_import_batch_object', import_batch_object)
+    harvester.import_objects(harvest_objects)
+
+    assert calls == [('lock', ['a', 'b']), ('import', 'b'), ('import', 'a'),
+                     ('import', 'b')]
+
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'harvest gobcan_harvester')
+@pytest.mark.usefixtures('with_plugins')
+def test_indexing_error_is_saved_as_object_error(harvest_job, monkeypatch):
+    harvester = p.get_plugin('gobcan_harvester')
+    harvest_object = harvest_factories.HarvestObjectObj(
+        job=harvest_job, guid='guid-1', content='{}')
+
+    def import_object(harvest_object, *args, **kwargs):
+        harvester._deferred_index.add('imported-dataset')
+        return True
+
+    def rebuild(*args, **kwargs):
+        raise RuntimeError('Solr is down')
+
+    monkeypatch.setattr(harvester, '_import_object', import_object)
+    monkeypatch.setattr(
+        'ckanext.gobcangroups.harvester.indexing.search.rebuild', rebuild)
+
+    assert harvester.import_stage(harvest_object) is False
+    errors = model.Session.query(HarvestObjectError) \
+        .filter(HarvestObjectError.harvest_object_id == harvest_object.id)
+    assert 'Solr is down' in errors.one().message
+
+
+def _imported_object(job, guid, modified, gathered, **kwargs):
+    harvest_object = harvest_factories.HarvestObjectObj(
+        job=job, guid=guid, content='{}', gathered=gathered, **kwargs)
+    harvest_object.extras.append(
+        HarvestObjectExtra(key='modified', value=modified))
+    model.Session.commit()
+    return harvest_object
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'harvest gobcan_harvester')
+@pytest.mark.usefixtures('with_plugins')
+def test_incremental_harvest_retries_failed_import(harvest_job):
+    harvester = p.get_plugin('gobcan_harvester')
+    first_run = datetime.datetime(2021, 3, 1)
+    for guid in ('failed', 'imported'):
+        _imported_object(harvest_job, guid, '2021-01-01T00:00:00', first_run,
+                         state='COMPLETE', current=True,
+                         report_status='added')
+    # The next run failed to import the changed dataset
+    failed_job = harvest_factories.HarvestJobObj(source=harvest_job.source)
+    _imported_object(failed_job, 'failed', '2021-02-01T00:00:00',
+                     first_run + datetime.timedelta(days=1),
+                     state='ERROR', current=False, report_status='errored')
+
+    next_job = harvest_factories.HarvestJobObj(source=harvest_job.source)
+    incremental = harvester._incremental_filter(
+        next_job, {'incremental': True})
+
+    assert not incremental.skip('failed', '2021-01-01T00:00:00')
+    assert incremental.skip('imported', '2021-01-01T00:00:00')
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'harvest gobcan_harvester')
+@pytest.mark.usefixtures('with_plugins')
+def test_incremental_harvest_compares_each_dataset_date(harvest_job):
+    harvester = p.get_plugin('gobcan_harvester')
+    gathered = datetime.datetime(2021, 3, 1)
+    _imported_object(harvest_job, 'older', '2021-01-01', gathered,
+                     state='COMPLETE', current=True, report_status='added')
+    _imported_object(harvest_job, 'newer', '2021-02-01', gathered,
+                     state='COMPLETE', current=True, report_status='added')
+
+    next_job = harvest_factories.HarvestJobObj(source=harvest_job.source)
+    incremental = harvester._incremental_filter(
+        next_job, {'incremental': True})
+
+    # Changed, although still older than the newest date of the source
+    assert not incremental.skip('older', '2021-01-15')
+    assert incremental.skip('newer', '2021-02-01')
@@ -0,0 +1,65 @@
+"""Tests for harvester/index.py."""
+from ckanext.gobcangroups.harvester.index import GroupIndex, HarvestJobIndexes
+
+SECTOR = 'http://datos.gob.es/kos/sector-publico/sector/'
+
+GROUPS = [
+    {'id': 'economia', 'extras': [{'key': 'skos_nti', 'value': SECTOR + 'economia'}]},
+    {'id': 'empleo', 'extras': [{'key': 'skos_nti', 'value': 'empleo'}]},
+    {'id': 'sin-extras', 'extras': []},
+]
+
+
+def test_lookup_theme_list():
+    index = GroupIndex(GROUPS, 'skos_nti')
+    theme = '["{0}economia", "{0}empleo"]'.format(SECTOR)
+    assert index.lookup(theme) == ['economia', 'empleo']
+
+
+def test_lookup_dir3_segment():
+    organizations = [{'id': 'org', 'extras': [{'key': 'dir3', 'value': 'A05003638'}]}]
+    index = GroupIndex(organizations, 'dir3')
+    publisher = 'http://datos.gob.es/recurso/sector-publico/org/Organismo/A05003638'
+    assert index.lookup_first(publisher) == 'org'
+    assert index.lookup_first('http://example.com/A0000000') is None
+
+
+def test_lookup_substring_of_value():
+    groups = [
+        {'id': 'sector', 'extras': [{'key': 'skos_nti', 'value': 'sector-publico/sector/'}]},
+        {'id': 'economia', 'extras': [{'key': 'skos_nti', 'value': 'econom'}]},
+        {'id': 'vacio', 'extras': [{'key': 'skos_nti', 'value': ''}]},
+    ]
+    index = GroupIndex(groups, 'skos_nti')
+    assert index.lookup(SECTOR + 'economia') == ['sector', 'economia']
+    assert index.lookup('empleo') == []
+
+
+def test_lookup_dir3_inside_uri():
+    organizations = [
+        {'id': 'first', 'extras': [{'key': 'dir3', 'value': 'A05003638'}]},
+        {'id': 'second', 'extras': [{'key': 'dir3', 'value': 'A0500'}]},
+    ]
+    index = GroupIndex(organizations, 'dir3')
+    publisher = 'http://datos.gob.es/recurso/sector-publico/org/Organismo/A05003638/'
+    assert index.lookup(publisher) == ['first', 'second']
+    assert index.lookup_first(publisher) == 'first'
+    assert index.lookup_first(None) is None
+
+
+def test_indexes_rebuilt_per_job():
+    calls = []
+
+    def build():
+        calls.append(1)
+        return GROUPS
+
+    indexes = HarvestJobIndexes()
+    indexes.get('job-1', build, build)
+    indexes.get('job-1', build, build)
+    assert len(calls) == 2
+    indexes.get('job-2', build, build)
+    assert len(calls) == 4
+    indexes.invalidate()
+    indexes.get('job-2', build, build)
+    assert len(calls) == 6
@@ -0,0 +1,36 @@
+"""Tests for harvester/indexing.py."""
+import threading
+
+from ckanext.gobcangroups.harvester.indexing import (DeferredIndex,
+                                                     automatic_indexing)
+
+
+def test_rollback_drops_ids_added_after_checkpoint():
+    index = DeferredIndex()
+    index.add('kept')
+    checkpoint = index.checkpoint()
+    index.add('kept')
+    index.add('rolled-back')
+    index.rollback(checkpoint)
+    assert index.package_ids == set(['kept'])
+
+    checkpoint = index.checkpoint()
+    index.update(['other'])
+    index.rollback(checkpoint)
+    assert index.package_ids == set(['kept'])
+
+
+def test_indexing_is_only_suppressed_in_the_importing_thread():
+    index = DeferredIndex()
+    seen = []
+
+    def other_thread():
+        seen.append(bool(automatic_indexing()))
+
+    with index.suppressed():
+        assert not automatic_indexing()
+        thread = threading.Thread(target=other_thread)
+        thread.start()
+        thread.join()
+    assert seen == [True]
+    assert automatic_indexing()
@@ -0,0 +1,54 @@
+"""Tests for harvester/instrumentation.py."""
+from ckanext.gobcangroups.harvester.instrumentation import (
+    ImportStats, load_report, format_report)
+
+
+class FakeQueries(object):
+    count = 0
+
+
+def _stats(directory):
+    stats = ImportStats(str(directory), write_every=2)
+    stats._queries = FakeQueries()
+    return stats
+
+
+def test_stats_per_job(tmpdir):
+    stats = _stats(tmpdir)
+    stats.start_object('job-1')
+    with stats.stage('parse'):
+        stats._queries.count += 3
+    stats.finish_object()
+    stats.start_object('job-1')
+    with stats.stage('parse'):
+        pass
+    stats.finish_object()
+
+    report = load_report(str(tmpdir), 'job-1')
+    assert report['objects'] == 2
+    assert report['stages']['parse']['calls'] == 2
+    assert report['stages']['parse']['queries'] == 3
+    assert 'parse' in format_report(report)
+
+
+def test_stats_disabled_without_directory():
+    stats = ImportStats()
+    stats.start_object('job-1')
+    with stats.stage('parse'):
+        pass
+    stats.finish_object()
+    assert stats.stages == {}
+
+
+def test_stats_written_after_each_object_on_request(tmpdir):
+    stats = ImportStats(str(tmpdir), write_every=100)
+    stats._queries = FakeQueries()
+    stats.start_object('job-1')
+    with stats.stage('parse'):
+        pass
+    stats.finish_object()
+    assert load_report(str(tmpdir), 'job-1')['objects'] == 0
+
+    stats.start_object('job-1')
+    stats.finish_object(write=True)
+    assert load_report(str(tmpdir), 'job-1')['objects'] == 2
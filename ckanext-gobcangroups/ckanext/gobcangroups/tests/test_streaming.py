@@ -0,0 +1,45 @@
+"""Tests for harvester/streaming.py."""
+import io
+from xml.etree import ElementTree
+
+from ckanext.gobcangroups.benchmark import generate_catalogue
+from ckanext.gobcangroups.harvester.streaming import DatasetStream, DCAT_DATASET
+
+FLAT = b'''<?xml version="1.0" encoding="utf-8"?>
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+         xmlns:dct="http://purl.org/dc/terms/"
+         xmlns:hydra="http://www.w3.org/ns/hydra/core#">
+  <rdf:Description rdf:about="http://example.com/dataset/1">
+    <rdf:type rdf:resource="http://www.w3.org/ns/dcat#Dataset"/>
+    <dct:title>Uno</dct:title>
+  </rdf:Description>
+  <rdf:Description rdf:about="http://example.com/other">
+    <dct:title>Otro</dct:title>
+  </rdf:Description>
+  <hydra:PagedCollection rdf:about="http://example.com/catalog.rdf?page=1">
+    <hydra:nextPage>http://example.com/catalog.rdf?page=2</hydra:nextPage>
+  </hydra:PagedCollection>
+</rdf:RDF>
+'''
+
+
+def test_stream_nested_datasets():
+    out = io.StringIO()
+    generate_catalogue(out, datasets=10, distributions=2)
+    stream = DatasetStream(io.BytesIO(out.getvalue().encode('utf-8')))
+    documents = list(stream)
+    assert len(documents) == 10
+    for document in documents:
+        root = ElementTree.fromstring(document)
+        datasets = root.findall(DCAT_DATASET)
+        assert len(datasets) == 1
+        assert len(datasets[0].findall('.//{http://www.w3.org/ns/dcat#}Distribution')) == 2
+    assert stream.next_page is None
+
+
+def test_stream_flat_descriptions_and_next_page():
+    stream = DatasetStream(io.BytesIO(FLAT))
+    documents = list(stream)
+    assert len(documents) == 1
+    assert b'Uno' in documents[0]
+    assert stream.next_page == 'http://example.com/catalog.rdf?page=2'
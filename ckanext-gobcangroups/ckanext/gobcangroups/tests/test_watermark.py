@@ -0,0 +1,42 @@
+"""Tests for harvester/watermark.py."""
+from ckanext.gobcangroups.harvester.watermark import (
+    normalize_modified, dataset_modified, imported_modified, IncrementalFilter)
+
+
+def test_normalize_modified():
+    assert normalize_modified('2021-03-01') == '2021-03-01T00:00:00'
+    assert normalize_modified('2021-03-01T10:00:00+01:00') == '2021-03-01T09:00:00'
+    assert normalize_modified('not a date') is None
+    assert normalize_modified(None) is None
+
+
+def test_dataset_modified():
+    dataset = {'extras': [{'key': 'modified', 'value': '2021-03-01'}]}
+    assert dataset_modified(dataset) == '2021-03-01T00:00:00'
+    assert dataset_modified({'extras': []}) is None
+
+
+def test_incremental_filter():
+    incremental = IncrementalFilter({'a': '2021-03-01T00:00:00',
+                                     'b': '2021-03-01T00:00:00'})
+    assert incremental.skip('a', '2021-03-01T00:00:00')
+    assert not incremental.skip('b', '2021-03-02T00:00:00')
+    # A changed date older than the newest one of the source
+    assert not incremental.skip('b', '2021-02-01T00:00:00')
+    assert not incremental.skip('new', '2020-01-01T00:00:00')
+    assert not incremental.skip('a', None)
+    assert incremental.skipped == 1
+
+
+def test_imported_modified():
+    latest_objects = [
+        ('imported', 'COMPLETE', True, 'added', '2021-03-01T00:00:00'),
+        ('not-modified', 'COMPLETE', False, 'not modified',
+         '2021-02-01T00:00:00'),
+        ('no-date', 'COMPLETE', True, 'added', None),
+        ('failed', 'ERROR', False, 'errored', '2021-03-01T00:00:00'),
+        ('pending', 'WAITING', False, None, '2021-03-01T00:00:00'),
+        ('deleted', 'COMPLETE', False, 'deleted', '2021-03-01T00:00:00')]
+    assert imported_modified(latest_objects) == {
+        'imported': '2021-03-01T00:00:00',
+        'not-modified': '2021-02-01T00:00:00'}
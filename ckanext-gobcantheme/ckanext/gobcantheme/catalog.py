@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -
+import os
+import json
+import hashlib
+import inspect
+import logging
+import tempfile
+from collections import namedtuple
+from datetime import datetime
+
+from dateutil.parser import parse as parse_date
+
+import ckan.plugins.toolkit as toolkit
+from ckantoolkit import config
+from flask import Blueprint, make_response, request
+
+log = logging.getLogger(__name__)
+
+DEFAULT_ENDPOINT = '/catalog.{_format}'
+DEFAULT_DATASETS_PER_PAGE = 100
+# Oldest first, so that editing a dataset does not move it to another page
+# and only new datasets are appended at the end of the catalogue
+DEFAULT_SORT = 'metadata_created asc, id asc'
+
+# Formats kept on disk, as URL extension -> serializer format
+FORMATS = {'rdf': 'xml', 'xml': 'xml', 'ttl': 'ttl', 'jsonld': 'jsonld'}
+CONTENT_TYPES = {'rdf': 'application/rdf+xml',
+                 'xml': 'application/rdf+xml',
+                 'ttl': 'text/turtle',
+                 'jsonld': 'application/ld+json'}
+
+CachedPage = namedtuple('CachedPage', ['path', 'etag', 'last_modified'])
+
+# Settings read by the DCAT profiles, part of the cache version
+VERSION_SETTINGS = ('ckan.site_url', 'ckan.theme_taxonomy', 'ckan.publisher',
+                    'ckan.license', 'ckan.resource_formats')
+VERSION_PREFIXES = ('ckan.gobcan.', 'ckanext.dcat.',
+                    'ckanext.gobcantheme.catalog_cache.')
+
+catalog_cache = None
+
+
+def _as_datetime(value):
+    # Search results limited to some fields come straight from Solr, which
+    # may have parsed the dates already
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=None)
+    return parse_date(value).replace(tzinfo=None)
+
+
+def _profile_sources(profiles):
+    '''Returns the source code of the modules of the DCAT profiles in use'''
+    from ckanext.dcat.processors import RDFSerializer
+
+    modules = set(inspect.getmodule(profile)
+                  for profile in RDFSerializer(profiles=profiles)._profiles)
+    sources = []
+    for module in sorted(modules, key=lambda module: module.__name__):
+        try:
+            sources.append(inspect.getsource(module))
+        except (OSError, TypeError):
+            sources.append(module.__name__)
+    return sources
+
+
+def cache_version(config_, profiles=None):
+    '''
+    Returns the hash of what the catalogue pages depend on besides their
+    datasets: the code of the DCAT profiles and the settings they read,
+    including ``ckanext.gobcantheme.catalog_cache.version``. A deploy that
+    changes any of them renders every page again.
+    '''
+    settings = sorted((key, str(value)) for key, value in config_.items()
+                      if key in VERSION_SETTINGS or
+                      key.startswith(VERSION_PREFIXES))
+    key = json.dumps([settings, _profile_sources(profiles)])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def page_number(value):
+    try:
+        page = int(value or 1)
+    except ValueError:
+        raise toolkit.ValidationError(
+            {'page': ['Page param is not a valid integer']})
+    if page < 1:
+        raise toolkit.ValidationError(
+            {'page': ['Page param can not be negative']})
+    return page
+
+
+class CatalogCache(object):
+    '''
+    Pre-rendered pages of the DCAT catalogue endpoint, stored in `directory`.
+
+    The revision of a page is a hash of the ids and modification dates of
+    its datasets and of the total count (shown in the pagination of every
+    page), read with a search that only returns those two fields. A page is
+    serialised through the DCAT profiles once per revision and format, so a
+    changed dataset only re-renders the page it is in, and a new or deleted
+    one the pages after it. The revision also covers `version`, see
+    `cache_version`. Files are written atomically and shared by all the
+    processes using the same directory.
+    '''
+
+    def __init__(self, directory, datasets_per_page=DEFAULT_DATASETS_PER_PAGE,
+                 sort=DEFAULT_SORT, profiles=None, version=''):
+        self.directory = directory
+        self.datasets_per_page = datasets_per_page
+        self.sort = sort
+        self.profiles = profiles
+        self.version = version
+
+    def _search(self, page, fields=None):
+        data_dict = {'q': '*:*',
+                     'rows': self.datasets_per_page,
+                     'start': self.datasets_per_page * (page - 1),
+                     'sort': self.sort}
+        if fields:
+            data_dict['fl'] = fields
+        return toolkit.get_action('package_search')({}, data_dict)
+
+    def revision(self, query):
+        '''Returns the revision hash and last modification date of a page'''
+        datasets = [(dataset['id'], _as_datetime(dataset['metadata_modified']))
+                    for dataset in query['results']]
+        key = json.dumps([query['count'], self.datasets_per_page, self.sort,
+                          self.profiles, self.version,
+                          [(id_, modified.isoformat())
+                           for id_, modified in datasets]])
+        revision = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        last_modified = max(modified for _, modified in datasets) \
+            if datasets else None
+        return revision, last_modified
+
+    def path(self, page, _format, revision):
+        return os.path.join(self.directory, _format, str(page),
+                            '{0}.{1}'.format(revision, _format))
+
+    def get(self, page, _format):
+        '''
+        Returns the `CachedPage` of `page` in `_format`, rendering it first
+        if its current revision is not on disk yet. Pages past the end of
+        the catalogue are not cached and return None.
+        '''
+        query = self._search(page, fields=['id', 'metadata_modified'])
+        if page > 1 and not query['results']:
+            return None
+        revision, last_modified = self.revision(query)
+        path = self.path(page, _format, revision)
+        if not os.path.exists(path):
+            self.render(page, _format, path)
+        return CachedPage(path, '{0}-{1}'.format(revision, _format),
+                          last_modified)
+
+    def render(self, page, _format, path):
+        from ckanext.dcat.logic import _pagination_info
+        from ckanext.dcat.processors import RDFSerializer
+
+        log.debug('Rendering page %s of the catalogue as %s', page, _format)
+        query = self._search(page)
+        serializer = RDFSerializer(profiles=self.profiles)
+        output = serializer.serialize_catalog(
+            {}, query['results'], _format=FORMATS[_format],
+            pagination_info=_pagination_info(query, {'page': page}))
+        if not isinstance(output, bytes):
+            output = output.encode('utf-8')
+
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=directory, suffix='.tmp',
+                                         delete=False) as f:
+            f.write(output)
+        os.replace(f.name, path)
+
+        # Drop the previous revisions of the page
+        name = os.path.basename(path)
+        for other in os.listdir(directory):
+            if other != name and not other.endswith('.tmp'):
+                try:
+                    os.remove(os.path.join(directory, other))
+                except OSError:
+                    pass
+
+
+def configure(config_):
+    '''Creates the catalogue cache if a directory is configured for it'''
+    global catalog_cache
+
+    directory = config_.get('ckanext.gobcantheme.catalog_cache.directory')
+    if not directory:
+        catalog_cache = None
+        return
+    profiles = config_.get('ckanext.dcat.rdf.profiles')
+    profiles = profiles.split() if profiles else None
+    catalog_cache = CatalogCache(
+        directory,
+        datasets_per_page=toolkit.asint(config_.get(
+            'ckanext.dcat.datasets_per_page', DEFAULT_DATASETS_PER_PAGE)),
+        sort=config_.get('ckanext.gobcantheme.catalog_cache.sort',
+                         DEFAULT_SORT),
+        profiles=profiles,
+        version=cache_version(config_, profiles))
+
+
+def read_catalog(_format=None):
+    '''
+    Serves the plain catalogue pages from the cache with an ETag and a
+    Last-Modified date. Requests for other formats or with search
+    parameters go to the DCAT endpoint.
+    '''
+    from ckanext.dcat.utils import read_catalog_page
+
+    _format = request.args.get('format') or _format
+    if catalog_cache is None or _format not in FORMATS or \
+            set(request.args) - {'page', 'format'}:
+        return read_catalog_page(_format)
+
+    try:
+        page = catalog_cache.get(page_number(request.args.get('page')),
+                                 _format)
+    except toolkit.ValidationError as e:
+        toolkit.abort(409, str(e))
+    if page is None:
+        return read_catalog_page(_format)
+
+    try:
+        with open(page.path, 'rb') as f:
+            response = make_response(f.read())
+    except FileNotFoundError:
+        # Replaced by a newer revision rendered by another process
+        return read_catalog_page(_format)
+    response.headers['Content-Type'] = CONTENT_TYPES[_format]
+    response.set_etag(page.etag)
+    if page.last_modified:
+        response.last_modified = page.last_modified
+    return response.make_conditional(request)
+
+
+def get_blueprint():
+    blueprint = Blueprint('gobcantheme_catalog', __name__)
+    endpoint = config.get('ckanext.dcat.catalog_endpoint', DEFAULT_ENDPOINT)
+    blueprint.add_url_rule(endpoint.replace('{_format}', '<_format>'),
+                           'read_catalog', read_catalog)
+    return blueprint
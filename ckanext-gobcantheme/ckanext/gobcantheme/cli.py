@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -
+import json
+import logging
+
+import click
+
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.gobcantheme import dump
+
+
+log = logging.getLogger(__name__)
+
+
+def get_commands():
+    return [gobcantheme]
+
+
+@click.group()
+def gobcantheme():
+    '''GOBCAN portal commands'''
+    pass
+
+
+@gobcantheme.command('dump-catalogue')
+@click.option('--output-dir', default=None,
+              help='Directory of the dump files '
+                   '(default: ckanext.gobcantheme.catalog_dump.directory)')
+@click.option('--format', 'formats', type=click.Choice(sorted(dump.FORMATS)),
+              multiple=True,
+              help='Format to write, can be repeated (default: '
+                   'ckanext.gobcantheme.catalog_dump.formats)')
+@click.option('--batch-size', type=int, default=None,
+              help='Datasets serialised per batch')
+@click.option('--workers', type=int, default=None,
+              help='Worker processes serialising batches')
+@click.option('--enqueue', is_flag=True,
+              help='Run the dump on a background job worker')
+@click.option('--timeout', type=int, default=None,
+              help='Seconds the background job may run (default: '
+                   'ckanext.gobcantheme.catalog_dump.job_timeout)')
+def dump_catalogue(output_dir, formats, batch_size, workers, enqueue,
+                   timeout):
+    '''Write a compressed DCAT dump of the whole catalogue.'''
+    kwargs = {'directory': output_dir,
+              'formats': list(formats) or None,
+              'batch_size': batch_size,
+              'workers': workers}
+    if enqueue:
+        # The default job timeout of CKAN is far too short for a dump
+        timeout = timeout or toolkit.asint(toolkit.config.get(
+            'ckanext.gobcantheme.catalog_dump.job_timeout',
+            dump.DEFAULT_JOB_TIMEOUT))
+        job = toolkit.enqueue_job(dump.write_dump, kwargs=kwargs,
+                                  title='Dump the DCAT catalogue',
+                                  rq_kwargs={'timeout': timeout})
+        click.echo('Enqueued job {0}'.format(job.id))
+        return
+    try:
+        report = dump.write_dump(**kwargs)
+    except (RuntimeError, ValueError) as e:
+        raise click.ClickException(str(e))
+    click.echo(json.dumps(report, sort_keys=True))
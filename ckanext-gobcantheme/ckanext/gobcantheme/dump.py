@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -
+import os
+import gzip
+import shutil
+import logging
+import tempfile
+import multiprocessing
+from datetime import datetime
+
+from lxml import etree
+from rdflib import URIRef
+
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+from ckantoolkit import config
+from flask import Blueprint, send_from_directory
+
+log = logging.getLogger(__name__)
+
+# Dump format -> rdflib serializer
+FORMATS = {'nt': 'nt', 'ttl': 'turtle', 'rdf': 'xml'}
+DUMP_NAME = 'catalog.{0}.gz'
+DEFAULT_URL = '/catalog/dump'
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_JOB_TIMEOUT = 3600
+# Datasets are paged with an id cursor, so deleting a dataset while the dump
+# runs never shifts another one into a batch already written
+SORT = 'id asc'
+
+RDF_HEADER = (b'<?xml version="1.0" encoding="utf-8"?>\n'
+              b'<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">\n')
+RDF_FOOTER = b'</rdf:RDF>\n'
+
+
+def dump_directory():
+    directory = config.get('ckanext.gobcantheme.catalog_dump.directory')
+    if not directory:
+        raise RuntimeError(
+            'Set ckanext.gobcantheme.catalog_dump.directory to dump the '
+            'catalogue')
+    return directory
+
+
+def _id_range(after=None, last=None):
+    return 'id:{0}{1} TO {2}]'.format(
+        '{' if after else '[',
+        '"{0}"'.format(after) if after else '*',
+        '"{0}"'.format(last) if last else '*')
+
+
+def _search(rows, until, after=None, last=None, fields=None):
+    data_dict = {
+        'q': '*:*',
+        'fq': '+metadata_created:[* TO {0}] +{1}'.format(
+            until, _id_range(after, last)),
+        'sort': SORT,
+        'rows': rows}
+    if fields:
+        data_dict['fl'] = fields
+    return toolkit.get_action('package_search')({}, data_dict)
+
+
+def batch_ranges(batch_size, until, rows=None):
+    '''
+    Splits the datasets created up to `until` into batches of `batch_size`
+    by id, reading only their ids `rows` at a time. Returns the number of
+    datasets and a list of (after, last) id bounds per batch, `after`
+    excluded and `last` included, None meaning unbounded.
+    '''
+    rows = rows or batch_size
+    ranges = []
+    count = 0
+    start = after = None
+    while True:
+        ids = [dataset['id'] for dataset in
+               _search(rows, until, after, fields=['id'])['results']]
+        for id_ in ids:
+            count += 1
+            if count % batch_size == 0:
+                ranges.append((start, id_))
+                start = id_
+        if len(ids) < rows:
+            break
+        after = ids[-1]
+    if count % batch_size or not ranges:
+        ranges.append((start, None))
+    return count, ranges
+
+
+def serialize(graph, _format):
+    '''
+    Serialises a batch graph so that the batches of a dump can be joined
+    one after the other: N-Triples and Turtle documents can simply be
+    concatenated, for RDF/XML only the top level descriptions are kept, each
+    one declaring the namespaces it uses, to go under a single rdf:RDF.
+    '''
+    output = graph.serialize(format=FORMATS[_format])
+    if not isinstance(output, bytes):
+        output = output.encode('utf-8')
+    if _format == 'rdf':
+        root = etree.fromstring(output)
+        output = b''.join(
+            etree.tostring(child, encoding='utf-8', with_tail=False) + b'\n'
+            for child in root)
+    return output
+
+
+def part_path(parts, _format, batch):
+    return os.path.join(parts, '{0}-{1:08d}.gz'.format(_format, batch))
+
+
+def write_batches(parts, formats, batches, batch_size, until, profiles=None,
+                  compresslevel=6):
+    '''
+    Builds the graph of each (number, (after, last)) batch of datasets
+    through the DCAT profiles and writes it to a compressed part file per
+    format. The first batch also holds the catalogue description.
+    '''
+    from ckanext.dcat.processors import RDFSerializer
+    from ckanext.dcat.profiles import DCAT
+    from ckanext.dcat.utils import catalog_uri
+
+    catalog_ref = URIRef(catalog_uri())
+    for batch, (after, last) in batches:
+        query = _search(batch_size, until, after, last)
+        serializer = RDFSerializer(profiles=profiles)
+        if batch == 0:
+            serializer.graph_from_catalog()
+        for dataset_dict in query['results']:
+            dataset_ref = serializer.graph_from_dataset(dataset_dict)
+            serializer.g.add((catalog_ref, DCAT.dataset, dataset_ref))
+        for _format in formats:
+            with gzip.open(part_path(parts, _format, batch), 'wb',
+                           compresslevel) as f:
+                f.write(serialize(serializer.g, _format))
+        log.debug('Dumped batch %d (%d datasets)', batch,
+                  len(query['results']))
+
+
+def _batch_worker(*args):
+    try:
+        write_batches(*args)
+    finally:
+        model.Session.remove()
+
+
+def merge_parts(directory, parts, _format, batches, compresslevel=6):
+    '''
+    Joins the part files of `_format` in batch order into the dump file. A
+    sequence of gzip members is a valid gzip file, so the parts are copied
+    as they are without decompressing them.
+    '''
+    path = os.path.join(directory, DUMP_NAME.format(_format))
+    with tempfile.NamedTemporaryFile(dir=directory, suffix='.tmp',
+                                     delete=False) as output:
+        if _format == 'rdf':
+            output.write(gzip.compress(RDF_HEADER, compresslevel))
+        for batch in range(batches):
+            with open(part_path(parts, _format, batch), 'rb') as part:
+                shutil.copyfileobj(part, output)
+        if _format == 'rdf':
+            output.write(gzip.compress(RDF_FOOTER, compresslevel))
+    os.chmod(output.name, 0o644)
+    os.replace(output.name, path)
+    return path
+
+
+def write_dump(directory=None, formats=None, batch_size=None, workers=None,
+               compresslevel=6):
+    '''
+    Writes a compressed dump of the whole catalogue to `directory` in each
+    of `formats`, replacing the previous one once it is complete.
+
+    Datasets are read from the search index in batches of `batch_size`,
+    split by id before any of them is written, so memory use does not grow
+    with the catalogue and a dataset deleted while the dump runs never
+    moves another one to a different batch. Batches are split among
+    `workers` forked processes and merged in order. Datasets created after
+    the dump starts are left out.
+    '''
+    directory = directory or dump_directory()
+    formats = formats or config.get(
+        'ckanext.gobcantheme.catalog_dump.formats', 'nt ttl rdf').split()
+    unknown = set(formats) - set(FORMATS)
+    if unknown:
+        raise ValueError('Unknown dump formats: {0}'.format(
+            ', '.join(sorted(unknown))))
+    batch_size = batch_size or toolkit.asint(config.get(
+        'ckanext.gobcantheme.catalog_dump.batch_size', DEFAULT_BATCH_SIZE))
+    # package_search silently returns at most this many rows
+    rows_max = toolkit.asint(config.get('ckan.search.rows_max', 1000))
+    if not 0 < batch_size <= rows_max:
+        raise ValueError(
+            'The batch size must be between 1 and ckan.search.rows_max '
+            '({0})'.format(rows_max))
+    workers = workers or toolkit.asint(config.get(
+        'ckanext.gobcantheme.catalog_dump.workers', 1))
+    profiles = config.get('ckanext.dcat.rdf.profiles')
+    profiles = profiles.split() if profiles else None
+
+    until = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+    count, ranges = batch_ranges(batch_size, until, rows_max)
+    batches = len(ranges)
+    log.info('Dumping %d datasets in %d batches', count, batches)
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+    parts = tempfile.mkdtemp(prefix='.catalog-dump-', dir=directory)
+    try:
+        if workers <= 1:
+            write_batches(parts, formats, list(enumerate(ranges)), batch_size,
+                          until, profiles, compresslevel)
+        else:
+            _run_workers(workers, parts, formats, ranges, batch_size, until,
+                         profiles, compresslevel)
+        files = dict((_format, merge_parts(directory, parts, _format,
+                                           batches, compresslevel))
+                     for _format in formats)
+    finally:
+        shutil.rmtree(parts, ignore_errors=True)
+    return {'datasets': count, 'batches': batches, 'files': files}
+
+
+def _run_workers(workers, parts, formats, ranges, batch_size, until,
+                 profiles, compresslevel):
+    # Forked workers must not share the parent's connections
+    model.Session.remove()
+    model.meta.engine.dispose()
+
+    context = multiprocessing.get_context('fork')
+    processes = [
+        context.Process(target=_batch_worker,
+                        args=(parts, formats,
+                              list(enumerate(ranges))[index::workers],
+                              batch_size, until, profiles, compresslevel))
+        for index in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    failed = [index for index, process in enumerate(processes)
+              if process.exitcode != 0]
+    if failed:
+        raise RuntimeError(
+            'Catalogue dump workers {0} failed'.format(failed))
+
+
+def download_dump(filename):
+    if filename not in set(DUMP_NAME.format(_format) for _format in FORMATS):
+        toolkit.abort(404)
+    return send_from_directory(dump_directory(), filename,
+                               mimetype='application/gzip', conditional=True)
+
+
+def get_blueprint():
+    blueprint = Blueprint('gobcantheme_dump', __name__)
+    url = config.get('ckanext.gobcantheme.catalog_dump.url', DEFAULT_URL)
+    blueprint.add_url_rule(url.rstrip('/') + '/<filename>', 'download_dump',
+                           download_dump)
+    return blueprint
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -
+import os
+import json
+import logging
+import threading
+from collections import namedtuple
+from types import MappingProxyType
+
+from ckantoolkit import config
+
+log = logging.getLogger(__name__)
+
+IANA_MEDIA_TYPES = 'www.iana.org/assignments/media-types/'
+EU_FILE_TYPES = 'publications.europa.eu/resource/authority/file-type/'
+
+ResourceFormat = namedtuple('ResourceFormat',
+                            ['name', 'description', 'mimetype',
+                             'alternatives'])
+
+
+def normalize_format(value):
+    '''
+    Returns the key a format name, alias, file extension, media type or
+    media type / EU file type URI is matched with: case, surrounding and
+    repeated whitespace, a leading dot and media type parameters are ignored
+    '''
+    if not value:
+        return ''
+    key = ' '.join(str(value).split()).lower()
+    for scheme in ('https://', 'http://'):
+        if key.startswith(scheme):
+            key = key[len(scheme):]
+            for prefix in (IANA_MEDIA_TYPES, EU_FILE_TYPES):
+                if key.startswith(prefix):
+                    key = key[len(prefix):]
+                    break
+            break
+    key = key.split(';', 1)[0].strip()
+    return key.lstrip('.')
+
+
+class FormatIndex(object):
+    '''
+    Immutable lookup table of the resource formats of a
+    ``resource_formats.json`` file.
+
+    Any canonical name, media type or alternative name of a format finds
+    it, as does a file extension equal to one of them. Keys are matched in
+    that order of precedence, so an alias can never hide the canonical name
+    of another format. Extensions are not guessed from the media types:
+    the guesses depend on the mime.types file of the host and map many
+    extensions to generic types such as text/plain.
+    '''
+
+    def __init__(self, formats):
+        self.formats = tuple(formats)
+        keys = {}
+        passes = [
+            lambda fmt: [fmt.name],
+            lambda fmt: [fmt.mimetype],
+            lambda fmt: fmt.alternatives]
+        for values in passes:
+            for fmt in self.formats:
+                for value in values(fmt):
+                    key = normalize_format(value)
+                    if key and key not in keys:
+                        keys[key] = fmt
+        self.keys = MappingProxyType(keys)
+
+    @classmethod
+    def from_rows(cls, rows):
+        '''Builds the index from the rows of a resource formats file'''
+        return cls(ResourceFormat(row[0], row[1], row[2] or None,
+                                  tuple(row[3]) if len(row) > 3 else ())
+                   for row in rows
+                   if row and row[0] != '_comment')
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as f:
+            return cls.from_rows(json.load(f))
+
+    def get(self, value):
+        '''Returns the `ResourceFormat` `value` refers to, or None'''
+        return self.keys.get(normalize_format(value))
+
+    def name(self, value):
+        '''Returns the canonical name of a format or media type, or None'''
+        fmt = self.get(value)
+        return fmt.name if fmt else None
+
+    def mimetype(self, value):
+        '''Returns the media type of a format or media type, or None'''
+        fmt = self.get(value)
+        return fmt.mimetype if fmt else None
+
+
+_format_index = None
+_format_index_lock = threading.Lock()
+
+
+def _default_formats_file():
+    import ckan.config
+    return os.path.join(os.path.dirname(ckan.config.__file__),
+                        'resource_formats.json')
+
+
+def get_format_index():
+    '''
+    Returns the resource format index of the process, built on first use
+    from ``ckan.resource_formats``, the same file CKAN reads
+    '''
+    global _format_index
+    if _format_index is None:
+        with _format_index_lock:
+            if _format_index is None:
+                path = config.get('ckan.resource_formats', None) or \
+                    _default_formats_file()
+                _format_index = FormatIndex.from_file(path)
+    return _format_index
+
+
+def reload_format_index():
+    '''Drops the resource format index so the next lookup rebuilds it'''
+    global _format_index
+    with _format_index_lock:
+        _format_index = None
+
+
+def format_key(value):
+    '''
+    Returns the lowercase canonical name of a resource format, used for the
+    format labels and icons of the templates, or the normalised value if it
+    is not a known format
+    '''
+    name = get_format_index().name(value)
+    return name.lower() if name else normalize_format(value)
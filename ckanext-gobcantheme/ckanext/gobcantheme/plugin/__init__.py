@@ -11,6 +11,8 @@ from ckan.lib.plugins import DefaultTranslation
 from ckantoolkit import config
 from flask import Blueprint, redirect
 
+from ckanext.gobcantheme import catalog, cli, dump, formats
+
 HERE = os.path.abspath(os.path.dirname(__file__))
 I18N_DIR = os.path.join(HERE, "../i18n")
 
@@ -99,9 +101,11 @@ REDIRECT_VIEWS = (
 
 class GobcanthemePlugin(plugins.SingletonPlugin, DefaultTranslation):
     plugins.implements(plugins.IConfigurer)
+    plugins.implements(plugins.IConfigurable)
     plugins.implements(plugins.IBlueprint)
     plugins.implements(plugins.ITranslation)
     plugins.implements(plugins.ITemplateHelpers)
+    plugins.implements(plugins.IClick)
 
     # IConfigurer
 
@@ -110,6 +114,11 @@ class GobcanthemePlugin(plugins.SingletonPlugin, DefaultTranslation):
         toolkit.add_public_directory(config_, '../public')
         toolkit.add_resource('../assets', 'ckanext-gobcantheme')
 
+    # IConfigurable
+
+    def configure(self, config_):
+        catalog.configure(config_)
+
     # IBlueprint
 
     def get_blueprint(self):
@@ -121,7 +130,12 @@ class GobcanthemePlugin(plugins.SingletonPlugin, DefaultTranslation):
             for route_, view_, function_ in REDIRECT_VIEWS:
                 gobcantheme.add_url_rule(route_, view_, function_)
 
-        return [gobcantheme]
+        blueprints = [gobcantheme]
+        if catalog.catalog_cache is not None:
+            blueprints.append(catalog.get_blueprint())
+        if config.get('ckanext.gobcantheme.catalog_dump.directory'):
+            blueprints.append(dump.get_blueprint())
+        return blueprints
 
     # ITranslation
 
@@ -139,4 +153,10 @@ class GobcanthemePlugin(plugins.SingletonPlugin, DefaultTranslation):
             'gobcan_theme_accessibility_insuit_url': get_insuit_URL,
             'gobcan_theme_accessibility_readspeak_url': get_readspeak_URL,
             'gobcan_theme_pro_deploy': get_is_pro_deploy,
+            'gobcan_theme_format_key': formats.format_key,
         }
+
+    # IClick
+
+    def get_commands(self):
+        return cli.get_commands()
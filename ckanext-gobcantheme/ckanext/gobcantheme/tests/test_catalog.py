@@ -0,0 +1,77 @@
+"""Tests for catalog.py."""
+from datetime import datetime
+
+import pytest
+
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.gobcantheme import catalog
+
+
+def _query(*datasets, **kwargs):
+    return {'count': kwargs.get('count', len(datasets)),
+            'results': [{'id': id_, 'metadata_modified': modified}
+                        for id_, modified in datasets]}
+
+
+def test_page_number():
+    assert catalog.page_number(None) == 1
+    assert catalog.page_number('3') == 3
+    with pytest.raises(toolkit.ValidationError):
+        catalog.page_number('x')
+    with pytest.raises(toolkit.ValidationError):
+        catalog.page_number('0')
+
+
+def test_revision_changes_with_the_page_datasets():
+    cache = catalog.CatalogCache('/tmp/catalog')
+    query = _query(('a', '2020-01-01T10:00:00.000000'),
+                   ('b', '2020-02-01T10:00:00.000000'))
+    revision, last_modified = cache.revision(query)
+
+    assert last_modified == datetime(2020, 2, 1, 10)
+    assert cache.revision(query)[0] == revision
+    assert cache.revision(_query(('a', '2020-01-01T10:00:00.000000'),
+                                 ('b', '2020-03-01T10:00:00.000000')))[0] != revision
+    assert cache.revision(_query(('a', '2020-01-01T10:00:00.000000'),
+                                 ('b', '2020-02-01T10:00:00.000000'),
+                                 count=3))[0] != revision
+
+
+def test_revision_accepts_solr_dates():
+    cache = catalog.CatalogCache('/tmp/catalog')
+    parsed = _query(('a', datetime(2020, 1, 1, 10)))
+    raw = _query(('a', '2020-01-01T10:00:00Z'))
+
+    assert cache.revision(parsed) == cache.revision(raw)
+
+
+def test_path():
+    cache = catalog.CatalogCache('/tmp/catalog')
+
+    assert cache.path(2, 'ttl', 'abc') == '/tmp/catalog/ttl/2/abc.ttl'
+
+
+def test_revision_changes_with_the_cache_version():
+    query = _query(('a', '2020-01-01T10:00:00.000000'))
+
+    assert catalog.CatalogCache('/tmp/catalog', version='1').revision(query) != \
+        catalog.CatalogCache('/tmp/catalog', version='2').revision(query)
+
+
+def test_cache_version(monkeypatch):
+    sources = ['class Profile(object): pass']
+    monkeypatch.setattr(catalog, '_profile_sources', lambda profiles: sources)
+    config_ = {'ckan.gobcan.catalog_issued': '2020-01-01',
+               'ckan.site_url': 'http://example.com',
+               'ckan.plugins': 'dcat gobcantheme'}
+    version = catalog.cache_version(config_)
+
+    assert catalog.cache_version(dict(config_, **{'ckan.plugins': 'dcat'})) \
+        == version
+    assert catalog.cache_version(
+        dict(config_, **{'ckan.gobcan.catalog_issued': '2021-01-01'})) != version
+    assert catalog.cache_version(dict(
+        config_, **{'ckanext.gobcantheme.catalog_cache.version': '2'})) != version
+    sources[0] = 'class Profile(RDFProfile): pass'
+    assert catalog.cache_version(config_) != version
@@ -0,0 +1,80 @@
+"""Tests for dump.py."""
+import gzip
+
+import pytest
+from rdflib import BNode, Graph, Literal, Namespace, URIRef
+
+from ckanext.gobcantheme import dump
+
+DCT = Namespace('http://purl.org/dc/terms/')
+DCAT = Namespace('http://www.w3.org/ns/dcat#')
+
+RDFLIB_FORMATS = {'nt': 'nt', 'ttl': 'turtle', 'rdf': 'xml'}
+
+
+def _batch(batch, datasets=3):
+    g = Graph()
+    for number in range(datasets):
+        dataset = URIRef('http://example.org/dataset/{0}-{1}'.format(
+            batch, number))
+        distribution = BNode()
+        g.add((dataset, DCT.title, Literal(u'Conjunto {0}'.format(number),
+                                           lang='es')))
+        g.add((dataset, DCAT.distribution, distribution))
+        g.add((distribution, DCT['format'], Literal('CSV')))
+    return g
+
+
+def test_merged_batches_hold_every_triple(tmpdir):
+    parts = tmpdir.mkdir('parts')
+    expected = Graph()
+    for batch in range(3):
+        g = _batch(batch)
+        expected += g
+        for _format in dump.FORMATS:
+            with gzip.open(dump.part_path(str(parts), _format, batch),
+                           'wb') as f:
+                f.write(dump.serialize(g, _format))
+
+    for _format in dump.FORMATS:
+        path = dump.merge_parts(str(tmpdir), str(parts), _format, 3)
+        with gzip.open(path) as f:
+            merged = Graph().parse(data=f.read(),
+                                   format=RDFLIB_FORMATS[_format])
+
+        assert len(merged) == len(expected)
+        assert merged.isomorphic(expected)
+
+
+def test_rdf_xml_batches_declare_their_namespaces():
+    output = dump.serialize(_batch(0, datasets=1), 'rdf')
+
+    assert not output.startswith(b'<?xml')
+    assert b'<rdf:RDF' not in output
+    assert b'xmlns:rdf=' in output
+
+
+def test_batch_ranges_page_by_id(monkeypatch):
+    ids = ['id-{0:02d}'.format(number) for number in range(7)]
+    searches = []
+
+    def search(rows, until, after=None, last=None, fields=None):
+        searches.append(after)
+        matching = [id_ for id_ in ids if after is None or id_ > after]
+        return {'results': [{'id': id_} for id_ in matching[:rows]]}
+
+    monkeypatch.setattr(dump, '_search', search)
+
+    assert dump.batch_ranges(3, '2020-01-01T00:00:00Z', rows=4) == (
+        7, [(None, 'id-02'), ('id-02', 'id-05'), ('id-05', None)])
+    assert searches == [None, 'id-03']
+    assert dump.batch_ranges(7, '2020-01-01T00:00:00Z') == (
+        7, [(None, 'id-06')])
+
+    del ids[:]
+    assert dump.batch_ranges(3, '2020-01-01T00:00:00Z') == (0, [(None, None)])
+
+
+def test_batch_size_is_limited_to_rows_max(tmpdir):
+    with pytest.raises(ValueError):
+        dump.write_dump(directory=str(tmpdir), batch_size=5000)
@@ -0,0 +1,54 @@
+"""Tests for formats.py."""
+from ckanext.gobcantheme import formats
+
+ROWS = [
+    ['_comment', 'JSON field order as follows:'],
+    ['CSV', 'Comma Separated Values File', 'text/csv',
+     ['text/comma-separated-values']],
+    ['XLS', 'Excel Document', 'application/vnd.ms-excel', ['Excel']],
+    ['SHP', 'Shapefile', 'application/x-zipped-shp', ['esri shapefile']],
+    ['API', 'API', 'application/api', []],
+    ['TXT', 'Text file', 'text/plain', []],
+]
+
+
+def test_normalize_format():
+    assert formats.normalize_format('  Esri   Shapefile ') == 'esri shapefile'
+    assert formats.normalize_format('.CSV') == 'csv'
+    assert formats.normalize_format('text/csv; charset=utf-8') == 'text/csv'
+    assert formats.normalize_format(
+        'http://publications.europa.eu/resource/authority/file-type/CSV') == 'csv'
+    assert formats.normalize_format(
+        'https://www.iana.org/assignments/media-types/text/csv') == 'text/csv'
+    assert formats.normalize_format(None) == ''
+
+
+def test_lookup_by_any_name():
+    index = formats.FormatIndex.from_rows(ROWS)
+
+    for value in ('csv', ' CSV ', 'text/csv', 'Text/CSV; charset=utf-8',
+                  'text/comma-separated-values', '.csv'):
+        assert index.name(value) == 'CSV'
+    assert index.name('excel') == 'XLS'
+    assert index.name('.xls') == 'XLS'
+    assert index.mimetype('Esri Shapefile') == 'application/x-zipped-shp'
+    assert index.get('_comment') is None
+    assert index.get('unknown') is None
+    assert index.get(None) is None
+
+
+def test_canonical_names_win_over_aliases():
+    rows = ROWS + [['Excel', 'Excel', 'application/x-excel', []]]
+    index = formats.FormatIndex.from_rows(rows)
+
+    assert index.name('excel') == 'Excel'
+    assert index.name('xls') == 'XLS'
+
+
+
+def test_extensions_are_not_guessed_from_media_types():
+    index = formats.FormatIndex.from_rows(ROWS)
+
+    assert index.name('txt') == 'TXT'
+    assert index.get('bat') is None
+    assert index.get('c') is None
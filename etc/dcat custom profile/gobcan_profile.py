@@ -1,5 +1,9 @@
 
+import json
+import threading
 from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from types import MappingProxyType
 
 from rdflib.namespace import Namespace, XSD, RDF, RDFS
 from rdflib import Literal, URIRef, BNode
@@ -8,14 +12,168 @@ from ckanext.dcat.profiles import RDFProfile, CleanedURIRef, URIRefOrLiteral
 from ckanext.dcat.utils import resource_uri
 
 from ckan.model.license import LicenseRegister
-from ckan.lib import helpers as h
 
 from ckantoolkit import config
 
+try:
+    from ckanext.gobcantheme.formats import get_format_index
+except ImportError:
+    # Without ckanext-gobcantheme, formats are looked up in the CKAN list
+    from ckan.lib import helpers as h
+    get_format_index = None
+
 DCT = Namespace("http://purl.org/dc/terms/")
 DCAT = Namespace("http://www.w3.org/ns/dcat#")
 TIME = Namespace("http://www.w3.org/2006/time#")
 FOAF = Namespace("http://xmlns.com/foaf/0.1/")
+EU_FREQUENCY = Namespace(
+    "http://publications.europa.eu/resource/authority/frequency/")
+
+# Update frequencies as (time unit, amount, label, EU frequency URI). When
+# several durations share a label, the first one is used to serialise it.
+FREQUENCIES = [
+    (TIME.years, 1, 'Anual', EU_FREQUENCY.ANNUAL),
+    (TIME.months, 6, 'Semestral', EU_FREQUENCY.ANNUAL_2),
+    (TIME.months, 3, 'Trimestral', EU_FREQUENCY.QUARTERLY),
+    (TIME.months, 2, 'Bimensual', EU_FREQUENCY.BIMONTHLY),
+    (TIME.months, 1, 'Mensual', EU_FREQUENCY.MONTHLY),
+    (TIME.weeks, 2, 'Bisemanal', EU_FREQUENCY.BIWEEKLY),
+    (TIME.weeks, 1, 'Semanal', EU_FREQUENCY.WEEKLY),
+    (TIME.days, 15, 'Quincenal', EU_FREQUENCY.SEMIMONTHLY),
+    (TIME.days, 7, 'Semanal', EU_FREQUENCY.WEEKLY),
+    (TIME.days, 1, 'Diaria', EU_FREQUENCY.DAILY),
+]
+
+FREQUENCY_BY_DURATION = dict(((unit, amount), label)
+                             for unit, amount, label, _ in FREQUENCIES)
+FREQUENCY_BY_URI = {}
+FREQUENCY_BY_LABEL = {}
+for _unit, _amount, _label, _uri in FREQUENCIES:
+    FREQUENCY_BY_URI.setdefault(_uri, _label)
+    FREQUENCY_BY_LABEL.setdefault(_label.lower(), (_unit, _label, _amount))
+
+# Time units in the order they are checked when decoding a duration, any
+# amount of years is read as a yearly frequency
+FREQUENCY_UNITS = (TIME.years, TIME.months, TIME.weeks, TIME.days)
+DEFAULT_FREQUENCY = (TIME.years, 'Anual', '0')
+
+
+def _frequency_amount(value):
+    try:
+        amount = Decimal(str(value).strip())
+    except InvalidOperation:
+        return None
+    if amount == amount.to_integral_value():
+        return int(amount)
+
+
+def decode_duration(label, amounts):
+    '''
+    Returns the frequency label of a time:DurationDescription from its
+    rdfs:label and a dict of its time unit values, or None
+    '''
+    if label and label.strip().lower() in FREQUENCY_BY_LABEL:
+        return FREQUENCY_BY_LABEL[label.strip().lower()][1]
+    for unit in FREQUENCY_UNITS:
+        if unit not in amounts:
+            continue
+        if unit == TIME.years:
+            return 'Anual'
+        frequency = FREQUENCY_BY_DURATION.get(
+            (unit, _frequency_amount(amounts[unit])))
+        if frequency:
+            return frequency
+
+
+def normalize_license_uri(uri):
+    '''
+    Returns the key a license URI is matched with: case, scheme and
+    trailing slashes are ignored
+    '''
+    uri = str(uri).strip().lower()
+    for scheme in ('https://', 'http://'):
+        if uri.startswith(scheme):
+            uri = uri[len(scheme):]
+            break
+    return uri.rstrip('/')
+
+
+class LicenseIndex(object):
+    '''
+    Immutable URI -> id and title -> id lookup tables of the CKAN licenses
+    '''
+
+    def __init__(self, licenses):
+        uri2id = {}
+        title2id = {}
+        for license_id, url, title in licenses:
+            if url:
+                uri2id[normalize_license_uri(url)] = license_id
+            if title:
+                title2id[title] = license_id
+        self.uri2id = MappingProxyType(uri2id)
+        self.title2id = MappingProxyType(title2id)
+
+    @classmethod
+    def from_register(cls):
+        return cls((license_id, license.url, license.title)
+                   for license_id, license in LicenseRegister().items())
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as f:
+            licenses = json.load(f)
+        return cls((license['id'], license.get('url'), license.get('title'))
+                   for license in licenses)
+
+    def by_uri(self, uri):
+        if uri:
+            return self.uri2id.get(normalize_license_uri(uri))
+
+    def by_title(self, title):
+        if title:
+            return self.title2id.get(title)
+
+
+_license_index = None
+_license_index_lock = threading.Lock()
+
+
+def get_license_index():
+    '''
+    Returns the license index of the process, built on first use from
+    ``ckan.gobcan.licenses_file`` if set or from the CKAN license register
+    '''
+    global _license_index
+    if _license_index is None:
+        with _license_index_lock:
+            if _license_index is None:
+                path = config.get('ckan.gobcan.licenses_file', None)
+                _license_index = LicenseIndex.from_file(path) if path \
+                    else LicenseIndex.from_register()
+    return _license_index
+
+
+def reload_license_index():
+    '''Drops the license index so the next lookup rebuilds it'''
+    global _license_index
+    with _license_index_lock:
+        _license_index = None
+
+
+def resource_format(value):
+    '''
+    Returns the (canonical name, media type) of a format name, alias or
+    media type, or None if it is not a known format
+    '''
+    if not value:
+        return None
+    if get_format_index is not None:
+        fmt = get_format_index().get(value)
+        return (fmt.name, fmt.mimetype) if fmt else None
+    # Rows of h.resource_formats() are [media type, name, description]
+    row = h.resource_formats().get(value.strip().lower())
+    return (row[1], row[0] or None) if row else None
 
 
 class GobCanProfile(RDFProfile):
@@ -29,7 +187,6 @@ class GobCanProfile(RDFProfile):
     GOBCAN_PUBLISHER = None
     GOBCAN_LICENSE = None
     GOBCAN_ORGANIZATIONS = None
-    RESOURCE_FORMATS = None
 
     def __init__(self, graph, compatibility_mode=False):
         '''Class constructor
@@ -43,9 +200,6 @@ class GobCanProfile(RDFProfile):
         # Set organizations whitelist to escape replacement
         self._set_organizations_whitelist()
 
-        # Set the resource formats list
-        self._set_resource_formats()
-
         super(GobCanProfile, self).__init__(graph, compatibility_mode=False)
 
     def _set_catalog_properties(self):
@@ -76,21 +230,13 @@ class GobCanProfile(RDFProfile):
         that if distributions have different licenses we'll only get the first
         one.
         '''
-        if self._licenceregister_cache is not None:
-            license_uri2id, license_title2id = self._licenceregister_cache
-        else:
-            license_uri2id = {}
-            license_title2id = {}
-            for license_id, license in list(LicenseRegister().items()):
-                license_uri2id[license.url] = license_id
-                license_title2id[license.title] = license_id
-            self._licenceregister_cache = license_uri2id, license_title2id
+        licenses = get_license_index()
 
         dataset_license = self._object(dataset_ref, DCT.license)
         if dataset_license:
-            license_id = license_uri2id.get(dataset_license.toPython())
+            license_id = licenses.by_uri(dataset_license.toPython())
             if not license_id:
-                license_id = license_title2id.get(
+                license_id = licenses.by_title(
                     self._object_value(dataset_license, DCT.title))
             if license_id:
                 return license_id
@@ -100,9 +246,9 @@ class GobCanProfile(RDFProfile):
                 license = self._object(distribution, DCT.license)
                 if license:
                     # Try to find a matching license comparing URIs, then titles
-                    license_id = license_uri2id.get(license.toPython())
+                    license_id = licenses.by_uri(license.toPython())
                     if not license_id:
-                        license_id = license_title2id.get(
+                        license_id = licenses.by_title(
                             self._object_value(license, DCT.title))
                     if license_id:
                         return license_id
@@ -113,36 +259,14 @@ class GobCanProfile(RDFProfile):
         Returns a string with the update frequency checking the time
         tag
         '''
-        years = self._object_value(value[0], TIME.years)
-        if years:
-            return 'Anual'
-
-        months = self._object_value(value[0], TIME.months)
-        if months:
-            if months == '6':
-                return 'Semestral'
-            if months == '3':
-                return 'Trimestral'
-            if months == '2':
-                return 'Bimensual'
-            if months == '1':
-                return 'Mensual'
-
-        weeks = self._object_value(value[0], TIME.weeks)
-        if weeks:
-            if weeks == '2':
-                return 'Bisemanal'
-            if weeks == '1':
-                return 'Semanal'
-
-        days = self._object_value(value[0], TIME.days)
-        if days:
-            if days == '15':
-                return 'Quincenal'
-            if days == '7':
-                return 'Semanal'
-            if days == '1':
-                return 'Diaria'
+        label = None
+        amounts = {}
+        for predicate, obj in self.g.predicate_objects(value[0]):
+            if predicate == RDFS.label:
+                label = str(obj)
+            elif predicate in FREQUENCY_UNITS:
+                amounts.setdefault(predicate, obj)
+        return decode_duration(label, amounts)
 
     def _frequency(self, subject, predicate):
         '''
@@ -167,43 +291,27 @@ class GobCanProfile(RDFProfile):
             </dct:Frequency>
         </dct:accrualPeriodicity>
 
+        EU frequency vocabulary URIs are accepted both as the object of
+        dct:accrualPeriodicity and as the rdf:value of the dct:Frequency.
+
         Returns a string with the frequency value set to an empty string if
         it could not be found
         '''
-
-        value = frec = None
-
         for frequency in self.g.objects(subject, predicate):
+            if frequency in FREQUENCY_BY_URI:
+                return FREQUENCY_BY_URI[frequency]
             value = [t for t in self.g.objects(frequency, RDF.value)]
             if value:
-                frec = self._object_value(value[0], RDFS.label)
-                if frec.lower() in ('anual',
-                                    'semestral',
-                                    'trimestral',
-                                    'bimensual',
-                                    'mensual',
-                                    'quincenal',
-                                    'semanal',
-                                    'diaria'):
-                    return frec
-                else:
-                    return self._check_time_tag(value)
+                if value[0] in FREQUENCY_BY_URI:
+                    return FREQUENCY_BY_URI[value[0]]
+                return self._check_time_tag(value)
 
     def _get_frequency_details(self, frequency):
         '''
         Returns the time tag, the update frequency string and integer
         '''
-        frequencies = {
-            'anual': (TIME.years, 'Anual', 1),
-            'semestral': (TIME.months, 'Semestral', 6),
-            'trimestral': (TIME.months, 'Trimestral', 3),
-            'bimensual': (TIME.months, 'Bimensual', 2),
-            'mensual': (TIME.months, 'Mensual', 1),
-            'quincenal': (TIME.days, 'Quincenal', 15),
-            'semanal': (TIME.weeks, 'Semanal', 1),
-            'diaria': (TIME.days, 'Diaria', 1),
-        }
-        return frequencies.get(frequency.lower(), (TIME.years, 'Anual', '0'))
+        return FREQUENCY_BY_LABEL.get(frequency.strip().lower(),
+                                      DEFAULT_FREQUENCY)
 
     def _set_organizations_whitelist(self):
         if not config.get('ckan.gobcan.organizations_whitelist', None):
@@ -212,9 +320,6 @@ class GobCanProfile(RDFProfile):
         self.GOBCAN_ORGANIZATIONS = config.get(
             'ckan.gobcan.organizations_whitelist')
 
-    def _set_resource_formats(self):
-        self.RESOURCE_FORMATS = h.resource_formats()
-
     def parse_dataset(self, dataset_dict, dataset_ref):
         # License
         dataset_dict['license_id'] = self._license_new(dataset_ref)
@@ -226,6 +331,16 @@ class GobCanProfile(RDFProfile):
                 if item['key'] == 'frequency':
                     item['value'] = frequency
 
+        # Resource formats: canonical name and media type
+        for resource_dict in dataset_dict.get('resources', []):
+            known = resource_format(resource_dict.get('format')) or \
+                resource_format(resource_dict.get('mimetype'))
+            if known:
+                name, mimetype = known
+                resource_dict['format'] = name
+                if not resource_dict.get('mimetype') and mimetype:
+                    resource_dict['mimetype'] = mimetype
+
         return dataset_dict
 
     def graph_from_dataset(self, dataset_dict, dataset_ref):
@@ -286,7 +401,7 @@ class GobCanProfile(RDFProfile):
             # Format and media type
 
             mimetype = resource_dict.get('mimetype')
-            fmt = resource_dict.get('format')
+            fmt = resource_dict.get('format') or ''
             if not mimetype and '/' not in fmt:
 
                 # Add distribution
@@ -294,10 +409,8 @@ class GobCanProfile(RDFProfile):
                 g.add((dataset_ref, DCAT.distribution, distribution))
                 g.add((distribution, RDF.type, DCAT.Distribution))
 
-                resource_format_list = self.RESOURCE_FORMATS.get(fmt.lower())
-                imt_index = 0
-                if resource_format_list:
-                    mimetype = resource_format_list[imt_index]
+                known = resource_format(fmt)
+                mimetype = known[1] if known else None
 
                 # Add mimeType
                 if mimetype:
@@ -321,6 +434,13 @@ class GobCanProfile(RDFProfile):
             if value:
                 g.add((catalog_ref, predicate, _type(value)))
 
-        date = datetime.now()
-        self._add_date_triple(catalog_ref, DCT.issued, Literal(date.isoformat(),
-                                                               datatype=XSD.dateTime))
+        # A fixed issue date keeps the serialised catalogue identical between
+        # requests, which the catalogue page cache relies on
+        issued = (catalog_dict or {}).get('issued') or \
+            config.get('ckan.gobcan.catalog_issued', None)
+        if issued:
+            self._add_date_triple(catalog_ref, DCT.issued, issued)
+        else:
+            date = datetime.now()
+            self._add_date_triple(catalog_ref, DCT.issued, Literal(date.isoformat(),
+                                                                   datatype=XSD.dateTime))